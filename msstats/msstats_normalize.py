@@ -2,13 +2,152 @@
 """
 This script is intended to normalize MSstats input CSV such that
 it can be compared among multiple producers
+
+The numeric columns given by --columns (Intensity by default) are
+formatted with a fixed number of decimals, all other fields are passed
+through as they are. The file is read in chunks of lines. Records are
+only split as far as needed to reach the normalized columns, records with
+quoted fields (with commas, quotes or line breaks inside) by a CSV tokenizer
+which keeps them intact, and the values of each normalized column are
+formatted at once for the whole chunk. Values which are no numbers, like
+NA, are kept.
 """
 import argparse
+import collections
+import re
 import sys
 
 
-def normalize_intensity(intensity):
-    return "{0:.2f}".format(float(intensity))
+# Bytes of lines read at once
+chunk_size = 1 << 23
+
+default_columns = 'Intensity:2'
+
+# Raw text of a field, with the quotes if it is quoted
+re_field = re.compile(r'"(?:[^"]|"")*"|[^,"]*')
+
+
+def parse_columns(spec):
+    """
+    Returns the ordered dictionary of the columns to their precision from
+    the specification NAME[:PRECISION],..., where the precision defaults to 2.
+    """
+    columns = collections.OrderedDict()
+    for item in spec.split(','):
+        (name, _, precision) = item.strip().partition(':')
+        if not name:
+            raise ValueError("Empty column name in {}".format(spec))
+        try:
+            columns[name] = int(precision) if precision else 2
+        except ValueError:
+            raise ValueError("Precision of column {} is not an integer: {}".format(name, precision))
+        if columns[name] < 0:
+            raise ValueError("Precision of column {} is negative".format(name))
+    return columns
+
+
+def split_fields(line):
+    """
+    Splits the line into its fields as they are written, quoted fields
+    keep their quotes.
+    """
+    if '"' not in line:
+        return line.split(',')
+    fields = []
+    position = 0
+    while True:
+        m = re_field.match(line, position)
+        fields.append(m.group(0))
+        position = m.end()
+        if position == len(line):
+            return fields
+        if line[position] != ',':
+            raise ValueError("Malformed CSV line: {}".format(line))
+        position += 1
+
+
+def record_splitter(n_columns, positions):
+    """
+    Returns a function which splits a list of records only as far as needed
+    to separate the fields at the column positions, from the start or from
+    the end of the records, whichever is shorter, and the indices of these
+    fields in the split records. Joining a split record with commas restores
+    it. Records with quotes or an unexpected number of fields are split by
+    the tokenizer instead and packed into the same shape.
+    """
+    first = min(positions)
+    last = max(positions)
+    if last + 1 <= n_columns - first:
+        def pack(fields):
+            return fields[:last + 1] + ([','.join(fields[last + 1:])] if len(fields) > last + 1 else [])
+
+        def split(records):
+            return [record.split(',', last + 1) if '"' not in record else pack(split_fields(record))
+                    for record in records]
+        return (split, list(positions))
+
+    # The fields before the first column are kept together as the first field
+    prefix = 1 if first > 0 else 0
+    n_commas = n_columns - 1
+
+    def pack(fields):
+        return ([','.join(fields[:first])] if prefix else []) + fields[first:]
+
+    def split(records):
+        return [record.rsplit(',', n_columns - first)
+                if '"' not in record and record.count(',') == n_commas else pack(split_fields(record))
+                for record in records]
+    return (split, [position - first + prefix for position in positions])
+
+
+def unquote(field):
+    if len(field) >= 2 and field[0] == '"' and field[-1] == '"':
+        return field[1:-1].replace('""', '"')
+    return field
+
+
+def normalize_value(value, formatter):
+    try:
+        return formatter(float(unquote(value)))
+    except ValueError:
+        return value
+
+
+def normalize_values(values, precision):
+    """
+    Formats the values with precision decimals, keeping values which are no numbers.
+    """
+    formatter = '{{0:.{}f}}'.format(precision).format
+    try:
+        return list(map(formatter, map(float, values)))
+    except ValueError:
+        return [normalize_value(value, formatter) for value in values]
+
+
+def generate_records(f):
+    """
+    Generates the stripped, non-empty records of the CSV file f, joining the
+    lines of records with line breaks within quoted fields.
+    """
+    pending = None
+    while True:
+        lines = f.readlines(chunk_size)
+        if not lines:
+            break
+        records = []
+        for line in lines:
+            if pending is not None:
+                line = pending + line
+                pending = None
+            if '"' in line and line.count('"') % 2:
+                pending = line
+                continue
+            line = line.strip()
+            if line:
+                records.append(line)
+        yield records
+    if pending is not None:
+        raise ValueError("Unterminated quoted field: {}".format(pending.strip()))
 
 
 def main():
@@ -18,37 +157,44 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', type=str, required=True)
     parser.add_argument('-o', type=str, required=True)
+    parser.add_argument('--columns', type=str, default=default_columns,
+                        help="Numeric columns to normalize with their number of decimals, as NAME[:PRECISION],... "
+                             "Defaults to {}".format(default_columns))
     args = parser.parse_args(sys.argv[1:])
 
-    with open(args.i, 'r') as f:
+    try:
+        columns = parse_columns(args.columns)
+    except ValueError as e:
+        print("FATAL: {}".format(e), file=sys.stderr)
+        sys.exit(2)
+
+    with open(args.i, 'r', newline='') as f:
         with open(args.o, 'w') as outfile:
-            header = False
-            headers = {}
-            header_order = []
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                if not header:
-                    if 'ProteinName' in line:
-                        header = True
-                        outfile.write(line + '\n')
-                        header_order = line.split(SEP)
-                        # Match headers to column index
-                        headers = { column: index for (index, column) in enumerate(header_order)}
-                    else:
-                        print("FATAL: CSV input file does not start with header",
-                              file=sys.stderr)
+            positions = None
+            for records in generate_records(f):
+                if positions is None and records:
+                    header = records.pop(0)
+                    if 'ProteinName' not in header:
+                        print("FATAL: CSV input file does not start with header", file=sys.stderr)
                         sys.exit(1)
-                else:
-                    # Map the content of the line to a dict with the column names
-                    # as key names
-                    spt = line.split(SEP)
-                    line_content = {  header: spt[headers[header]]  for header in headers.keys() }
-                    line_content['Intensity'] = normalize_intensity(line_content['Intensity'])
-                    outfile.write(SEP.join([ line_content[header] for header in header_order]) + '\n')
-
-
+                    outfile.write(header + '\n')
+                    header_order = [unquote(column) for column in split_fields(header)]
+                    missing = [column for column in columns if column not in header_order]
+                    if missing:
+                        print("FATAL: Columns not in CSV header: {}".format(', '.join(missing)), file=sys.stderr)
+                        sys.exit(2)
+                    # Match the normalized columns to their index
+                    (split, indices) = record_splitter(
+                        len(header_order), [header_order.index(column) for column in columns])
+                    positions = list(zip(indices, columns.values()))
+                if positions is None:
+                    continue
+                rows = split(records)
+                for (position, precision) in positions:
+                    values = normalize_values([row[position] for row in rows], precision)
+                    for (row, value) in zip(rows, values):
+                        row[position] = value
+                outfile.write(''.join(SEP.join(row) + '\n' for row in rows))
 
 
 if __name__ == '__main__':
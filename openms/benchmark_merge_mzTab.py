@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of merge_mzTab_simple.py on many small synthetic mzTab files.
+
+Writes mzTab files as they are produced by SIRIUS or CSI:FingerID, each
+with its own ms_run and a few SML rows, and merges them with
+merge_mzTab_simple.py at once (--fan-in above the number of files), in a
+tree reduction with worker processes, and both ways in the order of the
+score column. The tree reduction has to give the same result as merging
+all files at once.
+
+Exits with 1 if an output of the tree reduction differs from the one of
+merging at once.
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'merge_mzTab_simple.py')
+
+columns = ['identifier', 'chemical_formula', 'smiles', 'inchi_key', 'description', 'exp_mass_to_charge',
+           'calc_mass_to_charge', 'charge', 'retention_time', 'taxid', 'species', 'database', 'database_version',
+           'reliability', 'uri', 'spectra_ref', 'search_engine', 'best_search_engine_score[1]',
+           'search_engine_score[1]_ms_run[1]', 'modifications', 'opt_global_rank', 'opt_global_explainedPeaks']
+
+sort_column = 'best_search_engine_score[1]'
+
+
+def write_inputs(directory, n_files, n_runs, max_rows, seed):
+    """
+    Writes the synthetic mzTab files to directory and returns their paths.
+    The ms_run of each file is one of n_runs locations, so files share
+    ms_runs, and each file has between 1 and max_rows SML rows.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for i in range(n_files):
+        lines = ['MTD\tmzTab-version\t1.0.0', 'MTD\tmzTab-mode\tSummary', 'MTD\tmzTab-type\tIdentification',
+                 'MTD\tmzTab-ID\tcompound_{}'.format(i), 'MTD\tdescription\tCSI:FingerID results',
+                 'MTD\tms_run[1]-location\tfile:///data/run{}.mzML'.format(i % n_runs),
+                 'MTD\tsoftware[1]\t[MS, MS:1002690, SIRIUS, 4.0]',
+                 'MTD\tsmall_molecule_search_engine_score[1]\t[, , CSI:FingerID score, ]', '',
+                 'SMH\t' + '\t'.join(columns)]
+        for r in range(rng.randint(1, max_rows)):
+            score = '{:.3f}'.format(-rng.uniform(0, 300))
+            lines.append('SML\t' + '\t'.join([
+                'c{}_{}'.format(i, r), 'C{}H{}O'.format(r, i % 40), 'CCO', 'KEY', 'null',
+                '{:.4f}'.format(rng.uniform(100, 900)), 'null', '1', '{:.2f}'.format(rng.uniform(1, 1000)),
+                'null', 'null', 'PubChem', 'null', '2', 'null', 'ms_run[1]:index={}'.format(i),
+                '[MS, MS:1002690, CSI:FingerID, ]', score, score, 'null', str(r + 1), str(rng.randint(1, 30))]))
+        path = os.path.join(directory, 'c{:05d}.mzTab'.format(i))
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        paths.append(path)
+    return paths
+
+
+def run_script(args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, script] + args, check=True)
+    return time.perf_counter() - start
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks merge_mzTab_simple.py on many small mzTab files")
+    parser.add_argument("--files", metavar="N", type=int, default=10000, help="Number of mzTab files")
+    parser.add_argument("--runs", metavar="N", type=int, default=3, help="Number of distinct ms_run locations")
+    parser.add_argument("--rows", metavar="N", type=int, default=6, help="Maximum number of SML rows of a file")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=4,
+                        help="Number of worker processes of the tree reduction")
+    parser.add_argument("--fan-in", dest="fan_in", metavar="N", type=int, default=128,
+                        help="Fan-in of the tree reduction")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", metavar="DIR", type=str,
+                        help="Write the inputs to DIR and keep them instead of using a temporary directory")
+    args = parser.parse_args(argv[1:])
+
+    directory = args.keep or tempfile.mkdtemp(prefix='benchmark_mztab_')
+    os.makedirs(directory, exist_ok=True)
+    try:
+        input_dir = os.path.join(directory, 'inputs')
+        os.makedirs(input_dir, exist_ok=True)
+        paths = write_inputs(input_dir, args.files, args.runs, args.rows, args.seed)
+        file_list = os.path.join(directory, 'inputs.txt')
+        with open(file_list, 'w') as f:
+            f.write(''.join(path + '\n' for path in paths))
+
+        sort_options = ['--sort-by', sort_column, '--numeric', '--reverse']
+        runs = [('single', ['--fan-in', str(args.files + 1)]),
+                ('tree', ['-j', str(args.jobs), '--fan-in', str(args.fan_in)]),
+                ('single sorted', ['--fan-in', str(args.files + 1)] + sort_options),
+                ('tree sorted', ['-j', str(args.jobs), '--fan-in', str(args.fan_in)] + sort_options)]
+        timings = {}
+        outputs = {}
+        for (name, options) in runs:
+            outputs[name] = os.path.join(directory, name.replace(' ', '_') + '.mzTab')
+            timings[name] = run_script(['--file-list', file_list, '-o', outputs[name]] + options)
+
+        identical = {'tree': read(outputs['tree']) == read(outputs['single']),
+                     'tree sorted': read(outputs['tree sorted']) == read(outputs['single sorted'])}
+        sys.stdout.write("{} files, {} ms_runs, -j {}, --fan-in {}\n".format(
+            args.files, args.runs, args.jobs, args.fan_in))
+        for (name, _) in runs:
+            if name in identical:
+                status = 'identical' if identical[name] else 'DIFFERS'
+            else:
+                status = ''
+            sys.stdout.write("{:<15s}{:>9.3f} s  {}\n".format(name, timings[name], status))
+    finally:
+        if args.keep is None:
+            shutil.rmtree(directory)
+    return 0 if all(identical.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Extracts compounds by their names from a SIRIUS .ms file into a new .ms
+file, for instance to rerun a few of them.
+
+The compounds are looked up in the index of the .ms file (see ms_index.py),
+which is built on the first use, and copied from the memory map of the
+file, so only the extracted compounds are read.
+"""
+import sys
+import argparse
+import os
+
+from ms_index import MsIndex
+
+
+def read_names(path):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Extracts compounds by their names from a SIRIUS .ms file")
+    parser.add_argument("IN", type=str, help="SIRIUS .ms file")
+    parser.add_argument("NAME", type=str, nargs='*', help="Names of the compounds to extract")
+    parser.add_argument('-l', '--names', metavar='FILE', type=str,
+                        help="File with further names of compounds to extract, one per line")
+    parser.add_argument('-o', metavar='OUT', type=str, help="Output .ms file. Defaults to stdout")
+    parser.add_argument('--file-order', dest='file_order', action='store_true',
+                        help="Write the compounds in the order of the .ms file instead of the order of the names")
+    parser.add_argument('--skip-missing', dest='skip_missing', action='store_true',
+                        help="Only warn about names which are not within the .ms file")
+    args = parser.parse_args(argv[1:])
+
+    for path in [args.IN] + ([args.names] if args.names is not None else []):
+        if not os.path.isfile(path):
+            sys.stderr.write("ERROR: File: {} does not exist.\n".format(path))
+            return 1
+    names = args.NAME + (read_names(args.names) if args.names is not None else [])
+
+    index = MsIndex(args.IN)
+    try:
+        (compounds, missing) = index.lookup(names)
+        if missing:
+            sys.stderr.write("{}: {} compounds are not within {}: {}\n".format(
+                'WARNING' if args.skip_missing else 'ERROR', len(missing), args.IN, ', '.join(missing)))
+            if not args.skip_missing:
+                return 3
+        if args.file_order:
+            compounds.sort(key=lambda compound: compound.offset)
+        if args.o is None:
+            index.write(compounds, sys.stdout.buffer)
+            sys.stdout.flush()
+        else:
+            with open(args.o, 'wb') as out:
+                index.write(compounds, out)
+    finally:
+        index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
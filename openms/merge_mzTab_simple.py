@@ -4,57 +4,555 @@
 Created on Fri Sep 22 10:04:02 2017
 
 Intended to merge mzTab files as they are produces by SIRIUS or CSI:FingerID.
-The first inputfile is simply copied to the output file. For all remaining
-input files, all lines with SML records are appended to the output file.
+
+Each input file is scanned once for its metadata (MTD) and the headers
+(PRH, PEH, PSH, SMH) of its sections, while only the byte ranges of the
+rows (PRT, PEP, PSM, SML) are recorded. The ms_run[n], assay[n] and
+study_variable[n] elements of all files are then numbered anew, where
+ms_runs with the same location are merged into one. All references to them
+in the metadata, the column headers and the spectra_ref column are
+rewritten accordingly. The output has the merged metadata, followed by
+each section in the order of the mzTab format, with the union of the
+columns of all files ('null' where a file lacks a column).
+
+Rows are streamed from one file after the other, or, with --sort-by, merged
+by a k-way merge into one order of the given column. Inputs whose rows are
+already in this order are streamed, only the rows of other inputs are
+sorted in memory. Sections whose rows need no changes are copied in large
+blocks.
+
+Inputs can be given as paths, glob patterns or a file list. More inputs
+than --fan-in are merged in a tree reduction: groups of at most --fan-in
+files are merged into intermediate files by a pool of worker processes,
+which are then merged again, until a single file remains. This bounds the
+number of open files and gives the same result as merging all at once.
 
 @author: Lukas Zimmermann
 """
 from __future__ import division
 import sys
 import argparse
+import collections
+import concurrent.futures
+import glob
+import heapq
+import math
 import os
+import re
+import shutil
+import tempfile
+
+
+# Header and row prefixes of the sections, in the order of the mzTab format
+sections = collections.OrderedDict([
+    (b'PRH', b'PRT'),
+    (b'PEH', b'PEP'),
+    (b'PSH', b'PSM'),
+    (b'SMH', b'SML')
+])
+row_prefixes = {row: header for (header, row) in sections.items()}
+
+# Elements of the metadata which are numbered anew for the merged file
+run_elements = ('ms_run', 'assay', 'study_variable')
+
+# Columns whose values refer to ms_runs
+reference_columns = ('spectra_ref',)
+
+null_value = 'null'
+
+default_fan_in = 128
+
+# Bytes copied at once from sections which need no changes
+copy_size = 1 << 20
+
+# Elements are also referred to within column names (search_engine_score[1]_ms_run[1])
+re_element = re.compile(r'(?<![A-Za-z])(ms_run|assay|study_variable)\[([0-9]+)\]')
+re_element_bytes = re.compile(rb'(?<![A-Za-z])(ms_run|assay|study_variable)\[([0-9]+)\]')
+re_run_key = re.compile(r'^(ms_run|assay|study_variable)\[([0-9]+)\]')
+
+# A section of an input file: its remapped column names and the byte range
+# of its rows, which are sorted if they are in the order of the sort key.
+# newline is the line break of the rows if the range only has rows which
+# all end with it, None otherwise
+Section = collections.namedtuple('Section', ['columns', 'start', 'end', 'sorted', 'newline'])
+
+# An input file: its metadata as list of (key, value), the mapping of its
+# (element, index) to the index in the merged file and its Sections
+MzTabFile = collections.namedtuple('MzTabFile', ['path', 'metadata', 'mapping', 'sections'])
+
+
+def split_line(line):
+    """
+    Fields of the line without its line break and the line break.
+    """
+    content = line.rstrip(b'\r\n')
+    return (content.split(b'\t'), line[len(content):])
+
+
+def numeric_key(value):
+    """
+    Sort key of numeric values. Values which are not numbers are sorted last.
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        return (1, 0.0)
+    if math.isnan(number):
+        return (1, 0.0)
+    return (0, number)
+
+
+def string_key(value):
+    return value
+
+
+def scan_file(path, sort_column=None, key=string_key, reverse=False):
+    """
+    Reads the metadata and section headers of the mzTab file at path and the
+    byte ranges of the rows of each section. Returns the MzTabFile without
+    mapping, and with the column names as in the file.
+    """
+    metadata = []
+    file_sections = collections.OrderedDict()
+    (header, columns, start, end, is_sorted, sort_position, last) = (None, None, None, None, True, None, None)
+    (newline, rows_end) = (None, None)
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            prefix = line[:3]
+            if prefix == b'MTD':
+                (fields, _) = split_line(line)
+                if len(fields) < 2:
+                    raise ValueError('Invalid metadata line in {}: {}'.format(path, line.decode('utf-8').rstrip()))
+                metadata.append((fields[1].decode('utf-8'), '\t'.join(f.decode('utf-8') for f in fields[2:])))
+            elif prefix in sections:
+                if header is not None:
+                    file_sections[header] = Section(columns, start, end, is_sorted, newline)
+                (fields, _) = split_line(line)
+                header = prefix
+                columns = [f.decode('utf-8') for f in fields[1:]]
+                (start, end, is_sorted, last) = (None, None, True, None)
+                (newline, rows_end) = (None, None)
+                sort_position = columns.index(sort_column) + 1 if sort_column in columns else None
+            elif prefix in row_prefixes:
+                if header != row_prefixes[prefix]:
+                    raise ValueError('Row of section {} without header in {}'.format(prefix.decode(), path))
+                line_newline = line[len(line.rstrip(b'\r\n')):]
+                if start is None:
+                    (start, newline) = (offset, line_newline)
+                elif rows_end != offset or line_newline != newline:
+                    newline = b''
+                end = offset + len(line)
+                rows_end = end
+                if sort_position is not None and is_sorted:
+                    (fields, _) = split_line(line)
+                    value = key(fields[sort_position].decode('utf-8') if sort_position < len(fields) else null_value)
+                    if last is not None and (value > last if reverse else value < last):
+                        is_sorted = False
+                    last = value
+            offset += len(line)
+    if header is not None:
+        file_sections[header] = Section(columns, start, end, is_sorted, newline)
+    return MzTabFile(path, metadata, {}, file_sections)
+
+
+def element_index(key):
+    """
+    (element, index) of a metadata key of an ms_run, assay or study_variable, None for other keys.
+    """
+    m = re_run_key.match(key)
+    return None if m is None else (m.group(1), int(m.group(2)))
+
+
+def remapper(mapping, encoding=None):
+    """
+    Function for re.sub which replaces the indices of the elements by those of the mapping.
+    """
+    def remap(match):
+        element = match.group(1) if encoding is None else match.group(1).decode(encoding)
+        index = mapping.get((element, int(match.group(2))))
+        if index is None:
+            return match.group(0)
+        replacement = '{}[{}]'.format(element, index)
+        return replacement if encoding is None else replacement.encode(encoding)
+    return remap
+
+
+class MetadataMerger(object):
+    """
+    Merges the metadata of the input files. The ms_run, assay and
+    study_variable elements of each file are numbered consecutively, except
+    ms_runs whose location has been seen before. All other keys are taken
+    from the first file which has them, differing values of later files are
+    recorded as conflicts.
+    """
+    def __init__(self):
+        self.lines = collections.OrderedDict()
+        self.conflicts = collections.OrderedDict()
+        self.counts = {element: 0 for element in run_elements}
+        self.locations = {}
+        # Lines (index, key, value) of each element, placed after the key preceding its first occurrence
+        self.element_lines = {element: [] for element in run_elements}
+        self.element_positions = collections.OrderedDict()
+
+    def add(self, metadata):
+        """
+        Adds the metadata of a file and returns its mapping of (element, index)
+        to the index in the merged file.
+        """
+        values = dict(metadata)
+        mapping = {}
+        shared = set()
+        previous = None
+        for (key, _) in metadata:
+            element = element_index(key)
+            if element is None:
+                previous = key
+                continue
+            self.element_positions.setdefault(element[0], previous)
+            if element in mapping:
+                continue
+            location = values.get('ms_run[{}]-location'.format(element[1])) if element[0] == 'ms_run' else None
+            if location is not None and location in self.locations:
+                mapping[element] = self.locations[location]
+                shared.add(element)
+                continue
+            self.counts[element[0]] += 1
+            mapping[element] = self.counts[element[0]]
+            if location is not None:
+                self.locations[location] = mapping[element]
+
+        remap = remapper(mapping)
+        for (key, value) in metadata:
+            element = element_index(key)
+            value = re_element.sub(remap, value)
+            if element is not None:
+                if element not in shared:
+                    self.element_lines[element[0]].append((mapping[element], re_element.sub(remap, key), value))
+            elif key not in self.lines:
+                self.lines[key] = value
+            elif self.lines[key] != value:
+                self.conflicts.setdefault(key, value)
+        return mapping
+
+    def generate_lines(self):
+        """
+        Generates the (key, value) of the merged metadata.
+        """
+        def generate_elements(previous):
+            for (element, position) in self.element_positions.items():
+                if position == previous:
+                    for (_, key, value) in sorted(self.element_lines[element], key=lambda line: line[0]):
+                        yield (key, value)
+        for line in generate_elements(None):
+            yield line
+        for (key, value) in self.lines.items():
+            yield (key, value)
+            for line in generate_elements(key):
+                yield line
+
+
+def remap_columns(columns, mapping):
+    remap = remapper(mapping)
+    return [re_element.sub(remap, column) for column in columns]
+
+
+def column_template(column):
+    """
+    Column name with the indices of its elements replaced and the indices,
+    by which columns of the same template are ordered.
+    """
+    indices = tuple(int(m.group(2)) for m in re_element.finditer(column))
+    return (re_element.sub(lambda m: m.group(1) + '[]', column), indices)
+
+
+def merge_columns(column_lists):
+    """
+    Union of the column lists. Columns of the same template are grouped
+    where the template first occurs and ordered by their indices, optional
+    columns (opt_) come last.
+    """
+    templates = collections.OrderedDict()
+    # Most files share their columns
+    for columns in dict.fromkeys(tuple(columns) for columns in column_lists):
+        for column in columns:
+            (template, indices) = column_template(column)
+            templates.setdefault(template, collections.OrderedDict())[column] = indices
+    merged = []
+    for optional in (False, True):
+        for (template, columns) in templates.items():
+            if template.startswith('opt_') == optional:
+                merged.extend(sorted(columns, key=lambda column: columns[column]))
+    return merged
+
+
+def row_transform(columns, merged_columns, mapping):
+    """
+    Returns the function which turns the fields of a row with the columns
+    into the line of the merged section, None if the row can be copied as is.
+    """
+    references = [i for (i, column) in enumerate(columns) if column in reference_columns]
+    identity = all(mapping[k] == k[1] for k in mapping)
+    if columns == merged_columns and (identity or not references):
+        return None
+    position = {column: i + 1 for (i, column) in enumerate(columns)}
+    positions = [position.get(column) for column in merged_columns]
+    reference_positions = {position[column] for column in reference_columns if column in position}
+    null = null_value.encode('ascii')
+    remap = remapper(mapping, 'ascii')
+
+    def transform(fields, prefix, newline):
+        out = [prefix]
+        for p in positions:
+            if p is None or p >= len(fields):
+                out.append(null)
+            elif p in reference_positions and not identity:
+                out.append(re_element_bytes.sub(remap, fields[p]))
+            else:
+                out.append(fields[p])
+        return b'\t'.join(out) + newline
+    return transform
+
+
+def generate_section_rows(mztab, prefix, transform, newline):
+    """
+    Generates the lines of the rows of the section of the mzTab file,
+    transformed for the merged file.
+    """
+    section = mztab.sections[prefix]
+    if section.start is None:
+        return
+    row_prefix = sections[prefix]
+    with open(mztab.path, 'rb') as f:
+        f.seek(section.start)
+        remaining = section.end - section.start
+        for line in f:
+            remaining -= len(line)
+            if line.startswith(row_prefix):
+                if transform is None:
+                    # Line breaks of all files are written as those of the first file
+                    yield line.rstrip(b'\r\n') + newline
+                else:
+                    (fields, _) = split_line(line)
+                    yield transform(fields, row_prefix, newline)
+            if remaining <= 0:
+                break
+
+
+def write_section_rows(mztab, prefix, transform, newline, out):
+    """
+    Writes the rows of the section of the mzTab file to out, as a block
+    copy if they need no changes.
+    """
+    section = mztab.sections[prefix]
+    if transform is not None or section.newline != newline:
+        for line in generate_section_rows(mztab, prefix, transform, newline):
+            out.write(line)
+        return
+    with open(mztab.path, 'rb') as f:
+        f.seek(section.start)
+        remaining = section.end - section.start
+        while remaining > 0:
+            block = f.read(min(copy_size, remaining))
+            if not block:
+                break
+            out.write(block)
+            remaining -= len(block)
+
+
+def generate_keyed_rows(mztab, prefix, transform, newline, sort_position, key, reverse=False):
+    """
+    Generates (key, line) for the rows of the section, in the order of the
+    file if its rows are sorted, and sorted in memory otherwise.
+    """
+    def keyed():
+        for line in generate_section_rows(mztab, prefix, transform, newline):
+            (fields, _) = split_line(line)
+            value = fields[sort_position].decode('utf-8') if sort_position < len(fields) else null_value
+            yield (key(value), line)
+    if mztab.sections[prefix].sorted:
+        return keyed()
+    return iter(sorted(keyed(), key=lambda x: x[0], reverse=reverse))
+
+
+def merge(paths, out, sort_column=None, numeric=False, reverse=False):
+    """
+    Merges the mzTab files at paths into the binary file out. Returns the
+    metadata keys whose values differ between the files.
+    """
+    key = numeric_key if numeric else string_key
+    merger = MetadataMerger()
+    mztabs = []
+    for path in paths:
+        mztab = scan_file(path, sort_column, key, reverse)
+        mapping = merger.add(mztab.metadata)
+        # Only the merged metadata is kept
+        mztabs.append(MzTabFile(path, None, mapping, collections.OrderedDict(
+            (prefix, section._replace(columns=remap_columns(section.columns, mapping)))
+            for (prefix, section) in mztab.sections.items())))
+
+    newline = b'\n'
+    with open(paths[0], 'rb') as f:
+        first = f.readline()
+        if first.endswith(b'\r\n'):
+            newline = b'\r\n'
+
+    for (metadata_key, value) in merger.generate_lines():
+        out.write(b'\t'.join([b'MTD', metadata_key.encode('utf-8')] +
+                             ([value.encode('utf-8')] if value != '' else [])) + newline)
+
+    for prefix in sections:
+        with_section = [mztab for mztab in mztabs if prefix in mztab.sections]
+        if not with_section:
+            continue
+        merged_columns = merge_columns([mztab.sections[prefix].columns for mztab in with_section])
+        out.write(newline + b'\t'.join([prefix] + [c.encode('utf-8') for c in merged_columns]) + newline)
+        # Files with the same columns and mapping share the transform of their rows
+        signatures = [(tuple(mztab.sections[prefix].columns), tuple(sorted(mztab.mapping.items())))
+                      for mztab in with_section]
+        shared = {}
+        for (signature, mztab) in zip(signatures, with_section):
+            if signature not in shared:
+                shared[signature] = row_transform(mztab.sections[prefix].columns, merged_columns, mztab.mapping)
+        transforms = [shared[signature] for signature in signatures]
+        if sort_column is not None and sort_column in merged_columns and prefix == b'SMH':
+            sort_position = merged_columns.index(sort_column) + 1
+            keyed = [generate_keyed_rows(mztab, prefix, transform, newline, sort_position, key, reverse)
+                     for (mztab, transform) in zip(with_section, transforms)]
+            for (_, line) in heapq.merge(*keyed, key=lambda x: x[0], reverse=reverse):
+                out.write(line)
+        else:
+            for (mztab, transform) in zip(with_section, transforms):
+                write_section_rows(mztab, prefix, transform, newline, out)
+    return list(merger.conflicts)
+
+
+def merge_files(paths, output, sort_column=None, numeric=False, reverse=False):
+    """
+    Merges the mzTab files at paths into the file output. Runs in the
+    worker processes of merge_tree.
+    """
+    with open(output, 'wb') as out:
+        return merge(paths, out, sort_column, numeric, reverse)
+
+
+def split_groups(paths, fan_in):
+    """
+    Splits the paths into the least number of consecutive groups of at most
+    fan_in paths, of about equal size.
+    """
+    n_groups = -(-len(paths) // fan_in)
+    size = -(-len(paths) // n_groups)
+    return [paths[i:i + size] for i in range(0, len(paths), size)]
+
+
+def merge_tree(paths, output, sort_column=None, numeric=False, reverse=False, jobs=1, fan_in=default_fan_in,
+               tmp_dir=None):
+    """
+    Merges the mzTab files at paths into the file output by a tree reduction,
+    which merges at most fan_in files at once, with jobs worker processes.
+    Returns the metadata keys whose values differ between the files.
+    """
+    conflicts = collections.OrderedDict()
+    tmp = tempfile.mkdtemp(prefix='.merge_mzTab', dir=tmp_dir or os.path.dirname(os.path.abspath(output)))
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            level = 0
+            while len(paths) > fan_in:
+                groups = split_groups(paths, fan_in)
+                outputs = [os.path.join(tmp, '{}_{}.mzTab'.format(level, i)) for i in range(len(groups))]
+                futures = [pool.submit(merge_files, group, group_output, sort_column, numeric, reverse)
+                           for (group, group_output) in zip(groups, outputs)]
+                for future in futures:
+                    conflicts.update((key, None) for key in future.result())
+                # Intermediate files of the previous level are no longer needed
+                if level > 0:
+                    for path in paths:
+                        os.remove(path)
+                (paths, level) = (outputs, level + 1)
+        conflicts.update((key, None) for key in merge_files(paths, output, sort_column, numeric, reverse))
+    finally:
+        shutil.rmtree(tmp)
+    return list(conflicts)
+
+
+def expand_inputs(patterns, file_list=None):
+    """
+    Paths of the input files given as paths or glob patterns, followed by
+    those listed one per line in file_list. Raises a ValueError for inputs
+    which do not exist.
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isfile(pattern) or glob.escape(pattern) == pattern:
+            paths.append(pattern)
+        else:
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise ValueError("No files match {}".format(pattern))
+            paths.extend(matches)
+    if file_list is not None:
+        with open(file_list, 'r') as f:
+            paths.extend(line.strip() for line in f if line.strip())
+    for path in paths:
+        if not os.path.isfile(path):
+            raise ValueError("File: {} does not exist.".format(path))
+    return paths
 
 
 def main(argv):
-    
+
     # Argument parser
     parser = argparse.ArgumentParser()
-    
-    parser.add_argument('-i', type=argparse.FileType('r'), nargs='+', help="MzML Files to be merged.", required=True)
-    parser.add_argument('-o', type=argparse.FileType('w'), help="Where the result should be written to", required=True)
-    parser.add_argument('--prefix', type=str, help="Lines starting with this prefix are going to be appended to the original file", required=True)
+
+    parser.add_argument('-i', type=str, nargs='+', default=[],
+                        help="mzTab Files to be merged, or glob patterns (quoted) of them.")
+    parser.add_argument('--file-list', dest='file_list', metavar='FILE', type=str,
+                        help="File with the paths of further mzTab files to be merged, one per line")
+    parser.add_argument('-o', type=str, help="Where the result should be written to", required=True)
+    parser.add_argument('--prefix', type=str,
+                        help="Ignored, all sections are merged. Kept for compatibility with older pipelines")
+    parser.add_argument('--sort-by', dest='sort_by', metavar='COLUMN', type=str,
+                        help="Merge the SML rows of all files into the order of this column")
+    parser.add_argument('--numeric', action='store_true', help="Compare the values of the sort column as numbers")
+    parser.add_argument('--reverse', action='store_true', help="Sort in descending order")
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help="Number of worker processes merging groups of files")
+    parser.add_argument('--fan-in', dest='fan_in', metavar='N', type=int, default=default_fan_in,
+                        help="Maximum number of files merged at once. More files are merged in a tree reduction")
+    parser.add_argument('--tmp-dir', dest='tmp_dir', metavar='DIR', type=str,
+                        help="Directory of the intermediate files. Defaults to the directory of the output")
     args = parser.parse_args(argv[1:])
-    infiles = args.i
-    prefix = args.prefix.strip()
-    
+
+    try:
+        paths = expand_inputs(args.i, args.file_list)
+    except (ValueError, OSError) as e:
+        sys.stderr.write("ERROR: {}\n".format(e))
+        return 1
+    if not paths:
+        sys.stderr.write("ERROR: No input files given\n")
+        return 1
+    if args.jobs < 1 or args.fan_in < 2:
+        sys.stderr.write("ERROR: The number of jobs has to be at least 1 and the fan-in at least 2\n")
+        return 1
+
     try:
-        with args.o as outfile:
-            
-            # Copy whole content of  first file
-            infiles = args.i
-            
-            with infiles[0] as infile:
-                for line in infile:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    outfile.write(line)
-                    outfile.write(os.linesep)
-                   
-            for infile in infiles[1:]:
-                with infile as infile:
-                    for line in infile:
-                        line = line.strip()
-                        if line.startswith(prefix):
-                            outfile.write(line)
-                            outfile.write(os.linesep)
-     
-    # If something goes wrong, delete the output file, so the 
+        if len(paths) > args.fan_in:
+            conflicts = merge_tree(paths, args.o, args.sort_by, args.numeric, args.reverse, args.jobs, args.fan_in,
+                                   args.tmp_dir)
+        else:
+            conflicts = merge_files(paths, args.o, args.sort_by, args.numeric, args.reverse)
+        for key in conflicts:
+            sys.stderr.write("WARNING: Conflicting values for {}, keeping the first one\n".format(key))
+
+    # If something goes wrong, delete the output file, so the
     # user is not presented with an incomplete file
-    except:
-        os.remove(outfile.name)
+    except Exception as e:
+        sys.stderr.write("ERROR: {}\n".format(e))
+        if os.path.exists(args.o):
+            os.remove(args.o)
         return 1
-        
+
     return 0
 
 
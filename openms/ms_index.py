@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent index of the compounds within a SIRIUS .ms file.
+
+The index is a SQLite sidecar file next to the .ms file, mapping the name
+of each compound to the byte offset and length of its lines and its number
+of peaks. It records the size and modification time of the .ms file and is
+rebuilt automatically once the file changes. Compounds are read as slices
+of a memory map of the .ms file, so they are written out without copies.
+
+If the directory of the .ms file is not writable, the index is kept in a
+user cache directory instead, and if that is not writable either, it is
+built in memory for each run.
+"""
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+
+from sirius_ms import Compound, open_buffer, close_buffer, generate_compounds
+
+
+index_suffix = '.msidx'
+
+default_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))),
+                                 'xlink_scripts', 'ms')
+
+# Compounds inserted at once while building the index
+insert_batch_size = 10000
+
+
+def index_path(ms_path, directory=None):
+    """
+    Path of the index. By default it is next to the .ms file, within
+    directory it is named after the absolute path of the file.
+    """
+    if directory is None:
+        return ms_path + index_suffix
+    return os.path.join(directory, hashlib.sha1(os.path.abspath(ms_path).encode('utf-8')).hexdigest()) + \
+        index_suffix
+
+
+def ms_stamp(ms_path):
+    """
+    Size and modification time of the .ms file, which identify its version.
+    """
+    stat = os.stat(ms_path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def fill_index(connection, ms_path):
+    """
+    Creates the tables of the index in the SQLite connection and inserts the
+    compounds of the .ms file, see generate_compounds.
+    """
+    (size, mtime) = ms_stamp(ms_path)
+    connection.executescript('''
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        CREATE TABLE meta (size INTEGER, mtime INTEGER);
+        CREATE TABLE compounds (name TEXT, offset INTEGER, length INTEGER, peaks INTEGER);
+    ''')
+    with open(ms_path, 'rb') as f:
+        buffer = open_buffer(f)
+        try:
+            compounds = generate_compounds(buffer)
+            while True:
+                batch = [compound for (_, compound) in zip(range(insert_batch_size), compounds)]
+                if not batch:
+                    break
+                connection.executemany('INSERT INTO compounds VALUES (?, ?, ?, ?)', batch)
+        finally:
+            close_buffer(buffer)
+    # Creating the index after all inserts is much faster than maintaining it
+    connection.execute('CREATE INDEX compounds_name ON compounds (name)')
+    connection.execute('INSERT INTO meta VALUES (?, ?)', (size, mtime))
+    connection.commit()
+
+
+def build_index(ms_path, directory=None):
+    """
+    Builds the index of the .ms file, next to it or within directory, into
+    a temporary file, which is then moved into place.
+    """
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(ms_path))
+        target = None
+    else:
+        os.makedirs(directory, exist_ok=True)
+        target = directory
+    umask = os.umask(0)
+    os.umask(umask)
+    (fd, tmp_index) = tempfile.mkstemp(prefix='.', suffix=index_suffix, dir=directory)
+    os.close(fd)
+    try:
+        connection = sqlite3.connect(tmp_index)
+        try:
+            fill_index(connection, ms_path)
+        finally:
+            connection.close()
+
+        # mkstemp creates files which are only accessible by the owner
+        os.chmod(tmp_index, 0o666 & ~umask)
+        os.replace(tmp_index, index_path(ms_path, target))
+    finally:
+        if os.path.exists(tmp_index):
+            os.remove(tmp_index)
+
+
+def is_current(ms_path, directory=None):
+    """
+    Whether the index of the .ms file exists and matches its current version.
+    """
+    path = index_path(ms_path, directory)
+    if not os.path.isfile(path):
+        return False
+    try:
+        connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+        try:
+            meta = connection.execute('SELECT size, mtime FROM meta').fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return False
+    return meta is not None and tuple(meta) == ms_stamp(ms_path)
+
+
+class MsIndex(object):
+    """
+    Random access to the compounds of a .ms file through its index, which is
+    (re)built first if necessary. Each process has to open its own MsIndex.
+    The index is looked up and built next to the .ms file first, then within
+    cache_dir, and built in memory if neither is writable.
+    """
+    def __init__(self, ms_path, cache_dir=default_cache_dir):
+        self.ms_path = ms_path
+        directories = [None, cache_dir]
+        current = [directory for directory in directories if is_current(ms_path, directory)]
+        # False stands for the index in memory
+        directory = current[0] if current else False
+        if not current:
+            for candidate in directories:
+                try:
+                    build_index(ms_path, candidate)
+                    directory = candidate
+                    break
+                except (OSError, sqlite3.Error) as e:
+                    sys.stderr.write("WARNING: Could not write index of {} to {}: {}\n".format(
+                        ms_path, os.path.dirname(os.path.abspath(index_path(ms_path, candidate))), e))
+        if directory is False:
+            sys.stderr.write("WARNING: Building the index of {} in memory\n".format(ms_path))
+            self.connection = sqlite3.connect(':memory:')
+            fill_index(self.connection, ms_path)
+        else:
+            self.connection = sqlite3.connect('file:{}?mode=ro'.format(index_path(ms_path, directory)), uri=True)
+        self.ms = open(ms_path, 'rb')
+        self.buffer = open_buffer(self.ms)
+
+    def __contains__(self, name):
+        return self.connection.execute('SELECT 1 FROM compounds WHERE name = ? LIMIT 1',
+                                       (name,)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM compounds').fetchone()[0]
+
+    def compounds(self, name):
+        """
+        Returns the list of the Compounds with the name, in the order of the file.
+        """
+        return [Compound(*row) for row in self.connection.execute(
+            'SELECT name, offset, length, peaks FROM compounds WHERE name = ? ORDER BY rowid', (name,))]
+
+    def lookup(self, names):
+        """
+        Returns the list of the Compounds with the names, in the order of the
+        names, and the list of the names which are not within the file.
+        """
+        found = []
+        missing = []
+        for name in dict.fromkeys(names):
+            compounds = self.compounds(name)
+            if compounds:
+                found.extend(compounds)
+            else:
+                missing.append(name)
+        return (found, missing)
+
+    def write(self, compounds, out):
+        """
+        Writes the lines of the compounds to the binary file out, directly
+        from the memory map of the .ms file.
+        """
+        view = memoryview(self.buffer)
+        try:
+            for compound in compounds:
+                out.write(view[compound.offset:compound.offset + compound.length])
+        finally:
+            view.release()
+
+    def close(self):
+        close_buffer(self.buffer)
+        self.ms.close()
+        self.connection.close()
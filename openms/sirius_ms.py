@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reads the compounds of SIRIUS .ms files.
+
+An .ms file is a sequence of compounds, each starting with a line
+'>compound NAME' and followed by further '>' lines with its properties and
+the peak lists of its spectra, one 'mz intensity' line per peak. The file
+is memory mapped and only scanned for the offsets of the compound lines,
+the compounds themselves are handed out as byte ranges of the file.
+"""
+import collections
+import mmap
+import os
+
+
+# A compound of the file: its name, the byte range of its lines and the
+# number of its peaks, which estimates the work of processing it
+Compound = collections.namedtuple('Compound', ['name', 'offset', 'length', 'peaks'])
+
+compound_tag = b'>compound'
+
+# Starts of the lines which are no peaks, after the line break of the previous line
+non_peak_starts = (b'\n>', b'\n\n', b'\n\r', b'\n#')
+
+
+def open_buffer(f):
+    """
+    Memory map of the binary file f, empty bytes for an empty file.
+    """
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def close_buffer(buffer):
+    if isinstance(buffer, mmap.mmap):
+        buffer.close()
+
+
+def compound_offsets(buffer):
+    """
+    Returns the list of the offsets of the compound lines.
+    """
+    offsets = []
+    position = 0 if buffer[:len(compound_tag)] == compound_tag else buffer.find(b'\n' + compound_tag)
+    while position != -1:
+        if buffer[position:position + 1] == b'\n':
+            position += 1
+        offsets.append(position)
+        position = buffer.find(b'\n' + compound_tag, position)
+    return offsets
+
+
+def preamble_length(buffer):
+    """
+    Number of bytes before the first compound, which are usually comments.
+    """
+    position = 0 if buffer[:len(compound_tag)] == compound_tag else buffer.find(b'\n' + compound_tag)
+    return len(buffer) if position == -1 else position + (1 if position else 0)
+
+
+def count_peaks(lines):
+    """
+    Number of peak lines in the lines of a compound, which are all lines but
+    the compound line and those which are empty, comments or start with '>'.
+    """
+    n_lines = lines.count(b'\n') + (0 if lines.endswith(b'\n') else 1)
+    return n_lines - 1 - sum(lines.count(start) for start in non_peak_starts)
+
+
+def compound_at(buffer, offset, end):
+    """
+    The Compound whose line starts at offset and which ends at end.
+    """
+    lines = buffer[offset:end]
+    name_end = lines.find(b'\n')
+    name = lines[len(compound_tag):name_end if name_end != -1 else len(lines)].strip()
+    return Compound(name.decode('utf-8'), offset, end - offset, count_peaks(lines))
+
+
+def generate_compounds(buffer):
+    """
+    Generates the Compounds of the .ms file in buffer in the order of the file.
+    """
+    offsets = compound_offsets(buffer)
+    for (offset, end) in zip(offsets, offsets[1:] + [len(buffer)]):
+        yield compound_at(buffer, offset, end)
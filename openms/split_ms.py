@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Splits a SIRIUS .ms file into shards of whole compounds, which can be
+processed by separate SIRIUS jobs.
+
+The shards are made of a fixed number of compounds each (--count), of a
+fixed number of shards with consecutive compounds (--shards), or of a fixed
+number of shards balanced by the estimated work (--balanced). The work of a
+compound is estimated by the number of its peaks, and the compounds are
+assigned to the shards greedily from the largest, each to the shard with the
+least work so far. Within a shard, the compounds keep the order of the file.
+
+The shards are named 0.ms, 1.ms, ... in the output directory, and the
+manifest lists each shard with its number of compounds, peaks and bytes,
+so jobs can be scheduled by their size.
+"""
+import sys
+import argparse
+import heapq
+import os
+
+from sirius_ms import open_buffer, close_buffer, generate_compounds, preamble_length
+
+
+manifest_name = 'manifest.tsv'
+manifest_header = ['shard', 'compounds', 'peaks', 'bytes']
+
+# Size of the write buffer of the shards
+buffer_size = 1 << 20
+
+
+def shard_by_count(compounds, count):
+    """
+    Lists of consecutive compounds with count compounds each.
+    """
+    return [compounds[i:i + count] for i in range(0, len(compounds), count)]
+
+
+def shard_by_number(compounds, n_shards):
+    """
+    n_shards lists of consecutive compounds, whose sizes differ by at most one.
+    """
+    n_shards = min(n_shards, len(compounds))
+    (size, rest) = divmod(len(compounds), n_shards) if n_shards else (0, 0)
+    shards = []
+    start = 0
+    for i in range(n_shards):
+        end = start + size + (1 if i < rest else 0)
+        shards.append(compounds[start:end])
+        start = end
+    return shards
+
+
+def compound_work(compound):
+    # Compounds without peaks still cost a SIRIUS run
+    return compound.peaks + 1
+
+
+def shard_balanced(compounds, n_shards):
+    """
+    n_shards lists of compounds with about equal work, by assigning the
+    compounds from the largest to the shard with the least work so far.
+    """
+    n_shards = min(n_shards, len(compounds))
+    heap = [(0, i) for i in range(n_shards)]
+    shards = [[] for _ in range(n_shards)]
+    for compound in sorted(compounds, key=compound_work, reverse=True):
+        (work, i) = heapq.heappop(heap)
+        shards[i].append(compound)
+        heapq.heappush(heap, (work + compound_work(compound), i))
+    return [sorted(shard, key=lambda compound: compound.offset) for shard in shards]
+
+
+def write_shard(buffer, compounds, path, preamble=0):
+    """
+    Writes the compounds (in this order) and the first preamble bytes of the
+    buffer into the file at path. Consecutive compounds are written at once.
+    Returns the number of bytes written.
+    """
+    view = memoryview(buffer)
+    written = 0
+    try:
+        with open(path, 'wb', buffering=buffer_size) as out:
+            ranges = [(0, preamble)] if preamble else []
+            for compound in compounds:
+                if ranges and ranges[-1][1] == compound.offset:
+                    ranges[-1] = (ranges[-1][0], compound.offset + compound.length)
+                else:
+                    ranges.append((compound.offset, compound.offset + compound.length))
+            for (start, end) in ranges:
+                out.write(view[start:end])
+                written += end - start
+    finally:
+        view.release()
+    return written
+
+
+def split(path, output_dir, count=None, n_shards=None, balanced=None):
+    """
+    Splits the .ms file at path into shards in output_dir by one of count,
+    n_shards or balanced. Returns the rows of the manifest.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = []
+    with open(path, 'rb') as f:
+        buffer = open_buffer(f)
+        try:
+            compounds = list(generate_compounds(buffer))
+            if count is not None:
+                shards = shard_by_count(compounds, count)
+            elif n_shards is not None:
+                shards = shard_by_number(compounds, n_shards)
+            else:
+                shards = shard_balanced(compounds, balanced)
+            # Anything before the first compound stays at the beginning of the first shard
+            preamble = preamble_length(buffer)
+            if not shards and preamble:
+                shards = [[]]
+            for (i, shard) in enumerate(shards):
+                name = '{}.ms'.format(i)
+                written = write_shard(buffer, shard, os.path.join(output_dir, name), preamble if i == 0 else 0)
+                manifest.append([name, len(shard), sum(compound.peaks for compound in shard), written])
+        finally:
+            close_buffer(buffer)
+    return manifest
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Splits a SIRIUS .ms file into shards of whole compounds")
+    parser.add_argument("IN", type=str, help="SIRIUS .ms file")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('-n', '--count', metavar='N', type=int, help="Number of compounds per shard")
+    mode.add_argument('-s', '--shards', metavar='N', type=int, help="Number of shards of consecutive compounds")
+    mode.add_argument('-b', '--balanced', metavar='N', type=int,
+                      help="Number of shards with about equal numbers of peaks")
+    parser.add_argument('-o', metavar='DIR', type=str, default='.', help="Output directory of the shards")
+    parser.add_argument('--manifest', metavar='FILE', type=str,
+                        help="Path of the manifest. Defaults to {} in the output directory".format(manifest_name))
+    args = parser.parse_args(argv[1:])
+
+    if not os.path.isfile(args.IN):
+        sys.stderr.write("ERROR: File: {} does not exist.\n".format(args.IN))
+        return 1
+    if min(value for value in (args.count, args.shards, args.balanced) if value is not None) < 1:
+        sys.stderr.write("ERROR: The number of compounds or shards has to be at least 1\n")
+        return 2
+
+    manifest = split(args.IN, args.o, args.count, args.shards, args.balanced)
+    manifest_path = args.manifest if args.manifest is not None else os.path.join(args.o, manifest_name)
+    with open(manifest_path, 'w') as f:
+        f.write('\t'.join(manifest_header) + '\n')
+        for row in manifest:
+            f.write('\t'.join(str(value) for value in row) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,12 +1,14 @@
 #!/bin/bash
-"""
-Created on Fri Aug 15
+#
+# Created on Fri Aug 15
+#
+# Split sirius internal .ms file after n compound entries
+# first argument = file
+# second argument = number of compounds counted for split
+#
+# The shards 0.ms, 1.ms, ... are written to the current directory by
+# split_ms.py, which offers further ways of splitting.
+#
+# @author: Oliver Alka
 
-Split sirius internal .ms file after n compound entries
-first argument = file 
-second argument = number of compounds counted for split
-
-@author: Oliver Alka 
-"""
-
-awk '/>compound/ { delim++ } { file = sprintf("%s.ms", int(delim / '$2')); print >> file; }' $1 
+exec python3 "$(dirname "$0")/split_ms.py" "$1" --count "$2" -o .
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the peak memory of download_public_urine_metabolome.py.
+
+Writes synthetic archives like the one of the Urine Metabolome Database,
+whose XML member has the given sizes, serves them over a local HTTP
+server and runs download_public_urine_metabolome.py on each of them, with
+ElementTree and, if it is installed, with lxml. Reports the run time and
+the peak resident set size of each run, which should not grow with the
+size of the input.
+
+Exits with 1 if a run fails or if the tables written with ElementTree and
+lxml differ.
+"""
+import argparse
+import functools
+import hashlib
+import http.server
+import importlib.util
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from xml.sax.saxutils import escape
+
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'download_public_urine_metabolome.py')
+member_name = 'urine_metabolites.xml'
+
+concentration_values = ['1.5 +/- 0.3', 'NA', '12.0', '> 12.0', '< 14', '<= 3.3', '<5.110e-05', '7 (3-11)', '']
+
+size_units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+def parse_size(text):
+    """
+    Parses a size like 100M or 5G into bytes.
+    """
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in size_units else ''
+    return int(float(text[:len(text) - len(unit)]) * size_units[unit])
+
+
+def generate_metabolites(rng):
+    """
+    Generates the XML of one metabolite after the other, with a long
+    description and a few normal and abnormal concentrations.
+    """
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 9))) for _ in range(5000)]
+    i = 0
+    while True:
+        parts = ['<metabolite>\n<version>4.0</version>\n<creation_date>2005-11-16</creation_date>\n'
+                 '<update_date>2020-0{}-01</update_date>\n<accession>HMDB{:07d}</accession>\n'
+                 '<secondary_accessions><accession>HMDB{:05d}</accession></secondary_accessions>\n'
+                 '<name>Metabolite {}</name>\n<chemical_formula>C{}H{}O</chemical_formula>\n'
+                 '<average_molecular_weight>{:f}</average_molecular_weight>\n<smiles>CC(O)=O</smiles>\n'
+                 '<inchikey>KEY{}</inchikey>\n'.format(1 + i % 9, i, i, i, i % 20, i % 30, rng.uniform(50, 900), i),
+                 '<description>', ' '.join(rng.choices(words, k=150)), '</description>\n',
+                 '<normal_concentrations>\n']
+        for _ in range(rng.randint(0, 4)):
+            parts.append('<concentration><biofluid>{}</biofluid><concentration_value>{}</concentration_value>'
+                         '<concentration_units>umol/mmol creatinine</concentration_units>'
+                         '<subject_age>Adult (&gt;18 years old)</subject_age><subject_sex>Both</subject_sex>'
+                         '<subject_condition>Normal</subject_condition></concentration>\n'.format(
+                             rng.choice(['Urine', 'Blood']), escape(rng.choice(concentration_values))))
+        parts.append('</normal_concentrations>\n<abnormal_concentrations>\n')
+        for _ in range(rng.randint(0, 2)):
+            parts.append('<concentration><biofluid>Urine</biofluid><concentration_value>{}</concentration_value>'
+                         '<patient_age>Children</patient_age><patient_sex>Male</patient_sex>'
+                         '<patient_condition>Disease &amp; more</patient_condition></concentration>\n'.format(
+                             escape(rng.choice(concentration_values[:-1]))))
+        parts.append('</abnormal_concentrations>\n</metabolite>\n')
+        yield ''.join(parts).encode('utf-8')
+        i += 1
+
+
+def write_archive(path, xml_size, seed):
+    """
+    Writes the zip archive with an XML member of about xml_size bytes.
+    Returns the number of metabolites.
+    """
+    rng = random.Random(seed)
+    n_metabolites = 0
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        with archive.open(member_name, 'w', force_zip64=True) as member:
+            written = member.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<hmdb xmlns="http://www.hmdb.ca">\n')
+            for metabolite in generate_metabolites(rng):
+                if written >= xml_size:
+                    break
+                written += member.write(metabolite)
+                n_metabolites += 1
+            member.write(b'</hmdb>\n')
+    return n_metabolites
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def run_script(args):
+    """
+    Runs the script and returns its run time and peak resident set size in
+    bytes. The child is waited for by wait4, which reports the resource
+    usage of this child alone.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, script] + args, stdout=subprocess.DEVNULL)
+    (_, status, usage) = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    # The status is already collected
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return (seconds, usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024))
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, 1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks the peak memory of download_public_urine_metabolome.py")
+    parser.add_argument("--sizes", metavar="SIZE", type=str, nargs='+', default=['100M', '1G', '5G'],
+                        help="Sizes of the XML member of the synthetic archives, like 100M or 5G")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--keep", metavar="DIR", type=str,
+                        help="Write the inputs to DIR and keep them instead of using a temporary directory")
+    args = parser.parse_args(argv[1:])
+
+    parsers = [('ElementTree', ['--no-lxml'])]
+    if importlib.util.find_spec('lxml') is not None:
+        parsers.append(('lxml', []))
+
+    directory = args.keep or tempfile.mkdtemp(prefix='benchmark_urine_')
+    os.makedirs(directory, exist_ok=True)
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    failed = False
+    try:
+        sys.stdout.write("{:>10s} {:>8s} {:>12s} {:>10s} {:>10s}\n".format(
+            'XML size', 'zip', 'parser', 'time', 'peak RSS'))
+        for size in args.sizes:
+            archive = 'urine_{}.zip'.format(size)
+            write_archive(os.path.join(directory, archive), parse_size(size), args.seed)
+            url = 'http://127.0.0.1:{}/{}'.format(server.server_address[1], archive)
+            digests = set()
+            for (name, options) in parsers:
+                output = os.path.join(directory, 'out_{}_{}'.format(size, name))
+                try:
+                    (seconds, peak) = run_script(['-o', output, '--removetarget', '--url', url] + options)
+                except subprocess.CalledProcessError as e:
+                    sys.stdout.write("{:>10s} {:>12s} FAILED with {}\n".format(size, name, e.returncode))
+                    failed = True
+                    continue
+                digests.add(file_digest(os.path.join(output, 'urine_metabolites.csv')))
+                sys.stdout.write("{:>10s} {:>6d} MB {:>12s} {:>8.1f} s {:>7d} MB\n".format(
+                    size, os.path.getsize(os.path.join(directory, archive)) >> 20, name, seconds, peak >> 20))
+                shutil.rmtree(output)
+            if len(digests) > 1:
+                sys.stdout.write("{:>10s} tables of the parsers DIFFER\n".format(size))
+                failed = True
+            if args.keep is None:
+                os.remove(os.path.join(directory, archive))
+    finally:
+        server.shutdown()
+        server.server_close()
+        if args.keep is None:
+            shutil.rmtree(directory)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
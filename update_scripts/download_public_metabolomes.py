@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Downloads the metabolites of several biofluid metabolome databases of the
+HMDB and writes their concentrations as one partitioned Parquet dataset.
+
+Each source is exported by its own worker process, which streams the
+download, parses the XML member of the archive and writes the rows in
+batches, as download_public_urine_metabolome.py does for the CSV table.
+The sources are processed concurrently, so refreshing all of them takes
+about as long as the slowest one. The dataset has one directory per
+source in the Hive layout (source=serum/part-0.parquet), with the columns
+of the CSV table converted into typed columns.
+"""
+import sys
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import functools
+import os
+import shutil
+import tempfile
+import urllib.parse
+
+import download_public_urine_metabolome as metabolome
+
+
+default_sources = collections.OrderedDict([
+    ('urine', metabolome.default_url),
+    ('serum', 'https://hmdb.ca/system/downloads/current/serum_metabolites.zip'),
+    ('csf', 'https://hmdb.ca/system/downloads/current/csf_metabolites.zip'),
+    ('saliva', 'https://hmdb.ca/system/downloads/current/saliva_metabolites.zip'),
+    ('feces', 'https://hmdb.ca/system/downloads/current/feces_metabolites.zip')
+])
+
+partition_column = 'source'
+
+# Rows converted and written to the Parquet file at once
+batch_size = 1 << 16
+
+float_columns = {'average_molecular_weight', 'monisotopic_molecular_weight',
+                 metabolome.name_concentration_lower, metabolome.name_concentration_middle,
+                 metabolome.name_concentration_upper}
+date_columns = {'creation_date', 'update_date'}
+bool_columns = {'is_normal_concentration'}
+
+# Suffix of the dates in the databases, which are all in UTC
+utc_suffix = ' UTC'
+
+
+def parse_source(spec):
+    """
+    Returns (name, url) of a source given as NAME=URL or as the name of one
+    of the default_sources.
+    """
+    if '=' in spec:
+        (name, url) = spec.split('=', 1)
+        return (name, url)
+    if spec not in default_sources:
+        raise ValueError("Unknown source {}, expected one of {} or NAME=URL".format(
+            spec, ', '.join(default_sources)))
+    return (spec, default_sources[spec])
+
+
+def member_of(url):
+    """
+    Name of the XML file within the archive of the URL, which is named like
+    the archive (serum_metabolites.zip contains serum_metabolites.xml).
+    """
+    name = os.path.basename(urllib.parse.urlparse(url).path)
+    return os.path.splitext(name)[0] + '.xml'
+
+
+def to_float(value):
+    return None if value == metabolome.na_string else float(value)
+
+
+@functools.lru_cache(maxsize=1 << 12)
+def to_date(value):
+    """
+    Dates are shared by all rows of a metabolite, so the parsed dates are memoized.
+    """
+    if value == metabolome.na_string:
+        return None
+    if value.endswith(utc_suffix):
+        value = value[:-len(utc_suffix)]
+    try:
+        return datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        raise ValueError('Date could not be parsed: ' + value)
+
+
+def to_string(value):
+    return None if value == metabolome.na_string else value
+
+
+def column_types(pa):
+    """
+    Returns the list of (column, arrow type, conversion of the CSV value).
+    """
+    types = []
+    for column in metabolome.header:
+        if column in float_columns:
+            types.append((column, pa.float64(), to_float))
+        elif column in date_columns:
+            types.append((column, pa.timestamp('s', tz='UTC'), to_date))
+        elif column in bool_columns:
+            types.append((column, pa.bool_(), bool))
+        else:
+            types.append((column, pa.string(), to_string))
+    return types
+
+
+def write_batch(pa, writer, types, rows):
+    columns = [pa.array([convert(row[i]) for row in rows], type=arrow_type)
+               for (i, (_, arrow_type, convert)) in enumerate(types)]
+    writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=writer.schema))
+
+
+def export_source(name, url, output_dir, retries, use_lxml):
+    """
+    Writes the concentrations of the source into its partition of the
+    dataset. Runs in a worker process. Returns the number of rows and the
+    dictionary of the concentration values which could not be parsed.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = column_types(pa)
+    schema = pa.schema([(column, arrow_type) for (column, arrow_type, _) in types])
+    partition = os.path.join(output_dir, '{}={}'.format(partition_column, name))
+    os.makedirs(partition)
+    unparsed = collections.OrderedDict()
+    events = metabolome.generate_xml_events(
+        metabolome.generate_zip_member(metabolome.generate_download(url, retries), member_of(url)),
+        tags=metabolome.relevant_tags, use_lxml=use_lxml)
+
+    # The file only appears once complete
+    (fd, tmp) = tempfile.mkstemp(prefix='.', suffix='.parquet', dir=partition)
+    os.close(fd)
+    n_rows = 0
+    try:
+        with pq.ParquetWriter(tmp, schema) as writer:
+            rows = []
+            for row in metabolome.generate_rows(events, unparsed):
+                rows.append(row)
+                if len(rows) == batch_size:
+                    write_batch(pa, writer, types, rows)
+                    n_rows += len(rows)
+                    rows = []
+            if rows or not n_rows:
+                write_batch(pa, writer, types, rows)
+                n_rows += len(rows)
+        os.replace(tmp, os.path.join(partition, 'part-0.parquet'))
+    except BaseException:
+        shutil.rmtree(partition)
+        raise
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return (n_rows, unparsed)
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description="Exports the concentrations of HMDB biofluid metabolomes "
+                                                 "into a Parquet dataset partitioned by source")
+    parser.add_argument('SOURCE', nargs='*', default=list(default_sources),
+                        help="Sources to export, either one of {} or NAME=URL. Defaults to all".format(
+                            ', '.join(default_sources)))
+    parser.add_argument('-o', type=str, required=True, help="Output directory of the dataset")
+    parser.add_argument('--removetarget', action='store_true')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        help="Number of worker processes. Defaults to one per source")
+    parser.add_argument('--retries', type=int, default=metabolome.default_retries)
+    parser.add_argument('--no-lxml', dest='no_lxml', action='store_true',
+                        help="Parse with ElementTree even if lxml is installed")
+    parser.add_argument('--report-unparsed', dest='report_unparsed', metavar='FILE', type=str,
+                        help="Write the concentration values which could not be parsed into this file")
+    parser.add_argument('--strict', action='store_true',
+                        help="Exit with an error after writing the dataset if any concentration value "
+                             "could not be parsed")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        sources = collections.OrderedDict(parse_source(spec) for spec in args.SOURCE)
+    except ValueError as e:
+        sys.stderr.write("ERROR: {}\n".format(e))
+        sys.exit(2)
+    if args.jobs is not None and args.jobs < 1:
+        sys.stderr.write("ERROR: The number of jobs has to be at least 1\n")
+        sys.exit(2)
+
+    if os.path.exists(args.o):
+        if args.removetarget:
+            shutil.rmtree(args.o)
+        else:
+            print("FATAL: Target already exists")
+            sys.exit(1)
+    os.mkdir(args.o)
+
+    unparsed = collections.OrderedDict()
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs or len(sources)) as pool:
+        futures = collections.OrderedDict(
+            (name, pool.submit(export_source, name, url, args.o, args.retries, not args.no_lxml))
+            for (name, url) in sources.items())
+        for (name, future) in futures.items():
+            try:
+                (n_rows, source_unparsed) = future.result()
+            except Exception as e:
+                sys.stderr.write("ERROR: Export of {} failed: {}\n".format(name, e))
+                failed.append(name)
+                continue
+            sys.stderr.write("{}: {} rows\n".format(name, n_rows))
+            for (value, (count, accession)) in source_unparsed.items():
+                unparsed.setdefault(value, [0, accession])
+                unparsed[value][0] += count
+
+    if unparsed:
+        if args.report_unparsed is not None:
+            metabolome.write_unparsed_report(unparsed, args.report_unparsed)
+        sys.stderr.write("WARNING: {} concentration values could not be parsed, in {} rows\n".format(
+            len(unparsed), sum(count for (count, _) in unparsed.values())))
+    if failed:
+        sys.exit(3)
+    if unparsed and args.strict:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
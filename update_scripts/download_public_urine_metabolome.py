@@ -1,205 +1,692 @@
 #!/usr/bin/env python3
+"""
+Downloads the metabolites of the Urine Metabolome Database and writes their
+concentrations as CSV table.
+
+The archive is streamed: the download is read in chunks, the XML member of
+the zip archive is decompressed on the fly and fed into a pull parser, and
+the rows are written as soon as a metabolite has been parsed. Neither the
+archive nor the XML file are written to disk. If the connection breaks,
+the download is resumed with an HTTP Range request. Each metabolite is
+cleared and detached from the document once its rows have been written, so
+only one metabolite is held in memory at a time. lxml is used for parsing
+if it is installed, which also skips elements irrelevant for the table.
+
+Next to the table, an index records the version and update date of each
+metabolite with the location of its rows, and the validators (ETag,
+Last-Modified) of the downloaded archive. With --incremental, an existing
+export is updated: the download is skipped if a HEAD request shows that
+the archive is unchanged, and otherwise only the rows of metabolites with
+a new version or update date are formatted again, while those of all
+other metabolites are copied from the previous table.
+"""
 import sys
 import argparse
+import collections
+import functools
+import io
 import os
 import shutil
+import sqlite3
+import struct
+import tempfile
+import time
 import requests
-import zipfile
+import zlib
 import xml.etree.ElementTree as ET
 import csv
 import re
 
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+
+default_url = 'http://www.urinemetabolome.ca/system/downloads/current/urine_metabolites.zip'
+member_name = 'urine_metabolites.xml'
+
+# Bytes requested from the download and from the decompressor at once
+chunk_size = 1 << 20
+
+# Attempts to resume a broken download without any progress in between
+default_retries = 5
+backoff = 1.0  # s, doubled for each attempt
+timeout = 60  # s
+
+na_string = 'NA'
+
+# Suffix of the index of the table
+index_suffix = '.idx'
+accession_index = 'metabolites_accession'
+
+# Index entries inserted at once while the table is written
+insert_batch_size = 10000
+
+local_header_signature = b'PK\x03\x04'
+data_descriptor_signature = b'PK\x07\x08'
+zip64_placeholder = 0xFFFFFFFF
+
+
+def generate_download(url, retries=default_retries):
+    """
+    Generates the content of the URL in chunks. A broken download is resumed
+    from the last received byte with a Range request. If the server ignores
+    the range, the bytes already received are skipped.
+    """
+    offset = 0
+    failures = 0
+    while True:
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=timeout) as r:
+                r.raise_for_status()
+                skip = 0
+                if offset and (r.status_code != 206 or
+                               not r.headers.get('Content-Range', '').startswith('bytes {}-'.format(offset))):
+                    skip = offset
+                for chunk in r.iter_content(chunk_size):
+                    if skip:
+                        (chunk, skip) = (chunk[skip:], max(0, skip - len(chunk)))
+                    if chunk:
+                        offset += len(chunk)
+                        failures = 0
+                        yield chunk
+                return
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            failures += 1
+            if failures > retries:
+                raise
+            sys.stderr.write("WARNING: Download interrupted at byte {} ({}), resuming\n".format(offset, e))
+            time.sleep(backoff * 2 ** (failures - 1))
+
+
+class StreamReader(object):
+    """
+    Reads exact numbers of bytes from an iterator of chunks.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, n):
+        while len(self.buffer) < n:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                raise EOFError('Unexpected end of the zip archive')
+            self.buffer += chunk
+        (data, self.buffer) = (self.buffer[:n], self.buffer[n:])
+        return data
+
+    def read_chunk(self):
+        """
+        The buffered bytes or the next chunk, b'' at the end of the stream.
+        """
+        if self.buffer:
+            (data, self.buffer) = (self.buffer, b'')
+            return data
+        return next(self.chunks, b'')
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+
+def generate_member_data(reader, method, size):
+    """
+    Generates the decompressed data of the zip member at the position of the
+    reader. size is the compressed size, None if it is not known in advance.
+    """
+    if method == 0:
+        if size is None:
+            raise ValueError('Stored zip members of unknown size are not supported')
+        while size:
+            chunk = reader.read_chunk()
+            if not chunk:
+                raise EOFError('Unexpected end of the zip archive')
+            if len(chunk) > size:
+                reader.unread(chunk[size:])
+                chunk = chunk[:size]
+            size -= len(chunk)
+            yield chunk
+    elif method == 8:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not decompressor.eof:
+            chunk = reader.read_chunk()
+            if not chunk:
+                raise EOFError('Unexpected end of the zip archive')
+            # Bounds the output of highly compressed chunks. Once the end of
+            # the member is reached, the rest of the chunk is in unused_data
+            while chunk and not decompressor.eof:
+                data = decompressor.decompress(chunk, chunk_size)
+                if data:
+                    yield data
+                chunk = decompressor.unconsumed_tail
+        reader.unread(decompressor.unused_data)
+    else:
+        raise ValueError('Unsupported compression method {} in zip archive'.format(method))
+
+
+def zip64_sizes(extra, size, uncompressed_size):
+    """
+    The compressed and uncompressed sizes of a member and whether it is a
+    ZIP64 member. The ZIP64 extra field holds, in this order, the sizes for
+    which the header holds the placeholder 0xFFFFFFFF.
+    """
+    while len(extra) >= 4:
+        (header_id, length) = struct.unpack('<HH', extra[:4])
+        if header_id == 0x0001:
+            values = extra[4:4 + length]
+            if uncompressed_size == zip64_placeholder and len(values) >= 8:
+                (uncompressed_size, values) = (struct.unpack('<Q', values[:8])[0], values[8:])
+            if size == zip64_placeholder and len(values) >= 8:
+                size = struct.unpack('<Q', values[:8])[0]
+            return (size, uncompressed_size, True)
+        extra = extra[4 + length:]
+    return (size, uncompressed_size, False)
+
+
+def generate_zip_member(chunks, name):
+    """
+    Generates the decompressed data of the member with the given file name
+    of the zip archive streamed in chunks. The local file headers are read
+    in order, so the central directory at the end of the archive is not needed.
+    """
+    reader = StreamReader(chunks)
+    while True:
+        if reader.read(4) != local_header_signature:
+            raise ValueError('Zip archive does not contain {}'.format(name))
+        (flags, method, crc, size, uncompressed_size, name_length, extra_length) = struct.unpack(
+            '<2xHH4xIIIHH', reader.read(26))
+        member = reader.read(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+        (size, _, is_zip64) = zip64_sizes(reader.read(extra_length), size, uncompressed_size)
+        has_descriptor = flags & 0x08
+        data = generate_member_data(reader, method, None if has_descriptor else size)
+        if os.path.basename(member) != name:
+            for _ in data:
+                pass
+        else:
+            checksum = 0
+            for chunk in data:
+                checksum = zlib.crc32(chunk, checksum)
+                yield chunk
+        if has_descriptor:
+            descriptor = reader.read(4)
+            if descriptor == data_descriptor_signature:
+                descriptor = reader.read(4)
+            crc = struct.unpack('<I', descriptor)[0]
+            # The sizes of ZIP64 members have 8 bytes each
+            reader.read(16 if is_zip64 else 8)
+        if os.path.basename(member) == name:
+            if checksum != crc:
+                raise ValueError('CRC of {} within the zip archive does not match'.format(name))
+            return
+
+
+def generate_xml_events(chunks, events=('start', 'end'), tags=None, use_lxml=True):
+    """
+    Feeds the chunks into a pull parser and generates its (event, element) tuples.
+    If lxml is used and tags is given, only the events of elements with these
+    names (in any namespace) are generated, otherwise those of all elements.
+    """
+    if use_lxml and lxml_etree is not None:
+        tags = None if tags is None else ['{*}' + tag for tag in tags]
+        parser = lxml_etree.XMLPullParser(events=events, tag=tags)
+    else:
+        parser = ET.XMLPullParser(events=events)
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def handle_uncertainty(mean, sd):
+    mean = float(mean)
+    sd = float(sd)
+    return (str(mean - sd), str(mean), str(mean + sd))
+
+
+def handle_not_available():
+    return (na_string, na_string, na_string)
+
+
+def handle_regular(mean):
+    mean = float(mean)
+    return (mean, mean, mean)
+
+
+def handle_lower_bound(lower):
+    return (lower, na_string, na_string)
+
+
+def handle_upper_bound(upper):
+    return (na_string, na_string, upper)
+
+
+def handle_range(lower, upper):
+    return (lower, na_string, upper)
+
+
+number = r'[0-9]+(?:\.[0-9]+)?'
+
+# Formats of the concentration values with the handler computing (lower,
+# middle, upper) from the groups of the pattern. The alternatives are tried
+# in this order, so the prefix pattern 'regular' has to come last.
+concentration_formats = [
+    ('uncertainty', r'({0})\s*\+/-\s*({0})$', handle_uncertainty),               # 1.5 +/- 0.3
+    ('not_available', r'NA$', handle_not_available),
+    ('lower_bound_exclusive', r'>\s*({0})$', handle_lower_bound),                # >12.0
+    ('upper_bound_exclusive', r'<\s*({0})$', handle_upper_bound),                # < 14
+    ('upper_bound_exclusive_range', r'<\s*({0})\s*(?:-|–)\s*({0})$', handle_range),  # < 2.0 - 5.0
+    ('upper_bound_inclusive', r'<=\s*({0})$', handle_upper_bound),               # <= 3.3
+    ('upper_bound_exclusive_scientific', r'<({0}e-?[0-9]+)$', handle_upper_bound),  # <5.110e-05
+    ('regular', r'({0})', handle_regular)                                        # 12.0, 7 (3-11)
+]
+
+re_concentration = re.compile('|'.join('(?P<{}>{})'.format(name, pattern.format(number))
+                                       for (name, pattern, _) in concentration_formats))
+
+# Index of the group of each format within re_concentration, the number of
+# groups of its pattern and its handler
+concentration_handlers = {
+    name: (re_concentration.groupindex[name], re.compile(pattern.format(number)).groups, handler)
+    for (name, pattern, handler) in concentration_formats
+}
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def parse_concentration(value):
+    """
+    Returns (lower, middle, upper) of the concentration value, None if the
+    value is in none of the concentration_formats. Concentration values are
+    highly repetitive, so the results are memoized.
+    """
+    m = re_concentration.match(value)
+    if m is None:
+        return None
+    # The group of the format encloses the groups of its pattern, so it is closed last
+    (index, n_groups, handler) = concentration_handlers[m.lastgroup]
+    return handler(*[m.group(i) for i in range(index + 1, index + 1 + n_groups)])
+
+
+def document_root(elem):
+    """
+    Root of the document of the first parsed element. ElementTree always
+    reports the start of the root element first.
+    """
+    return elem.getroottree().getroot() if hasattr(elem, 'getroottree') else elem
+
+
+name_concentration_middle = 'concentration_middle'
+name_concentration_lower = 'concentration_lower'
+name_concentration_upper = 'concentration_upper'
+
+attributes_metabolites = [
+    'version',
+    'creation_date',
+    'update_date',
+    'accession',
+    'chemical_formula',
+    'average_molecular_weight',
+    'monisotopic_molecular_weight',
+    'iupac_name',
+    'traditional_iupac',
+    'cas_registry_number',
+    'smiles',
+    'inchi',
+    'inchikey'
+]
+attributes_concentration = [
+    'biofluid',
+    'concentration_value',
+    name_concentration_lower,
+    name_concentration_middle,
+    name_concentration_upper,
+    'concentration_units',
+    'subject_age',
+    'subject_sex',
+    'subject_condition'
+]
+
+# Columns of the rows of generate_rows
+header = attributes_metabolites + attributes_concentration + ['is_normal_concentration']
+
+# Elements relevant for the table, including those renamed by normalize
+relevant_tags = ['metabolite', 'concentration', 'normal_concentrations', 'abnormal_concentrations',
+                 'patient_age', 'patient_sex', 'patient_condition'] + \
+    attributes_metabolites + attributes_concentration
 
-def main(argv):
 
-    na_string = 'NA'
-    name_concentration_middle = 'concentration_middle'
-    name_concentration_lower = 'concentration_lower'
-    name_concentration_upper = 'concentration_upper'
-
-    def handle_uncertainty(m):
-        mean = float(m.group(1))
-        sd = float(m.group(2))
-        return (str(mean - sd), str(mean), str(mean + sd))
-
-    def handle_regular(m):
-        mean = float(m.group(1))
-        return (mean, mean, mean)
-
-    def handle_lower_bound(m):
-        return (m.group(1), 'NA', 'NA')
-
-    def handle_upper_bound(m):
-        return ('NA', 'NA', m.group(1))
-
-    def handle_upper_bound_exclusive_range(m):
-        return (m.group(1), 'NA', m.group(2))
-
-    re_handler = {
-        'uncertainty':
-        (re.compile(r'^([0-9]+(?:\.[0-9]+)?)\s*\+/-\s*([0-9]+(?:\.[0-9]+)?)$'),
-         handle_uncertainty),
-        'not_available':
-        (re.compile(r'^NA$'),
-         lambda x: (na_string, na_string, na_string)),
-        'regular':
-        (re.compile(r'^([0-9]+(?:\.[0-9]+)?)'),
-         handle_regular),
-        'lower_bound_exclusive':
-        (re.compile(r'^>\s*([0-9]+(?:\.[0-9]+)?)$'),
-         handle_lower_bound),  # >12.0
-        'upper_bound_exclusive':
-        (re.compile(r'^<\s*([0-9]+(?:\.[0-9]+)?)$'),
-         handle_upper_bound),  # < 14
-        'upper_bound_exclusive_range':
-        (re.compile(r'^<\s*([0-9]+(?:\.[0-9]+)?)\s*(?:-|–)\s*([0-9]+(?:\.[0-9]+)?)$'),
-         handle_upper_bound_exclusive_range),
-        'upper_bound_inclusive':
-        (re.compile(r'^<=\s*([0-9]+(?:\.[0-9]+)?)$'),
-         handle_upper_bound),
-        'upper_bound_exclusive_scientific':
-        (re.compile(r'^<([0-9]+(?:\.[0-9]+)?e-?[0-9]+)$'),
-         handle_upper_bound)   # <5.110e-05
-    }
+def get_value(value):
+    if value is None:
+        return 'NA'
+    value = value.strip()
+    if not value:
+        return 'NA'
+    return value
+
+
+def normalize(tag):
+    tag = tag.replace(r'{http://www.hmdb.ca}', '')
+
+    if tag == 'patient_age':
+        return 'subject_age'
+    if tag == 'patient_sex':
+        return 'subject_sex'
+    if tag == 'patient_condition':
+        return 'subject_condition'
+    return tag
+
+
+def generate_metabolites(events, unparsed=None):
+    """
+    Generates for each metabolite the dictionary of its attributes and the
+    list of the rows (in the order of header) of all its concentrations,
+    from the events of generate_xml_events. Concentration values which
+    cannot be parsed raise a ValueError, unless unparsed is a dictionary,
+    which then collects their count and first accession.
+    """
+    root = None
+
+    metabolite = {}
+    normal_concentrations = []
+    abnormal_concentrations = []
+
+    concentration = {}
+    concentration_abnormal = False
+
+    for (event, elem) in events:
+        if root is None:
+            root = document_root(elem)
+        tag = normalize(elem.tag)
+        if event == 'start':
+            if tag == 'normal_concentrations':
+                concentration_abnormal = False
+            elif tag == 'abnormal_concentrations':
+                concentration_abnormal = True
+
+        elif event == 'end':
+            if tag == 'metabolite':
+
+                # Commit concentration with all metabolites and reset
+                row_metabolite = [metabolite[x] if x in metabolite else 'NA' for x in attributes_metabolites]
+                rows = []
+                for conc in normal_concentrations:
+                    row_concentration = [conc[x] if x in conc else 'NA' for x in attributes_concentration]
+                    row_concentration.append(True)
+                    rows.append(row_metabolite + row_concentration)
+
+                for conc in abnormal_concentrations:
+                    row_concentration = [conc[x] if x in conc else 'NA' for x in attributes_concentration]
+                    row_concentration.append(False)
+                    rows.append(row_metabolite + row_concentration)
+                yield (metabolite, rows)
+
+                metabolite = {}
+                concentration = {}
+                normal_concentrations = []
+                abnormal_concentrations = []
+
+                # Drops the subtree of the metabolite and detaches it from the document
+                elem.clear()
+                del root[:]
+
+            elif tag == 'concentration':
+
+                if 'concentration_value' in concentration:
+                    concentration_value = concentration['concentration_value']
+                    bounds = parse_concentration(concentration_value)
+                    if bounds is None:
+                        if unparsed is None:
+                            raise ValueError('Concentration could not be parsed: ' + concentration_value)
+                        unparsed.setdefault(concentration_value, [0, metabolite.get('accession', na_string)])
+                        unparsed[concentration_value][0] += 1
+                        bounds = handle_not_available()
+                    (lower, mean, upper) = bounds
+                    concentration[name_concentration_lower] = lower
+                    concentration[name_concentration_middle] = mean
+                    concentration[name_concentration_upper] = upper
+
+                if concentration_abnormal:
+                    abnormal_concentrations.append(concentration)
+                else:
+                    normal_concentrations.append(concentration)
+                concentration = {}
+            else:
+                if tag in attributes_metabolites:
+                    metabolite[tag] = get_value(elem.text)
+                elif tag in attributes_concentration:
+                    concentration[tag] = get_value(elem.text)
+
+
+def generate_rows(events, unparsed=None):
+    """
+    Generates the rows of all metabolites of generate_metabolites.
+    """
+    for (_, rows) in generate_metabolites(events, unparsed):
+        for row in rows:
+            yield row
+
+
+def head_validators(url):
+    """
+    Returns the ETag, Last-Modified and Content-Length of the URL as
+    reported by a HEAD request, None if they cannot identify the version of
+    the file or the request fails.
+    """
+    try:
+        r = requests.head(url, headers={'Accept-Encoding': 'identity'}, allow_redirects=True, timeout=timeout)
+        r.raise_for_status()
+    except requests.RequestException:
+        return None
+    validators = (r.headers.get('ETag'), r.headers.get('Last-Modified'), r.headers.get('Content-Length'))
+    if validators[0] is None and (validators[1] is None or validators[2] is None):
+        return None
+    return validators
+
+
+def table_stamp(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def read_export_index(concentration_file):
+    """
+    Returns the validators of the archive of the previous export and the
+    read-only connection to its index, from which previous_entry looks up
+    the rows of each metabolite. Returns None if there is no index or the
+    table has changed since.
+    """
+    path = concentration_file + index_suffix
+    if not os.path.isfile(path) or not os.path.isfile(concentration_file):
+        return None
+    try:
+        connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    except sqlite3.Error:
+        return None
+    try:
+        meta = connection.execute('SELECT size, mtime, etag, last_modified, content_length FROM meta').fetchone()
+        # Indexes without the index on accession are rebuilt
+        indexed = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                                     (accession_index,)).fetchone()
+    except sqlite3.Error:
+        connection.close()
+        return None
+    if meta is None or indexed is None or tuple(meta[:2]) != table_stamp(concentration_file):
+        connection.close()
+        return None
+    validators = tuple(meta[2:]) if any(value is not None for value in meta[2:]) else None
+    return (validators, connection)
+
+
+def previous_entry(connection, accession):
+    """
+    Returns (version, update_date, offset, length) of the rows of the
+    accession in the previous table, None if it is not within the table or
+    occurs more than once.
+    """
+    entries = connection.execute('SELECT version, update_date, offset, length FROM metabolites '
+                                 'WHERE accession = ? LIMIT 2', (accession,)).fetchall()
+    return entries[0] if len(entries) == 1 else None
+
+
+def create_export_index(concentration_file):
+    """
+    Creates the index of the table as temporary file next to it. Returns the
+    connection, into which the (accession, version, update_date, offset,
+    length) entries are inserted while the table is written, and the path
+    of the temporary file, see finish_export_index.
+    """
+    directory = os.path.dirname(os.path.abspath(concentration_file))
+    (fd, tmp_index) = tempfile.mkstemp(prefix='.', suffix=index_suffix, dir=directory)
+    os.close(fd)
+    try:
+        connection = sqlite3.connect(tmp_index)
+        connection.executescript('''
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE meta (size INTEGER, mtime INTEGER, etag TEXT, last_modified TEXT, content_length TEXT);
+            CREATE TABLE metabolites (accession TEXT, version TEXT, update_date TEXT, offset INTEGER,
+                                      length INTEGER);
+        ''')
+    except BaseException:
+        os.remove(tmp_index)
+        raise
+    return (connection, tmp_index)
+
+
+def finish_export_index(connection, tmp_index, concentration_file, validators):
+    """
+    Records the version of the written table and the validators of the
+    archive in the index and moves it into place.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    connection.execute('CREATE INDEX {} ON metabolites (accession)'.format(accession_index))
+    connection.execute('INSERT INTO meta VALUES (?, ?, ?, ?, ?)',
+                       table_stamp(concentration_file) + tuple(validators or (None, None, None)))
+    connection.commit()
+    connection.close()
+
+    # mkstemp creates files which are only accessible by the owner
+    os.chmod(tmp_index, 0o666 & ~umask)
+    os.replace(tmp_index, concentration_file + index_suffix)
+
+
+def write_unparsed_report(unparsed, path):
+    with open(path, 'w') as report:
+        report_csvwriter = csv.writer(report, delimiter='\t')
+        report_csvwriter.writerow(['concentration_value', 'count', 'first_accession'])
+        for (value, (count, accession)) in unparsed.items():
+            report_csvwriter.writerow([value, count, accession])
+
+
+def main(argv):
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-o', type=str, required=True)
     parser.add_argument('--removetarget', action='store_true')
+    parser.add_argument('--url', type=str, default=default_url)
+    parser.add_argument('--retries', type=int, default=default_retries)
+    parser.add_argument('--no-lxml', dest='no_lxml', action='store_true',
+                        help="Parse with ElementTree even if lxml is installed")
+    parser.add_argument('--report-unparsed', dest='report_unparsed', metavar='FILE', type=str,
+                        help="Collect the concentration values which cannot be parsed into this file "
+                             "instead of stopping at the first one")
+    parser.add_argument('--strict', action='store_true',
+                        help="Collect the concentration values which cannot be parsed and exit with an "
+                             "error after writing the table if there are any")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Update an existing export, only rewriting the metabolites which have changed")
     args = parser.parse_args(argv[1:])
 
-    if os.path.exists(args.o):
+    if os.path.exists(args.o) and not args.incremental:
         if args.removetarget:
             shutil.rmtree(args.o)
         else:
             print("FATAL: Target already exists")
             sys.exit(1)
-    os.mkdir(args.o)
-    url = 'http://www.urinemetabolome.ca/system/downloads/current/urine_metabolites.zip'
-    r = requests.get(url)
-    result_file = os.path.join(args.o, 'urine_metabolites.zip')
-    with open(result_file, 'wb') as f:
-        f.write(r.content)
-    with zipfile.ZipFile(result_file, "r") as zip_ref:
-        zip_ref.extractall(args.o)
-    os.remove(result_file)
-    result_file = os.path.join(args.o, 'urine_metabolites.xml')
+    os.makedirs(args.o, exist_ok=True)
     concentration_file = os.path.join(args.o, 'urine_metabolites.csv')
 
-    parser_it = ET.iterparse(result_file, events=['start', 'end'])
-
-    attributes_metabolites = [
-        'version',
-        'creation_date',
-        'update_date',
-        'accession',
-        'chemical_formula',
-        'average_molecular_weight',
-        'monisotopic_molecular_weight',
-        'iupac_name',
-        'traditional_iupac',
-        'cas_registry_number',
-        'smiles',
-        'inchi',
-        'inchikey'
-    ]
-    attributes_concentration = [
-        'biofluid',
-        'concentration_value',
-        name_concentration_lower,
-        name_concentration_middle,
-        name_concentration_upper,
-        'concentration_units',
-        'subject_age',
-        'subject_sex',
-        'subject_condition'
-    ]
-
-    def get_value(value):
-        if value is None:
-            return 'NA'
-        value = value.strip()
-        if not value:
-            return 'NA'
-        return value
-
-    def normalize(tag):
-        tag = tag.replace(r'{http://www.hmdb.ca}', '')
-
-        if tag == 'patient_age':
-            return 'subject_age'
-        if tag == 'patient_sex':
-            return 'subject_sex'
-        if tag == 'patient_condition':
-            return 'subject_condition'
-        return tag
+    previous = read_export_index(concentration_file) if args.incremental else None
+    validators = head_validators(args.url)
+    if previous is not None and validators is not None and previous[0] == validators:
+        previous[1].close()
+        sys.stderr.write("Download is unchanged since the last export\n")
+        return
+    previous_index = previous[1] if previous is not None else None
 
-    metabolite = {}
-    normal_concentrations = []
-    abnormal_concentrations = []
+    parser_it = generate_xml_events(generate_zip_member(generate_download(args.url, args.retries), member_name),
+                                    tags=relevant_tags, use_lxml=not args.no_lxml)
 
-    concentration = {}
-    concentration_abnormal = False
-
-    with open(concentration_file, 'w') as outfile:
-        outfile_csvwriter = csv.writer(outfile)
-        outfile_csvwriter.writerow(
-            attributes_metabolites + attributes_concentration +
-            ['is_normal_concentration'])
-        for (event, elem) in parser_it:
-            tag = normalize(elem.tag)
-            if event == 'start':
-                if tag == 'normal_concentrations':
-                    concentration_abnormal = False
-                elif tag == 'abnormal_concentrations':
-                    concentration_abnormal = True
-
-            elif event == 'end':
-                if tag == 'metabolite':
-
-                    # Commit concentration with all metabolites and reset
-                    row_metabolite = [metabolite[x] if x in metabolite else 'NA' for x in attributes_metabolites ]
-                    for conc in normal_concentrations:
-                        row_concentration = [ conc[x] if x in conc else 'NA' for x in attributes_concentration]
-                        row_concentration.append(True)
-                        outfile_csvwriter.writerow(row_metabolite + row_concentration)
-
-                    for conc in abnormal_concentrations:
-                        row_concentration = [conc[x] if x in conc else 'NA' for x in attributes_concentration]
-                        row_concentration.append(False)
-                        outfile_csvwriter.writerow(row_metabolite + row_concentration)
-
-                    metabolite = {}
-                    concentration = {}
-                    normal_concentrations = []
-                    abnormal_concentrations = []
-
-                elif tag == 'concentration':
-
-                    if 'concentration_value' in concentration:
-                        concentration_value = concentration['concentration_value']
-                        matched = False
-                        for (name, (regex, handler)) in re_handler.items():
-                            m = re.match(regex, concentration_value)
-                            if m:
-                                matched = True
-                                (lower, mean, upper) = handler(m)
-                                concentration[name_concentration_lower] = lower
-                                concentration[name_concentration_middle] = mean
-                                concentration[name_concentration_upper] = upper
-                                break
-                        if not matched:
-                            raise ValueError('Concentration could not be parsed: ' + concentration_value)
+    # Concentration values which could not be parsed, with their count and the first metabolite
+    collect_unparsed = args.strict or args.report_unparsed is not None
+    unparsed = collections.OrderedDict()
 
-                    if concentration_abnormal:
-                        abnormal_concentrations.append(concentration)
-                    else:
-                        normal_concentrations.append(concentration)
-                    concentration = {}
+    # The table is written to a temporary file, so the previous table can be copied from.
+    # The entries of the index are written along, so they are not held in memory.
+    umask = os.umask(0)
+    os.umask(umask)
+    (fd, tmp_table) = tempfile.mkstemp(prefix='.', suffix='.csv', dir=args.o)
+    (index_connection, tmp_index) = create_export_index(concentration_file)
+    entries = []
+    n_metabolites = 0
+    n_changed = 0
+    try:
+        with os.fdopen(fd, 'wb') as outfile, \
+                open(concentration_file if previous_index is not None else os.devnull, 'rb') as previous_table:
+            rows_buffer = io.StringIO()
+            outfile_csvwriter = csv.writer(rows_buffer)
+            outfile_csvwriter.writerow(header)
+            outfile.write(rows_buffer.getvalue().encode('utf-8'))
+            for (metabolite, rows) in generate_metabolites(parser_it, unparsed if collect_unparsed else None):
+                accession = metabolite.get('accession', na_string)
+                version = metabolite.get('version', na_string)
+                update_date = metabolite.get('update_date', na_string)
+                entry_previous = None if previous_index is None else previous_entry(previous_index, accession)
+                if entry_previous is not None and tuple(entry_previous[:2]) == (version, update_date):
+                    previous_table.seek(entry_previous[2])
+                    data = previous_table.read(entry_previous[3])
                 else:
-                    if tag in attributes_metabolites:
-                        metabolite[tag] = get_value(elem.text)
-                    elif tag in attributes_concentration:
-                        concentration[tag] = get_value(elem.text)
+                    rows_buffer.seek(0)
+                    rows_buffer.truncate()
+                    outfile_csvwriter.writerows(rows)
+                    data = rows_buffer.getvalue().encode('utf-8')
+                    n_changed += 1
+                entries.append((accession, version, update_date, outfile.tell(), len(data)))
+                if len(entries) == insert_batch_size:
+                    index_connection.executemany('INSERT INTO metabolites VALUES (?, ?, ?, ?, ?)', entries)
+                    entries = []
+                n_metabolites += 1
+                outfile.write(data)
+        index_connection.executemany('INSERT INTO metabolites VALUES (?, ?, ?, ?, ?)', entries)
+
+        # mkstemp creates files which are only accessible by the owner
+        os.chmod(tmp_table, 0o666 & ~umask)
+        os.replace(tmp_table, concentration_file)
+        finish_export_index(index_connection, tmp_index, concentration_file, validators)
+    finally:
+        if previous_index is not None:
+            previous_index.close()
+        index_connection.close()
+        for tmp in (tmp_table, tmp_index):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    if args.incremental:
+        sys.stderr.write("{} of {} metabolites changed since the last export\n".format(n_changed, n_metabolites))
+
+    if unparsed:
+        if args.report_unparsed is not None:
+            write_unparsed_report(unparsed, args.report_unparsed)
+        sys.stderr.write("WARNING: {} concentration values could not be parsed, in {} rows\n".format(
+            len(unparsed), sum(count for (count, _) in unparsed.values())))
+        if args.strict:
+            for value in unparsed:
+                sys.stderr.write("  {}\n".format(value))
+            sys.exit(1)
 
 
 if __name__ == '__main__':
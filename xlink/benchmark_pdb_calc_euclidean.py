@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of pdb_calc_euclidean.py on large synthetic inputs.
+
+Writes a PDB file with several MODEL records and alternate locations of
+some atoms and a distance CSV file with random pairs of its atoms, runs
+pdb_calc_euclidean.py on them with and without the coordinate cache, and
+checks that the output is byte-identical to the one of the original
+algorithm, which is included as reference: each ATOM record is compared
+with all pairs and the last occurrence of an atom wins.
+
+Exits with 1 if an output differs from the reference.
+"""
+import argparse
+import csv
+import io
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from structure_reader import record_atom_resid, record_atom_segid, record_atom_resname, record_atom_name, \
+    record_atom_x, record_atom_y, record_atom_z
+
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdb_calc_euclidean.py')
+
+atom_names = ['N', 'CA', 'C', 'O', 'CB', 'CG', 'CD', 'NZ']
+
+
+def write_inputs(pdb_path, csv_path, n_atoms, n_pairs, n_models, altloc_fraction, seed):
+    """
+    Writes the synthetic PDB and distance CSV files. Every model holds the
+    same atoms with other coordinates, a fraction of the atoms has a second
+    alternate location. The CSV file further contains a pair with an atom
+    which is not within the PDB file and a row with too few fields.
+    """
+    rng = random.Random(seed)
+    atoms = []
+    for i in range(n_atoms):
+        (chain, residue) = divmod(i // len(atom_names), 9999)
+        atoms.append((str(residue + 1), 'LYS', atom_names[i % len(atom_names)], 'ABCDEFGHIJ'[chain % 10]))
+    with open(pdb_path, 'w') as f:
+        for model in range(1, n_models + 1):
+            if n_models > 1:
+                f.write("MODEL     {:4d}\n".format(model))
+            serial = 1
+            for (resid, resname, atomname, segid) in atoms:
+                altlocs = ' '
+                if rng.random() < altloc_fraction:
+                    altlocs = 'AB'
+                for altloc in altlocs:
+                    (x, y, z) = (rng.uniform(-200, 200) for _ in range(3))
+                    f.write("ATOM  {:5d}  {:<3s}{}{:3s} {}{:>4s}    {:8.3f}{:8.3f}{:8.3f}  1.00  0.00           {}\n".format(
+                        serial % 100000, atomname, altloc, resname, segid, resid, x, y, z, atomname[0]))
+                    serial += 1
+            f.write("ENDMDL\n" if n_models > 1 else "END\n")
+    with open(csv_path, 'w') as f:
+        for _ in range(n_pairs):
+            f.write(','.join(rng.choice(atoms) + rng.choice(atoms)) + '\n')
+        f.write('1,LYS,CA,Z,2,LYS,CA,Z\n')
+        f.write('1,LYS,CA\n')
+
+
+def reference_output(pdb_path, csv_path):
+    """
+    Output of the original algorithm of pdb_calc_euclidean.py. A pair is
+    only reported if both of its atoms are found, where the original raised
+    a KeyError if only the first one was.
+    """
+    out = io.StringIO()
+    names = ['resid1', 'resname1', 'atomname1', 'segid1', 'resid2', 'resname2', 'atomname2', 'segid2']
+    filter_residues = []
+    with open(csv_path, 'r') as f:
+        for row in csv.reader(f, delimiter=','):
+            if len(row) < 8:
+                out.write("Not enough fields for row. Skipping..{}".format(os.linesep))
+                continue
+            filter_residues.append(dict(zip(names, [item.strip() for item in row[:8]])))
+
+    with open(pdb_path, 'r') as f:
+        for line in f:
+            if not line.startswith("ATOM"):
+                continue
+            x = {'resid': record_atom_resid(line), 'segid': record_atom_segid(line),
+                 'resname': record_atom_resname(line), 'atomname': record_atom_name(line),
+                 'x': record_atom_x(line), 'y': record_atom_y(line), 'z': record_atom_z(line)}
+            for residue in filter_residues:
+                for slot in ('1', '2'):
+                    if residue["resname" + slot] == x["resname"] and residue["segid" + slot] == x["segid"] and \
+                            residue["resid" + slot] == x["resid"] and residue["atomname" + slot] == x["atomname"]:
+                        residue["x" + slot] = x['x']
+                        residue["y" + slot] = x['y']
+                        residue["z" + slot] = x['z']
+
+    dist_lookup = {}
+    for residue in filter_residues:
+        if "x1" in residue and "x2" in residue:
+            delta = [a - b for (a, b) in zip([residue["x1"], residue["y1"], residue["z1"]],
+                                             [residue["x2"], residue["y2"], residue["z2"]])]
+            dist_lookup[tuple(residue[name] for name in names)] = math.sqrt(sum(a * a for a in delta))
+
+    with open(csv_path, 'r') as f:
+        for row in csv.reader(f, delimiter=','):
+            key = tuple([item.strip() for item in row[:8]])
+            if key in dist_lookup:
+                row = row + [str(dist_lookup[key])]
+            out.write(','.join(row) + os.linesep)
+    return out.getvalue().encode()
+
+
+def run_script(args):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, script] + args, stdout=subprocess.PIPE, check=True).stdout
+    return (output, time.perf_counter() - start)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks pdb_calc_euclidean.py against the original algorithm")
+    parser.add_argument("--atoms", metavar="N", type=int, default=20000, help="Number of atoms of each model")
+    parser.add_argument("--pairs", metavar="N", type=int, default=1000, help="Number of pairs in the distance CSV")
+    parser.add_argument("--models", metavar="N", type=int, default=2, help="Number of MODEL records")
+    parser.add_argument("--altlocs", metavar="FRACTION", type=float, default=0.05,
+                        help="Fraction of the atoms with two alternate locations")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", metavar="DIR", type=str,
+                        help="Write the inputs to DIR and keep them instead of using a temporary directory")
+    args = parser.parse_args(argv[1:])
+
+    directory = args.keep or tempfile.mkdtemp(prefix='benchmark_pdb_')
+    os.makedirs(directory, exist_ok=True)
+    try:
+        pdb_path = os.path.join(directory, 'synthetic.pdb')
+        csv_path = os.path.join(directory, 'synthetic.csv')
+        write_inputs(pdb_path, csv_path, args.atoms, args.pairs, args.models, args.altlocs, args.seed)
+
+        start = time.perf_counter()
+        expected = reference_output(pdb_path, csv_path)
+        timings = [('reference', time.perf_counter() - start, True)]
+
+        cache_dir = os.path.join(directory, 'cache')
+        runs = [('no cache', ['--no-cache']),
+                ('cold cache', ['--cache-dir', cache_dir]),
+                ('warm cache', ['--cache-dir', cache_dir])]
+        for (name, options) in runs:
+            (output, seconds) = run_script([pdb_path, csv_path] + options)
+            timings.append((name, seconds, output == expected))
+
+        sys.stdout.write("{} atoms x {} models, {} pairs\n".format(args.atoms, args.models, args.pairs))
+        for (name, seconds, identical) in timings:
+            sys.stdout.write("{:<12s}{:>9.3f} s  {}\n".format(name, seconds, 'identical' if identical else 'DIFFERS'))
+    finally:
+        if args.keep is None:
+            shutil.rmtree(directory)
+    return 0 if all(identical for (_, _, identical) in timings) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent index of the sequences within a FASTA file.
+
+The index is a SQLite sidecar file next to the FASTA file, mapping each
+accession (the first word of the header line) to the byte offset and
+length of its sequence. It records the size and modification time of the
+FASTA file and is rebuilt automatically once the file changes.
+Optionally, all sequences are also packed into a blob with one byte per
+residue, from which they are sliced through a memory map.
+
+If the directory of the FASTA file is not writable, for instance a shared
+database directory, the index is kept in a user cache directory instead,
+and if that is not writable either, it is built in memory for each run.
+"""
+import hashlib
+import mmap
+import os
+import sqlite3
+import sys
+import tempfile
+
+
+index_suffix = '.xlidx'
+blob_suffix = '.xlseq'
+
+default_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))),
+                                 'xlink_scripts', 'fasta')
+
+# Entries inserted at once while building the index
+insert_batch_size = 10000
+
+
+def index_base(fasta_path, directory=None):
+    """
+    Path of the index files without suffix. By default they are next to the
+    FASTA file, within directory they are named after its absolute path.
+    """
+    if directory is None:
+        return fasta_path
+    return os.path.join(directory, hashlib.sha1(os.path.abspath(fasta_path).encode('utf-8')).hexdigest())
+
+
+def index_path(fasta_path, directory=None):
+    return index_base(fasta_path, directory) + index_suffix
+
+
+def blob_path(fasta_path, directory=None):
+    return index_base(fasta_path, directory) + blob_suffix
+
+
+def fasta_stamp(fasta_path):
+    """
+    Size and modification time of the FASTA file, which identify its version.
+    """
+    stat = os.stat(fasta_path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def generate_entries(fasta_path, blob=None):
+    """
+    Generates tuples (accession, offset, length, blob_offset, blob_length) for
+    each record of the FASTA file. If blob is given, the residues of each
+    sequence are written to this binary file and blob_offset and blob_length
+    locate them, otherwise both are None.
+    """
+    entry = None
+    offset = 0
+    blob_offset = 0
+    with open(fasta_path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if entry is not None:
+                    yield tuple(entry)
+                fields = line[1:].split()
+                accession = fields[0].decode() if fields else ''
+                blob_length = None if blob is None else 0
+                entry = [accession, offset + len(line), 0, None if blob is None else blob_offset, blob_length]
+            elif entry is not None:
+                entry[2] += len(line)
+                if blob is not None:
+                    residues = b''.join(line.split())
+                    blob.write(residues)
+                    entry[4] += len(residues)
+                    blob_offset += len(residues)
+            offset += len(line)
+    if entry is not None:
+        yield tuple(entry)
+
+
+def fill_index(connection, fasta_path, blob=None):
+    """
+    Creates the tables of the index in the SQLite connection and inserts the
+    entries of the FASTA file, see generate_entries.
+    """
+    connection.executescript('''
+        CREATE TABLE meta (size INTEGER, mtime INTEGER, packed INTEGER);
+        CREATE TABLE entries (accession TEXT PRIMARY KEY, offset INTEGER, length INTEGER,
+                              blob_offset INTEGER, blob_length INTEGER);
+    ''')
+    (size, mtime) = fasta_stamp(fasta_path)
+    entries = generate_entries(fasta_path, blob)
+    while True:
+        batch = [entry for (_, entry) in zip(range(insert_batch_size), entries)]
+        if not batch:
+            break
+        try:
+            connection.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?)', batch)
+        except sqlite3.IntegrityError:
+            raise ValueError("Duplicate accession within FASTA file {}".format(fasta_path))
+    connection.execute('INSERT INTO meta VALUES (?, ?, ?)', (size, mtime, int(blob is not None)))
+    connection.commit()
+
+
+def build_index(fasta_path, pack=False, directory=None):
+    """
+    Builds the index of the FASTA file, and the packed sequence blob if pack
+    is set, next to the FASTA file or within directory. Both files are
+    written to temporary files first and then moved into place.
+    """
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(fasta_path))
+        target = None
+    else:
+        os.makedirs(directory, exist_ok=True)
+        target = directory
+    umask = os.umask(0)
+    os.umask(umask)
+    (fd, tmp_index) = tempfile.mkstemp(prefix='.', suffix=index_suffix, dir=directory)
+    os.close(fd)
+    tmp_blob = None
+    try:
+        connection = sqlite3.connect(tmp_index)
+        blob = None
+        if pack:
+            (fd, tmp_blob) = tempfile.mkstemp(prefix='.', suffix=blob_suffix, dir=directory)
+            blob = os.fdopen(fd, 'wb')
+        try:
+            fill_index(connection, fasta_path, blob)
+        finally:
+            if blob is not None:
+                blob.close()
+            connection.close()
+
+        # mkstemp creates files which are only accessible by the owner
+        for tmp in (tmp_index, tmp_blob):
+            if tmp is not None:
+                os.chmod(tmp, 0o666 & ~umask)
+        if pack:
+            os.replace(tmp_blob, blob_path(fasta_path, target))
+            tmp_blob = None
+        elif os.path.exists(blob_path(fasta_path, target)):
+            os.remove(blob_path(fasta_path, target))
+        os.replace(tmp_index, index_path(fasta_path, target))
+    finally:
+        for tmp in (tmp_index, tmp_blob):
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def read_meta(fasta_path, directory=None):
+    """
+    Returns (size, mtime, packed) as recorded in the index of the FASTA file,
+    None if there is no readable index.
+    """
+    path = index_path(fasta_path, directory)
+    if not os.path.isfile(path):
+        return None
+    try:
+        connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+        try:
+            return connection.execute('SELECT size, mtime, packed FROM meta').fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return None
+
+
+def is_current(fasta_path, directory=None):
+    """
+    Whether the index of the FASTA file exists and matches its current version.
+    """
+    meta = read_meta(fasta_path, directory)
+    if meta is None or tuple(meta[:2]) != fasta_stamp(fasta_path):
+        return False
+    return not meta[2] or os.path.isfile(blob_path(fasta_path, directory))
+
+
+class FastaIndex(object):
+    """
+    Read-only access to the sequences of a FASTA file through its index,
+    which is (re)built first if necessary. Each process has to open its own
+    FastaIndex. If pack is None, a rebuilt index keeps the packed blob if
+    the previous index had one. The index is looked up and built next to the
+    FASTA file first, then within cache_dir, and built in memory if neither
+    is writable.
+    """
+    def __init__(self, fasta_path, pack=None, cache_dir=default_cache_dir):
+        self.fasta_path = fasta_path
+        directories = [None, cache_dir]
+        current = [directory for directory in directories if is_current(fasta_path, directory)]
+        # False stands for the index in memory
+        directory = current[0] if current else False
+        if not current:
+            if pack is None:
+                meta = read_meta(fasta_path) or read_meta(fasta_path, cache_dir)
+                pack = bool(meta and meta[2])
+            for candidate in directories:
+                try:
+                    build_index(fasta_path, pack, candidate)
+                    directory = candidate
+                    break
+                except (OSError, sqlite3.Error) as e:
+                    sys.stderr.write("WARNING: Could not write index of {} to {}: {}\n".format(
+                        fasta_path, os.path.dirname(os.path.abspath(index_path(fasta_path, candidate))), e))
+        self.fasta = open(fasta_path, 'rb')
+        self.blob = None
+        if directory is False:
+            sys.stderr.write("WARNING: Building the index of {} in memory\n".format(fasta_path))
+            self.connection = sqlite3.connect(':memory:')
+            fill_index(self.connection, fasta_path)
+            return
+        self.connection = sqlite3.connect('file:{}?mode=ro'.format(index_path(fasta_path, directory)), uri=True)
+        packed = self.connection.execute('SELECT packed FROM meta').fetchone()[0]
+        if packed and os.path.getsize(blob_path(fasta_path, directory)) > 0:
+            with open(blob_path(fasta_path, directory), 'rb') as f:
+                self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, accession):
+        return self.connection.execute('SELECT 1 FROM entries WHERE accession = ?',
+                                       (accession,)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def sequence(self, accession):
+        """
+        Returns the sequence of the accession as string. Raises KeyError if
+        the accession is not within the FASTA file.
+        """
+        row = self.connection.execute(
+            'SELECT offset, length, blob_offset, blob_length FROM entries WHERE accession = ?',
+            (accession,)).fetchone()
+        if row is None:
+            raise KeyError(accession)
+        (offset, length, blob_offset, blob_length) = row
+        if self.blob is not None:
+            return self.blob[blob_offset:blob_offset + blob_length].decode('ascii')
+        self.fasta.seek(offset)
+        return b''.join(self.fasta.read(length).split()).decode('ascii')
+
+    def close(self):
+        self.connection.close()
+        self.fasta.close()
+        if self.blob is not None:
+            self.blob.close()
@@ -2,26 +2,170 @@
 """
 Renumbers the ranks of of the hits in an xQuest result file according
 to the order within the spectrum
+
+The result file is memory mapped and only the digits of the ranks are
+rewritten, everything in between is copied unchanged. With --in-place the
+renumbered file is written next to the result file and then moved over it.
+With --stats the file is not changed, but the distribution of the ranks is
+reported instead.
 """
+import argparse
+import collections
+import mmap
+import os
 import re
 import sys
+import tempfile
+
+from xquest_parser import generate_tags, re_rank
+
+re_spectrum = re.compile(rb'\sspectrum\s*=\s*(["\'])(.*?)\1', re.DOTALL)
+
+
+def open_buffer(f):
+    """
+    Memory map of the binary file f, empty bytes for an empty file.
+    """
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-def main():
 
+def renumber(buffer, out):
+    """
+    Writes the result file in buffer to the binary file out, with the ranks
+    of the hits renumbered from 1 within each spectrum. Returns the number
+    of ranks changed.
+    """
+    rank = 1
+    written = 0
+    changed = 0
+    view = memoryview(buffer)
     try:
-        rank = 1
-        re_rank = re.compile(r'search_hit_rank="([0-9]+)"')
-
-        with open(sys.argv[1], 'r') as f:
-            for line in f:
-                if line.startswith("<search_hit "):
-                    line = re.sub(re_rank, 'search_hit_rank="{}"'.format(rank),line)
-                    rank += 1
-                elif line.startswith("</spectrum_search"):
-                    rank = 1
-                sys.stdout.write(line)
+        for (event, start, end) in generate_tags(buffer):
+            if event == 'hit':
+                m = re_rank.search(buffer, start, end)
+                if m is not None:
+                    digits = str(rank).encode()
+                    if m.group(2) != digits:
+                        out.write(view[written:m.start(2)])
+                        out.write(digits)
+                        written = m.end(2)
+                        changed += 1
+                rank += 1
+            elif event == 'end':
+                rank = 1
+        out.write(view[written:])
     finally:
-        sys.stdout.close()
+        view.release()
+    return changed
+
+
+def renumber_in_place(path):
+    """
+    Renumbers the ranks of the result file at path through a temporary file
+    in the same directory, which atomically replaces the result file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    (fd, tmp) = tempfile.mkstemp(prefix='.', suffix='.xml', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as out, open(path, 'rb') as f:
+            buffer = open_buffer(f)
+            try:
+                changed = renumber(buffer, out)
+            finally:
+                if isinstance(buffer, mmap.mmap):
+                    buffer.close()
+            os.fchmod(out.fileno(), os.fstat(f.fileno()).st_mode & 0o7777)
+        if changed:
+            os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return changed
+
+
+def rank_stats(buffer):
+    """
+    Returns the number of hits for each rank, the number of spectra for each
+    number of hits, and a list of (spectrum, ranks) for the spectra whose
+    ranks are not 1, 2, ... in the order of their hits. Missing ranks are None.
+    """
+    rank_counts = collections.Counter()
+    hit_counts = collections.Counter()
+    out_of_order = []
+    spectrum = None
+    ranks = []
+    for (event, start, end) in generate_tags(buffer):
+        if event == 'hit':
+            m = re_rank.search(buffer, start, end)
+            rank = int(m.group(2)) if m is not None and m.group(2) else None
+            rank_counts[rank] += 1
+            ranks.append(rank)
+        elif event == 'spectrum':
+            m = re_spectrum.search(buffer, start, end)
+            spectrum = m.group(2).decode() if m is not None else ''
+            ranks = []
+        else:
+            hit_counts[len(ranks)] += 1
+            if ranks != list(range(1, len(ranks) + 1)):
+                out_of_order.append((spectrum, ranks))
+            spectrum = None
+            ranks = []
+    return (rank_counts, hit_counts, out_of_order)
+
+
+def write_stats(rank_counts, hit_counts, out_of_order, out):
+    def key(value):
+        return (value is None, value or 0)
+
+    out.write("spectra\t{}\n".format(sum(hit_counts.values())))
+    out.write("hits\t{}\n".format(sum(rank_counts.values())))
+    out.write("out_of_order\t{}\n".format(len(out_of_order)))
+    out.write("\nrank\thits\n")
+    for rank in sorted(rank_counts, key=key):
+        out.write("{}\t{}\n".format('NA' if rank is None else rank, rank_counts[rank]))
+    out.write("\nhits_per_spectrum\tspectra\n")
+    for n in sorted(hit_counts):
+        out.write("{}\t{}\n".format(n, hit_counts[n]))
+    if out_of_order:
+        out.write("\nspectrum\tranks\n")
+        for (spectrum, ranks) in out_of_order:
+            out.write("{}\t{}\n".format(spectrum, ','.join('NA' if r is None else str(r) for r in ranks)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Renumbers the ranks of the hits in an xQuest result file")
+    parser.add_argument("IN", type=str, help="xQuest result file")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--in-place', dest='in_place', action='store_true',
+                      help="Replace the result file instead of writing to stdout")
+    mode.add_argument('--stats', action='store_true',
+                      help="Report the distribution of the ranks instead of renumbering them")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.IN):
+        sys.stderr.write("ERROR: File: {} does not exist.\n".format(args.IN))
+        sys.exit(1)
+
+    if args.in_place:
+        renumber_in_place(args.IN)
+        return
+
+    with open(args.IN, 'rb') as f:
+        buffer = open_buffer(f)
+        try:
+            if args.stats:
+                write_stats(*rank_stats(buffer), out=sys.stdout)
+            else:
+                try:
+                    renumber(buffer, sys.stdout.buffer)
+                finally:
+                    sys.stdout.close()
+        finally:
+            if isinstance(buffer, mmap.mmap):
+                buffer.close()
+
+
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of arrays derived from structure files.
+
+Each entry is a directory of .npy files which are memory-mapped when the
+entry is loaded. Entries are keyed on the absolute path, the size and the
+modification time of the source file, so an entry is never used for a
+file which has changed since. The total size of the cache is bounded by
+evicting the least recently used entries.
+"""
+import os
+import sys
+import hashlib
+import shutil
+import tempfile
+import numpy as np
+
+
+default_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))),
+                                 'xlink_scripts', 'structures')
+default_cache_size = 1024  # MB
+
+
+def add_cache_arguments(parser):
+    """
+    Adds the options controlling the cache to an argparse parser.
+    """
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true",
+                        help="Always parse the structure files and do not use the coordinate cache")
+    parser.add_argument("--cache-dir", metavar="DIR", type=str, default=default_cache_dir,
+                        help="Directory of the coordinate cache")
+    parser.add_argument("--cache-size", metavar="MB", type=int, default=default_cache_size,
+                        help="Maximum size of the coordinate cache in megabytes")
+
+
+def cache_key(filename, extra=None):
+    """
+    Name of the cache entry of the file, derived from its absolute path, size and mtime.
+    extra distinguishes different entries derived from the same file.
+    """
+    stat = os.stat(filename)
+    identity = "{}\0{}\0{}".format(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    if extra is not None:
+        identity += "\0" + extra
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+def entry_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def evict(cache_dir, max_bytes):
+    """
+    Removes the least recently used entries until the cache fits into max_bytes.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and not entry.name.startswith('.'):
+            entries.append((entry.stat().st_mtime, entry_size(entry.path), entry.path))
+    total = sum(size for (_, size, _) in entries)
+    for (_, size, path) in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def load(path):
+    """
+    Memory-maps all arrays of the cache entry at path.
+    """
+    return {name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode='r')
+            for name in os.listdir(path) if name.endswith('.npy')}
+
+
+def store(path, arrays):
+    """
+    Writes the arrays as new cache entry at path. The entry is assembled in a
+    temporary directory and moved into place, so readers never see partial entries.
+    """
+    tmp = tempfile.mkdtemp(prefix='.', dir=os.path.dirname(path))
+    try:
+        for (name, array) in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), array, allow_pickle=False)
+        os.rename(tmp, path)
+    except OSError:
+        # Another process might have stored the same entry concurrently
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def cached_arrays(filename, compute, cache_dir=default_cache_dir, cache_size=default_cache_size, extra=None):
+    """
+    Returns the arrays of the file, as computed by compute(filename), which has
+    to return a dictionary of names to arrays. The arrays are taken from the
+    cache if possible, otherwise they are computed and added to the cache.
+    extra identifies the computation if several are cached for the same file.
+    """
+    path = os.path.join(cache_dir, cache_key(filename, extra))
+    if os.path.isdir(path):
+        try:
+            arrays = load(path)
+            # Marks the entry as recently used
+            os.utime(path)
+            return arrays
+        except (OSError, ValueError):
+            shutil.rmtree(path, ignore_errors=True)
+
+    arrays = compute(filename)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        store(path, arrays)
+        evict(cache_dir, cache_size * 1024 * 1024)
+    except OSError as e:
+        sys.stderr.write("WARNING: Could not write coordinate cache: {}{}".format(e, os.linesep))
+    return arrays
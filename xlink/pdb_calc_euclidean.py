@@ -11,23 +11,22 @@ Calculates the euclidean distance between pairs of residues.
 import sys
 import argparse
 import os
-import math
+import itertools
+import numpy as np
 
-def extract(segment, t):
-    def from_line(line):
-        if isinstance(segment, tuple):
-            return t(line[segment[0]-1:segment[1]].strip())
-        else:
-            return t(line[segment-1].strip())
-    return from_line
-# Line extractors for legacy pdb format for particular fields
-record_atom_resid = extract((23, 26), str)
-record_atom_segid = extract(22, str)
-record_atom_resname = extract((18, 20), str)
-record_atom_name = extract((13, 16), str)
-record_atom_x = extract((31, 38), float)
-record_atom_y = extract((39, 46), float)
-record_atom_z = extract((47, 54), float)
+import pdb_cache
+import residue_map
+from structure_reader import generate_atoms, extensions as structure_extensions
+
+# Atoms which are considered as crosslink anchors in the all-pairs mode,
+# as (resname, atomname). A resname of None matches every residue.
+crosslink_atoms = {(None, 'CA'), (None, 'CB'), ('LYS', 'NZ')}
+
+# Leading columns of the xlinkanalyzer CSV files written by xlconverter
+xlinkanalyzer_columns = ['Id', 'Protein1', 'Protein2', 'AbsPos1', 'AbsPos2']
+
+# Columns appended to the xlinkanalyzer CSV file
+xlinkanalyzer_result_columns = ['Chain1', 'Resid1', 'Chain2', 'Resid2', 'Distance']
 
 
 def checkfile(filename, extension=None):
@@ -46,115 +45,566 @@ def checkfile(filename, extension=None):
         return True
     
     # Get file extension
-    true_extension = filename.split('.')[-1]
-    if extension != true_extension:
-        sys.stderr.write("File {} does not have the correct extension.{}Expected: {}{}Have:{}{}".format(filename, os.linesep, extension, os.linesep, extension, os.linesep ))
+    extensions = (extension,) if isinstance(extension, str) else tuple(extension)
+    if not filename.endswith(tuple('.' + e for e in extensions)):
+        sys.stderr.write("File {} does not have the correct extension.{}Expected: {}{}Have:{}{}".format(filename, os.linesep, ', '.join(extensions), os.linesep, filename.split('.')[-1], os.linesep ))
         return False
     return True
     
 
-# Writes the results back as CSV
-def write_results_csv(filename, dist_lookup):
+def read_rows_csv(filename):
+    """
+    Reads all rows of the distance CSV file, such that the file
+    needs to be parsed only once.
     """
-    Generates the Residues within a CSV file assuming a given order.
-    """    
     import csv
     with open(filename, 'r') as csvfile_handle:
-        for row in csv.reader(csvfile_handle, delimiter=','):
-            key = tuple([item.strip() for item in row[:8]])
-            if key in dist_lookup:
-                    row.append(str(dist_lookup[key]))
-            sys.stdout.write(','.join(row) + os.linesep)
+        return list(csv.reader(csvfile_handle, delimiter=','))
 
 
-def generate_residues_csv(filename):
+# Writes the results back as CSV
+def write_results_csv(rows, dist_lookup):
     """
-    Generates the Residues within a CSV file assuming a given order.
+    Writes the rows of the distance CSV file with the distance appended.
+    """    
+    for row in rows:
+        key = tuple([item.strip() for item in row[:8]])
+        if key in dist_lookup:
+                row = row + [str(dist_lookup[key])]
+        sys.stdout.write(','.join(row) + os.linesep)
+
+
+def generate_residues_csv(rows):
+    """
+    Generates the Residues within the rows of a CSV file assuming a given order.
     """
     # Attention: Order of residue attributes is assumed here
     names = ['resid1', 'resname1', 'atomname1', 'segid1', 'resid2', 'resname2', 'atomname2', 'segid2']
-    import csv
-    with open(filename, 'r') as csvfile_handle:
-        for row in csv.reader(csvfile_handle, delimiter=','):
-            if len(row) < 8:
-                sys.stdout.write("Not enough fields for row. Skipping..{}".format(os.linesep))
-                continue            
-            # Attention: Order of residue attributes is assumed here
-            yield dict(zip(names, [item.strip() for item in row[:8]]))
-
-def generate_residues_pdb(filename):
-    """
-    Generates the residues within a PDB file.
-    """
-    with open(filename, 'r') as pdbfile_handle:
-        for line in pdbfile_handle:   
-            if line.startswith("ATOM"):
-                yield {
-                    'resid':    record_atom_resid(line),
-                    'segid':    record_atom_segid (line),
-                    'resname':  record_atom_resname(line),
-                    'atomname': record_atom_name(line),
-                    'x': record_atom_x(line),
-                    'y': record_atom_y(line),
-                    'z': record_atom_z(line)
-                  }
-    
-    
-def dot_product(x, y):
-    return sum((a*b for (a,b) in zip(x,y)))
+    for row in rows:
+        if len(row) < 8:
+            sys.stdout.write("Not enough fields for row. Skipping..{}".format(os.linesep))
+            continue            
+        # Attention: Order of residue attributes is assumed here
+        yield dict(zip(names, [item.strip() for item in row[:8]]))
 
 
-def vec_norm(x):
-    return math.sqrt(dot_product(x,x))
-    
+def generate_residues_pdb(filename, atoms=None):
+    """
+    Generates the residues within a PDB or mmCIF file, optionally gzip-compressed.
+    Each residue carries the serial number of the MODEL it belongs to, '1'
+    if there are no MODEL records. If atoms is given, only residues whose
+    key (resid, resname, atomname, segid) is in atoms are generated.
+    """
+    return generate_atoms(filename, atoms)
+
+
+def generate_models_pdb(filename, atoms=None):
+    """
+    Groups the residues within a PDB file by model. Generates tuples of the
+    model serial number and the residues of that model.
+    """
+    for (model, residues) in itertools.groupby(generate_residues_pdb(filename, atoms),
+                                               key=lambda residue: residue['model']):
+        yield (model, residues)
+
+
+def build_pair_index(filter_residues):
+    """
+    Compiles the residue pairs into a lookup table which maps the
+    key (resid, resname, atomname, segid) of an atom to all the
+    (pair, slot) positions it has to fill. Slot is either '1' or '2'.
+    """
+    pair_index = {}
+    for (i, residue) in enumerate(filter_residues):
+        for slot in ('1', '2'):
+            key = (residue["resid" + slot], residue["resname" + slot],
+                   residue["atomname" + slot], residue["segid" + slot])
+            pair_index.setdefault(key, []).append((i, slot))
+    return pair_index
+
+
+def is_crosslink_atom(residue):
+    return (None, residue["atomname"]) in crosslink_atoms or \
+           (residue["resname"], residue["atomname"]) in crosslink_atoms
+
+
+class CoordinateStore(object):
+    """
+    Column store of atom records. The coordinates are held in a N x 3 array,
+    the identity columns are interned into integer codes which index into
+    the vocabulary of the respective column.
+    """
+    columns = ('model', 'resid', 'resname', 'atomname', 'segid')
+    key_columns = ('resid', 'resname', 'atomname', 'segid')
+
+    def __init__(self, coords, codes, vocabularies):
+        self.coords = coords
+        self.codes = codes
+        self.vocabularies = vocabularies
+
+    @classmethod
+    def from_residues(cls, residues):
+        interned = {column: {} for column in cls.columns}
+        codes = {column: [] for column in cls.columns}
+        coords = []
+        for residue in residues:
+            for column in cls.columns:
+                vocabulary = interned[column]
+                codes[column].append(vocabulary.setdefault(residue[column], len(vocabulary)))
+            coords.append((residue['x'], residue['y'], residue['z']))
+        # Dictionaries preserve insertion order, so the code is the list index
+        return cls(np.array(coords, dtype=np.float64).reshape(-1, 3),
+                   {column: np.array(codes[column], dtype=np.int32) for column in cls.columns},
+                   {column: list(interned[column]) for column in cls.columns})
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Inverse of to_arrays.
+        """
+        return cls(arrays['coords'],
+                   {column: arrays[column] for column in cls.columns},
+                   {column: arrays[column + '_vocabulary'].tolist() for column in cls.columns})
+
+    def to_arrays(self):
+        """
+        Flattens the store into a dictionary of plain arrays, e.g. for caching.
+        """
+        arrays = {'coords': np.asarray(self.coords)}
+        for column in self.columns:
+            arrays[column] = np.asarray(self.codes[column])
+            arrays[column + '_vocabulary'] = np.array(self.vocabularies[column], dtype=str)
+        return arrays
+
+    def __len__(self):
+        return self.coords.shape[0]
+
+    def key(self, i):
+        """
+        Returns (resid, resname, atomname, segid) of the i-th atom.
+        """
+        return tuple(self.vocabularies[column][self.codes[column][i]] for column in self.key_columns)
+
+    def subset(self, rows):
+        """
+        Store of the given rows, sharing the vocabularies with this store.
+        """
+        return CoordinateStore(self.coords[rows],
+                               {column: self.codes[column][rows] for column in self.columns},
+                               self.vocabularies)
+
+    def models(self):
+        """
+        Generates tuples of the model serial number and the store of its atoms.
+        """
+        for (code, model) in enumerate(self.vocabularies['model']):
+            yield (model, self.subset(np.nonzero(self.codes['model'] == code)[0]))
+
+    def lookup(self, keys, last=False):
+        """
+        Returns the row of the first occurrence of each key, or of the last
+        if last is set, -1 for absent keys.
+        """
+        keys = list(keys)
+        result = np.full(len(keys), -1, dtype=np.int64)
+        if not keys or not len(self):
+            return result
+
+        # Encodes the key columns of each row into a single integer
+        sizes = [len(self.vocabularies[column]) for column in self.key_columns]
+        composite = np.zeros(len(self), dtype=np.int64)
+        for (column, size) in zip(self.key_columns, sizes):
+            composite = composite * size + self.codes[column]
+        if last:
+            (unique, first) = np.unique(composite[::-1], return_index=True)
+            first = len(self) - 1 - first
+        else:
+            (unique, first) = np.unique(composite, return_index=True)
+
+        positions = [{value: code for (code, value) in enumerate(self.vocabularies[column])}
+                     for column in self.key_columns]
+        wanted = np.full(len(keys), -1, dtype=np.int64)
+        for (i, key) in enumerate(keys):
+            code = 0
+            for (position, size, value) in zip(positions, sizes, key):
+                if value not in position:
+                    break
+                code = code * size + position[value]
+            else:
+                wanted[i] = code
+        valid = np.nonzero(wanted >= 0)[0]
+        found = np.minimum(np.searchsorted(unique, wanted[valid]), len(unique) - 1)
+        hit = unique[found] == wanted[valid]
+        result[valid[hit]] = first[found[hit]]
+        return result
+
+    def crosslink_mask(self):
+        """
+        Boolean mask of the atoms which are crosslink anchors, see crosslink_atoms.
+        """
+        pairs = itertools.product(enumerate(self.vocabularies['resname']),
+                                  enumerate(self.vocabularies['atomname']))
+        anchor = np.zeros((len(self.vocabularies['resname']), len(self.vocabularies['atomname'])), dtype=bool)
+        for ((i, resname), (j, atomname)) in pairs:
+            anchor[i, j] = is_crosslink_atom({'resname': resname, 'atomname': atomname})
+        return anchor[self.codes['resname'], self.codes['atomname']]
+
+
+def load_structure(filename, cache_options=None):
+    """
+    Returns the CoordinateStore of all atoms in the PDB file. If cache_options
+    is given, the store is taken from or added to the coordinate cache.
+    """
+    def parse(filename):
+        return CoordinateStore.from_residues(generate_residues_pdb(filename)).to_arrays()
+    if cache_options is None:
+        return CoordinateStore.from_arrays(parse(filename))
+    return CoordinateStore.from_arrays(pdb_cache.cached_arrays(filename, parse, **cache_options))
+
+
+def load_atoms(filename, keys, cache_options=None):
+    """
+    Returns the CoordinateStore of the atoms in keys within all models of
+    the structure file. Without cache, only the atoms in keys are parsed,
+    with cache the store holds all atoms.
+    """
+    if cache_options is None:
+        return CoordinateStore.from_residues(generate_residues_pdb(filename, keys))
+    return load_structure(filename, cache_options)
+
+
+def generate_models(filename, keys, cache_options=None):
+    """
+    Generates tuples of the model serial number and the CoordinateStore
+    of the atoms in keys within that model.
+
+    Without cache, only the atoms in keys are parsed.
+    """
+    if cache_options is None:
+        for (model, residues) in generate_models_pdb(filename, keys):
+            yield (model, CoordinateStore.from_residues(residues))
+    else:
+        for (model, store) in load_structure(filename, cache_options).models():
+            yield (model, store)
+
+
+def cache_options_from_args(args):
+    """
+    The keyword arguments of pdb_cache.cached_arrays, None if caching is disabled.
+    """
+    if args.no_cache:
+        return None
+    return {'cache_dir': args.cache_dir, 'cache_size': args.cache_size}
+
+
+def pair_distances(coords, idx1, idx2):
+    """
+    Euclidean distances between the rows idx1 and idx2 of coords.
+    """
+    delta = coords[idx1] - coords[idx2]
+    return np.sqrt((delta * delta).sum(axis=1))
+
+
+def compute_pair_distances(store, n_pairs, pair_index):
+    """
+    Computes the distances of all pairs in pair_index in one batch.
+    Returns the indices of the pairs with both atoms present in store
+    and their distances. Atoms occurring several times, e.g. alternate
+    locations, are taken from their last occurrence.
+    """
+    idx = {'1': np.full(n_pairs, -1, dtype=np.int64), '2': np.full(n_pairs, -1, dtype=np.int64)}
+    keys = list(pair_index)
+    for (key, row) in zip(keys, store.lookup(keys, last=True).tolist()):
+        if row < 0:
+            continue
+        for (i, slot) in pair_index[key]:
+            idx[slot][i] = row
+    found = np.nonzero((idx['1'] >= 0) & (idx['2'] >= 0))[0]
+    return (found, pair_distances(store.coords, idx['1'][found], idx['2'][found]))
+
+
+def pair_key(residue):
+    """
+    The eight key fields of a pair of residues from the distance CSV file.
+    """
+    return (residue["resid1"], residue["resname1"], residue["atomname1"], residue["segid1"],
+            residue["resid2"], residue["resname2"], residue["atomname2"], residue["segid2"])
+
+
+def compute_distances(store, filter_residues, pair_index):
+    """
+    Computes the distances of all pairs in filter_residues in one batch.
+    Returns the dictionary mapping the eight key fields of each pair
+    with both atoms present in store to the distance.
+    """
+    (found, distances) = compute_pair_distances(store, len(filter_residues), pair_index)
+    return {pair_key(filter_residues[i]): distance
+            for (i, distance) in zip(found.tolist(), distances.tolist())}
+
+
+def neighbour_pairs(coords, cutoff):
+    """
+    Finds all pairs of rows (i, j) with i < j within cutoff of each other.
+
+    Uses a cell list with cell edge length cutoff, such that only atoms in
+    the same or in adjacent cells need to be compared. Returns the index
+    arrays i, j and the distances, sorted by i and j.
+    """
+    empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))
+    if len(coords) < 2:
+        return empty
+    cells = np.floor((coords - coords.min(axis=0)) / cutoff).astype(np.int64)
+    members = {}
+    for (row, cell) in enumerate(map(tuple, cells.tolist())):
+        members.setdefault(cell, []).append(row)
+    members = {cell: np.array(rows, dtype=np.int64) for (cell, rows) in members.items()}
+
+    # Half shell of neighbouring cells, each pair of cells is visited once
+    offsets = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+               if (dx, dy, dz) > (0, 0, 0)]
+    max_dist2 = cutoff * cutoff
+    result_i, result_j = [], []
+    for (cell, rows) in members.items():
+        for offset in [(0, 0, 0)] + offsets:
+            other = members.get((cell[0] + offset[0], cell[1] + offset[1], cell[2] + offset[2]))
+            if other is None:
+                continue
+            delta = coords[rows][:, None, :] - coords[other][None, :, :]
+            within = (delta * delta).sum(axis=2) <= max_dist2
+            if offset == (0, 0, 0):
+                within = np.triu(within, k=1)
+            (ii, jj) = np.nonzero(within)
+            result_i.append(rows[ii])
+            result_j.append(other[jj])
+    if not result_i:
+        return empty
+    i = np.concatenate(result_i)
+    j = np.concatenate(result_j)
+    (i, j) = (np.minimum(i, j), np.maximum(i, j))
+    order = np.lexsort((j, i))
+    (i, j) = (i[order], j[order])
+    return (i, j, pair_distances(coords, i, j))
+
+
+def write_all_pairs_csv(store, cutoff):
+    """
+    Writes all pairs of crosslink atoms in store within cutoff as CSV.
+    Pairs of atoms within the same residue are omitted.
+    """
+    (i, j, distances) = neighbour_pairs(store.coords, cutoff)
+    same_residue = (store.codes['resid'][i] == store.codes['resid'][j]) & \
+                   (store.codes['segid'][i] == store.codes['segid'][j])
+    keep = ~same_residue
+    for (a, b, distance) in zip(i[keep].tolist(), j[keep].tolist(), distances[keep].tolist()):
+        sys.stdout.write(','.join(store.key(a) + store.key(b) + (str(distance),)) + os.linesep)
+
+
+def is_xlinkanalyzer_csv(rows):
+    """
+    Whether the rows are an xlinkanalyzer CSV file, recognized by its header.
+    """
+    return bool(rows) and [item.strip() for item in rows[0][:len(xlinkanalyzer_columns)]] == xlinkanalyzer_columns
+
+
+def parse_positions(value):
+    """
+    Positions of an AbsPos column, which joins several positions by '+' and is '-' if empty.
+    """
+    return [int(item) for item in value.split('+') if item.strip().isdigit()]
+
+
+def anchor_atoms(rows, protein_column, position_column, anchors):
+    """
+    Collects the anchor atoms of one end of the crosslinks in rows, for each
+    position and each chain mapped to the protein. anchors maps each protein
+    to its array of anchor_rows. Returns the arrays of row indices and atoms.
+    """
+    by_protein = {}
+    for (i, row) in enumerate(rows):
+        if len(row) <= position_column:
+            continue
+        positions = parse_positions(row[position_column])
+        (indices, protein_positions) = by_protein.setdefault(row[protein_column].strip(), ([], []))
+        indices.extend([i] * len(positions))
+        protein_positions.extend(positions)
+
+    result_rows = [np.empty(0, dtype=np.int64)]
+    result_atoms = [np.empty(0, dtype=np.int64)]
+    for (protein, (indices, positions)) in by_protein.items():
+        rows_of_protein = anchors.get(protein)
+        if rows_of_protein is None or not indices:
+            continue
+        indices = np.array(indices, dtype=np.int64)
+        positions = np.array(positions, dtype=np.int64)
+        valid = (positions >= 1) & (positions < rows_of_protein.shape[1])
+        atoms = rows_of_protein[:, positions[valid]]
+        indices = np.broadcast_to(indices[valid], atoms.shape)
+        found = atoms >= 0
+        result_rows.append(indices[found])
+        result_atoms.append(atoms[found])
+    return (np.concatenate(result_rows), np.concatenate(result_atoms))
+
+
+def closest_pairs(coords, n_rows, rows1, atoms1, rows2, atoms2):
+    """
+    For each row, finds the closest pair of its atoms in atoms1 and atoms2.
+    Returns the arrays of the atoms of the closest pair and its distance,
+    -1 and nan for rows lacking atoms on either end.
+    """
+    order1 = np.argsort(rows1, kind='stable')
+    order2 = np.argsort(rows2, kind='stable')
+    (atoms1, atoms2) = (atoms1[order1], atoms2[order2])
+    count1 = np.bincount(rows1, minlength=n_rows)
+    count2 = np.bincount(rows2, minlength=n_rows)
+    start1 = np.cumsum(count1) - count1
+    start2 = np.cumsum(count2) - count2
+
+    # All combinations of the atoms of both ends within each row
+    n_pairs = count1 * count2
+    pair_row = np.repeat(np.arange(n_rows), n_pairs)
+    k = np.arange(len(pair_row)) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    idx1 = atoms1[start1[pair_row] + k // count2[pair_row]]
+    idx2 = atoms2[start2[pair_row] + k % count2[pair_row]]
+    distances = pair_distances(coords, idx1, idx2)
+
+    best1 = np.full(n_rows, -1, dtype=np.int64)
+    best2 = np.full(n_rows, -1, dtype=np.int64)
+    best = np.full(n_rows, np.nan)
+    order = np.lexsort((distances, pair_row))
+    (rows, first) = np.unique(pair_row[order], return_index=True)
+    chosen = order[first]
+    best1[rows] = idx1[chosen]
+    best2[rows] = idx2[chosen]
+    best[rows] = distances[chosen]
+    return (best1, best2, best)
+
+
+def write_xlinkanalyzer_csv(rows, store, anchors):
+    """
+    Writes the rows of the xlinkanalyzer CSV file with the chains and residues
+    of the closest pair of anchor atoms and their distance appended.
+    """
+    (header, rows) = (rows[0], rows[1:])
+    (protein1, protein2, abspos1, abspos2) = [xlinkanalyzer_columns.index(column) for column in
+                                              ('Protein1', 'Protein2', 'AbsPos1', 'AbsPos2')]
+    (rows1, atoms1) = anchor_atoms(rows, protein1, abspos1, anchors)
+    (rows2, atoms2) = anchor_atoms(rows, protein2, abspos2, anchors)
+    (best1, best2, distances) = closest_pairs(store.coords, len(rows), rows1, atoms1, rows2, atoms2)
+
+    # Chains and residues of the atoms, the atom -1 of rows without distance gets ''
+    def labels(atoms, column):
+        vocabulary = np.array(list(store.vocabularies[column]) + [''], dtype=object)
+        codes = np.append(np.asarray(store.codes[column]), len(vocabulary) - 1)
+        return vocabulary[codes[atoms]].tolist()
+
+    columns = zip(labels(best1, 'segid'), labels(best1, 'resid'), labels(best2, 'segid'), labels(best2, 'resid'),
+                  ['' if np.isnan(distance) else str(distance) for distance in distances.tolist()])
+    lines = [','.join(header + xlinkanalyzer_result_columns)]
+    lines.extend(','.join(row + list(result)) for (row, result) in zip(rows, columns))
+    sys.stdout.write(os.linesep.join(lines) + os.linesep)
+
+
+def compute_anchors(filename, store, rows, fasta, atomname, min_identity, cache_options=None):
+    """
+    Maps the proteins of the xlinkanalyzer rows to the chains of the structure
+    and returns for each protein the anchor_rows of the atom atomname.
+    """
+    from fasta_index import FastaIndex
+
+    proteins = set()
+    for row in rows[1:]:
+        proteins.update(row[column].strip() for column in (1, 2) if len(row) > column)
+    proteins.discard('-')
+    proteins.discard('')
+
+    anchors = {}
+    database_index = FastaIndex(fasta)
+    try:
+        for protein in sorted(proteins):
+            try:
+                sequence = database_index.sequence(protein)
+            except KeyError:
+                sys.stderr.write("Protein {} is not within {}.{}".format(protein, fasta, os.linesep))
+                continue
+            mapping = residue_map.residue_map(filename, store, sequence, min_identity, cache_options)
+            anchors[protein] = residue_map.anchor_rows(store, mapping, atomname)
+    finally:
+        database_index.close()
+    return anchors
+
 
 def main(argv):
     
     parser = argparse.ArgumentParser(description="Computes Euclidean distances within a protein between pairs of residues")
     parser.add_argument("IN_PDB",  type=str)
-    parser.add_argument("IN_DIST", type=str)
+    parser.add_argument("IN_DIST", type=str, nargs='?')
+    parser.add_argument("--all-pairs", dest="all_pairs", action="store_true",
+                        help="List all pairs of CA, CB and Lys NZ atoms within the cutoff instead of the pairs in IN_DIST")
+    parser.add_argument("--cutoff", metavar="ANGSTROM", type=float, default=30.0,
+                        help="Maximum distance of pairs in the all-pairs mode")
+    parser.add_argument("--fasta", metavar="DB", type=str,
+                        help="FASTA database of the proteins, required if IN_DIST is an xlinkanalyzer CSV file")
+    parser.add_argument("--atom", metavar="NAME", type=str, default='CA',
+                        help="Atom of the residues between which distances of xlinkanalyzer crosslinks are computed")
+    parser.add_argument("--min-identity", dest="min_identity", metavar="FRACTION", type=float,
+                        default=residue_map.default_min_identity,
+                        help="Minimal fraction of the residues of a chain aligned to a protein to map it")
+    pdb_cache.add_cache_arguments(parser)
     
     args = parser.parse_args(argv[1:])
 
-    if not checkfile(args.IN_PDB, "pdb") or not checkfile(args.IN_DIST):
+    if args.all_pairs:
+        if not checkfile(args.IN_PDB, structure_extensions):
+            sys.stderr.write("Cannot continue due to previous errors.{}".format(os.linesep))
+            sys.exit(1)
+        if args.cutoff <= 0:
+            sys.stderr.write("Cutoff must be positive. Terminating.{}".format(os.linesep))
+            sys.exit(1)
+        store = load_structure(args.IN_PDB, cache_options_from_args(args))
+        (_, store) = next(store.models(), (None, store))
+        write_all_pairs_csv(store.subset(np.nonzero(store.crosslink_mask())[0]), args.cutoff)
+        return
+
+    if args.IN_DIST is None:
+        sys.stderr.write("IN_DIST is required unless --all-pairs is given.{}".format(os.linesep))
+        sys.exit(1)
+
+    if not checkfile(args.IN_PDB, structure_extensions) or not checkfile(args.IN_DIST):
          sys.stderr.write("Cannot continue due to previous errors.{}".format(os.linesep))
          sys.exit(1)
         
     # Handle distfile in csv format and construct filter for the pdbfile
     if args.IN_DIST.endswith("csv"):
-        filter_residues = list(generate_residues_csv(args.IN_DIST))
+        rows = read_rows_csv(args.IN_DIST)
     else:
         sys.stderr.write("Unsupported file extension for the distfile. Terminating.{}".format(os.linesep))
-        
- 
-    def join(x):
-        for residue in filter_residues:
-            if residue["resname1"] == x["resname"] and residue["segid1"] == x["segid"] and residue["resid1"] == x["resid"] and residue["atomname1"] == x["atomname"]:
-                residue["x1"] = x['x']
-                residue["y1"] = x['y']
-                residue["z1"] = x['z']
-                
-            if residue["resname2"] == x["resname"] and residue["segid2"] == x["segid"] and residue["resid2"] == x["resid"] and residue["atomname2"] == x["atomname"]:
-                residue["x2"] = x['x']
-                residue["y2"] = x['y']
-                residue["z2"] = x['z']
-    
-    # Joins all residues in the PDB File to the residues in the filter_residues list
-    for residue in generate_residues_pdb(args.IN_PDB):
-            join(residue)        
-    
-    dict_lookup = {}        
-    for residue in filter_residues:
-        if "x1" in residue and "y1" in residue:
-            dict_lookup[(residue["resid1"],residue["resname1"],residue["atomname1"],residue["segid1"],
-                         residue["resid2"],residue["resname2"],residue["atomname2"],residue["segid2"])] = vec_norm([a-b for (a,b) in zip([residue["x1"], residue["y1"], residue["z1"]], 
-                                                  [residue["x2"], residue["y2"], residue["z2"]])])         
-            
+        sys.exit(1)
+
+    # Crosslinks between positions of the proteins are mapped onto the chains
+    if is_xlinkanalyzer_csv(rows):
+        if args.fasta is None or not checkfile(args.fasta):
+            sys.stderr.write("xlinkanalyzer CSV files require the FASTA database given by --fasta.{}".format(os.linesep))
+            sys.exit(1)
+        cache_options = cache_options_from_args(args)
+        store = load_structure(args.IN_PDB, cache_options)
+        (_, store) = next(store.models(), (None, store))
+        anchors = compute_anchors(args.IN_PDB, store, rows, args.fasta, args.atom, args.min_identity, cache_options)
+        write_xlinkanalyzer_csv(rows, store, anchors)
+        return
+
+    filter_residues = list(generate_residues_csv(rows))
+
+    # Joins all residues in the PDB File to the residues in the filter_residues list.
+    # As atoms are matched regardless of their model, the last occurrence wins
+    pair_index = build_pair_index(filter_residues)
+    store = load_atoms(args.IN_PDB, pair_index, cache_options_from_args(args))
+    dict_lookup = compute_distances(store, filter_residues, pair_index)
+
     # Handle distfile in csv format and construct filter for the pdbfile
     if args.IN_DIST.endswith("csv"):
-        write_results_csv(args.IN_DIST, dict_lookup)
+        write_results_csv(rows, dict_lookup)
 
 
         
 if __name__ == '__main__':
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Calculates the euclidean distances between the pairs of residues of one
+distance CSV file for many PDB or mmCIF files and for every MODEL within them.
+
+The CSV file is parsed once and the compiled pair index is shared with a
+pool of worker processes, each of which handles whole PDB files.
+The distances are written as long-format table, optionally together with
+the minimum, mean and maximum distance of each pair across all models.
+"""
+import sys
+import argparse
+import os
+import csv
+import multiprocessing
+import numpy as np
+
+import pdb_cache
+from pdb_calc_euclidean import checkfile, read_rows_csv, generate_residues_csv, generate_models, \
+    build_pair_index, compute_pair_distances, pair_key, cache_options_from_args
+from structure_reader import extensions as structure_extensions
+
+
+# Shared with the worker processes by the pool initializer
+_worker_state = {}
+
+
+def _init_worker(n_pairs, pair_index, cache_options):
+    _worker_state['n_pairs'] = n_pairs
+    _worker_state['pair_index'] = pair_index
+    _worker_state['cache_options'] = cache_options
+
+
+def distances_pdb(filename):
+    """
+    Computes the pair distances for every model within the PDB file.
+    Returns a list of (model, found, distances), see compute_pair_distances.
+    """
+    n_pairs = _worker_state['n_pairs']
+    pair_index = _worker_state['pair_index']
+    result = []
+    for (model, store) in generate_models(filename, pair_index, _worker_state['cache_options']):
+        (found, distances) = compute_pair_distances(store, n_pairs, pair_index)
+        result.append((model, found, distances))
+    return result
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description="Computes Euclidean distances between pairs of residues for many structures")
+    parser.add_argument("IN_DIST", type=str)
+    parser.add_argument("IN_PDB", type=str, nargs='+')
+    parser.add_argument("-o", metavar="OUT", type=str, required=True,
+                        help="Long-format table with the columns structure, model, pair and distance")
+    parser.add_argument("--summary", metavar="SUMMARY", type=str,
+                        help="Table with minimum, mean and maximum distance of each pair across all models")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=os.cpu_count(),
+                        help="Number of worker processes")
+    pdb_cache.add_cache_arguments(parser)
+
+    args = parser.parse_args(argv[1:])
+
+    if not all([checkfile(pdb, structure_extensions) for pdb in args.IN_PDB]) or not checkfile(args.IN_DIST, "csv"):
+        sys.stderr.write("Cannot continue due to previous errors.{}".format(os.linesep))
+        sys.exit(1)
+    if args.jobs < 1:
+        sys.stderr.write("Number of jobs must be positive.{}".format(os.linesep))
+        sys.exit(1)
+
+    filter_residues = list(generate_residues_csv(read_rows_csv(args.IN_DIST)))
+    pair_index = build_pair_index(filter_residues)
+    n_pairs = len(filter_residues)
+    pair_keys = [pair_key(residue) for residue in filter_residues]
+    cache_options = cache_options_from_args(args)
+
+    count = np.zeros(n_pairs, dtype=np.int64)
+    total = np.zeros(n_pairs)
+    minimum = np.full(n_pairs, np.inf)
+    maximum = np.full(n_pairs, -np.inf)
+
+    pool = None
+    if args.jobs == 1:
+        _init_worker(n_pairs, pair_index, cache_options)
+        results = map(distances_pdb, args.IN_PDB)
+    else:
+        pool = multiprocessing.Pool(processes=min(args.jobs, len(args.IN_PDB)),
+                                    initializer=_init_worker, initargs=(n_pairs, pair_index, cache_options))
+        results = pool.imap(distances_pdb, args.IN_PDB)
+
+    try:
+        with open(args.o, 'w', newline='') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(['structure', 'model', 'resid1', 'resname1', 'atomname1', 'segid1',
+                             'resid2', 'resname2', 'atomname2', 'segid2', 'distance'])
+            for (structure, models) in zip(args.IN_PDB, results):
+                for (model, found, distances) in models:
+                    writer.writerows((structure, model) + pair_keys[i] + (str(distance),)
+                                     for (i, distance) in zip(found.tolist(), distances.tolist()))
+                    count[found] += 1
+                    total[found] += distances
+                    minimum[found] = np.minimum(minimum[found], distances)
+                    maximum[found] = np.maximum(maximum[found], distances)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if args.summary is not None:
+        with open(args.summary, 'w', newline='') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(['resid1', 'resname1', 'atomname1', 'segid1',
+                             'resid2', 'resname2', 'atomname2', 'segid2', 'n', 'min', 'mean', 'max'])
+            for i in np.nonzero(count)[0].tolist():
+                writer.writerow(pair_keys[i] + (count[i], float(minimum[i]),
+                                                float(total[i] / count[i]), float(maximum[i])))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
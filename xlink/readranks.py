@@ -4,22 +4,29 @@ Spits out the ranks of each search hit for a xQuest result file grouped by
 the spectra
 
 """
-import re
+import mmap
 import sys
 
-def main():
+from xquest_parser import generate_tags, re_rank
+
 
-    re_rank = re.compile(r'search_hit_rank="([0-9]+)"')
+def main():
 
-    with open(sys.argv[1], 'r') as f:
-        for line in f:
-            if line.startswith("<search_hit "):
-                m = re.findall(re_rank, line)
-                print(m[0])
-            elif line.startswith("</spectrum_search"):
-                print("===")
+    lines = []
+    with open(sys.argv[1], 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if f.seek(0, 2) else b''
+        for (event, start, end) in generate_tags(buffer):
+            if event == 'hit':
+                m = re_rank.search(buffer, start, end)
+                lines.append(m.group(2) if m is not None else b'')
+            elif event == 'end':
+                lines.append(b'===')
+            if len(lines) >= 10000:
+                sys.stdout.buffer.write(b'\n'.join(lines) + b'\n')
+                del lines[:]
+    if lines:
+        sys.stdout.buffer.write(b'\n'.join(lines) + b'\n')
 
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Maps positions within UniProt sequences to the residues of PDB chains.
+
+The sequence of each chain is read from its ATOM records and aligned to
+the protein sequence of the FASTA database. Chains which match the protein
+well enough are kept, together with the residue (resid, resname) at each
+sequence position. The maps are stored in the coordinate cache of pdb_cache,
+keyed on the structure file and the protein sequence, so each chain is
+aligned only once.
+"""
+import difflib
+import hashlib
+import numpy as np
+
+import pdb_cache
+
+
+three_to_one = {
+    'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D', 'CYS': 'C', 'GLN': 'Q', 'GLU': 'E', 'GLY': 'G',
+    'HIS': 'H', 'ILE': 'I', 'LEU': 'L', 'LYS': 'K', 'MET': 'M', 'PHE': 'F', 'PRO': 'P', 'SER': 'S',
+    'THR': 'T', 'TRP': 'W', 'TYR': 'Y', 'VAL': 'V', 'MSE': 'M', 'SEC': 'U', 'PYL': 'O'
+}
+
+# Minimal fraction of the residues of a chain aligned to the protein
+default_min_identity = 0.8
+
+# Aligned blocks shorter than this are considered as spurious
+min_block = 3
+
+# Changes invalidate the cached maps
+map_version = '1'
+
+
+def chain_residues(store):
+    """
+    Returns a dictionary of each chain (segid) of the store to the list of
+    its residues (resid, resname) in the order of the ATOM records.
+    """
+    vocabularies = store.vocabularies
+    n_resids = len(vocabularies['resid'])
+    n_resnames = len(vocabularies['resname'])
+    composite = (store.codes['segid'].astype(np.int64) * n_resids + store.codes['resid']) * n_resnames + \
+        store.codes['resname']
+    (unique, first) = np.unique(composite, return_index=True)
+    unique = unique[np.argsort(first, kind='stable')]
+    chains = {}
+    for code in unique.tolist():
+        (rest, resname) = divmod(code, n_resnames)
+        (segid, resid) = divmod(rest, n_resids)
+        chains.setdefault(vocabularies['segid'][segid], []).append(
+            (vocabularies['resid'][resid], vocabularies['resname'][resname]))
+    return chains
+
+
+def align_chain(residues, sequence, min_identity=default_min_identity):
+    """
+    Aligns the residues of a chain to the protein sequence. Returns the array
+    which holds for each 1-based position of the sequence the index of the
+    aligned residue, -1 where there is none. Returns None if less than
+    min_identity of the residues could be aligned.
+    """
+    chain_sequence = ''.join([three_to_one.get(resname, 'X') for (_, resname) in residues])
+    if not chain_sequence:
+        return None
+    matcher = difflib.SequenceMatcher(None, chain_sequence, sequence, autojunk=False)
+    positions = np.full(len(sequence) + 1, -1, dtype=np.int32)
+    aligned = 0
+    for (i, j, size) in matcher.get_matching_blocks():
+        if size >= min_block:
+            positions[j + 1:j + 1 + size] = np.arange(i, i + size, dtype=np.int32)
+            aligned += size
+    if aligned < min_identity * len(chain_sequence):
+        return None
+    return positions
+
+
+def compute_map(store, sequence, min_identity=default_min_identity):
+    """
+    Aligns all chains of the store to the protein sequence. Returns the arrays
+    'chains' with the matching chains and 'resid', 'resname' with one row per
+    chain and one column per 1-based sequence position, empty where a
+    position has no residue.
+    """
+    chains = []
+    resids = []
+    resnames = []
+    for (segid, residues) in chain_residues(store).items():
+        positions = align_chain(residues, sequence, min_identity)
+        if positions is None:
+            continue
+        residues = residues + [('', '')]
+        chains.append(segid)
+        resids.append([residues[k][0] for k in positions.tolist()])
+        resnames.append([residues[k][1] for k in positions.tolist()])
+    shape = (len(chains), len(sequence) + 1)
+    return {
+        'chains': np.array(chains, dtype=str),
+        'resid': np.array(resids, dtype=str).reshape(shape),
+        'resname': np.array(resnames, dtype=str).reshape(shape)
+    }
+
+
+def residue_map(filename, store, sequence, min_identity=default_min_identity, cache_options=None):
+    """
+    The map of compute_map for the structure file, whose atoms are in the
+    store, taken from the cache if cache_options are given.
+    """
+    if cache_options is None:
+        return compute_map(store, sequence, min_identity)
+    extra = 'residue_map\0{}\0{}\0{}'.format(map_version, min_identity,
+                                             hashlib.sha1(sequence.encode('ascii')).hexdigest())
+    return pdb_cache.cached_arrays(filename, lambda _: compute_map(store, sequence, min_identity),
+                                   extra=extra, **cache_options)
+
+
+def anchor_rows(store, residue_map, atomname):
+    """
+    Returns the array of the rows of the store holding the atom atomname of
+    the residue at each position of the map, shaped like the map and -1 where
+    the position has no residue or the residue lacks the atom. Atoms occurring
+    several times, e.g. alternate locations, are taken from their last
+    occurrence, as in the pair mode of pdb_calc_euclidean.
+    """
+    shape = residue_map['resid'].shape
+    keys = [(resid, resname, atomname, segid)
+            for (segid, resids, resnames) in zip(residue_map['chains'].tolist(), residue_map['resid'].tolist(),
+                                                  residue_map['resname'].tolist())
+            for (resid, resname) in zip(resids, resnames)]
+    return store.lookup(keys, last=True).reshape(shape)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent index of a SIFTS mapping table between UniProt and PDB.
+
+The mapping table is the tab separated pdb_chain_uniprot file of SIFTS
+(optionally gzip compressed), with one line for each segment of a UniProt
+sequence observed in a PDB chain:
+
+    PDB  CHAIN  SP_PRIMARY  RES_BEG  RES_END  PDB_BEG  PDB_END  SP_BEG  SP_END
+
+It is compiled once into a SQLite sidecar file next to the table, with an
+index on the accession, and rebuilt automatically once the table changes.
+If the directory of the table is not writable, for instance a shared
+database mount, the index is kept in a user cache directory instead, and
+if that is not writable either, it is built in memory for each run.
+"""
+import collections
+import gzip
+import hashlib
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+
+index_suffix = '.xlmap'
+
+default_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))),
+                                 'xlink_scripts', 'sifts')
+
+# Segments inserted at once while building the index
+insert_batch_size = 10000
+
+Segment = collections.namedtuple('Segment', ['accession', 'pdb', 'chain', 'res_beg', 'res_end',
+                                             'pdb_beg', 'pdb_end', 'sp_beg', 'sp_end'])
+
+columns = ('PDB', 'CHAIN', 'SP_PRIMARY', 'RES_BEG', 'RES_END', 'PDB_BEG', 'PDB_END', 'SP_BEG', 'SP_END')
+
+re_isoform = re.compile(r'-[0-9]+$')
+
+
+def index_path(mapping_path, directory=None):
+    """
+    Path of the index. By default it is next to the mapping table, within
+    directory it is named after the absolute path of the table.
+    """
+    if directory is None:
+        return mapping_path + index_suffix
+    return os.path.join(directory, hashlib.sha1(os.path.abspath(mapping_path).encode('utf-8')).hexdigest()) + \
+        index_suffix
+
+
+def mapping_stamp(mapping_path):
+    """
+    Size and modification time of the mapping table, which identify its version.
+    """
+    stat = os.stat(mapping_path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def open_mapping(mapping_path):
+    if mapping_path.endswith('.gz'):
+        return gzip.open(mapping_path, 'rt')
+    return open(mapping_path, 'r')
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def to_residue(value):
+    """
+    Residue numbers of the PDB may carry an insertion code and are kept as
+    strings, missing numbers ('None') become None.
+    """
+    return None if value in ('', 'None') else value
+
+
+def generate_segments(mapping_path):
+    """
+    Generates a tuple in the order of Segment for each line of the mapping table.
+    """
+    with open_mapping(mapping_path) as f:
+        positions = None
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            if positions is None:
+                try:
+                    positions = [fields.index(column) for column in columns]
+                except ValueError:
+                    raise ValueError("Mapping table {} lacks the header {}".format(mapping_path, '\t'.join(columns)))
+                continue
+            (pdb, chain, accession, res_beg, res_end, pdb_beg, pdb_end, sp_beg, sp_end) = \
+                [fields[i] for i in positions]
+            yield (accession, pdb.lower(), chain, to_int(res_beg), to_int(res_end),
+                   to_residue(pdb_beg), to_residue(pdb_end), to_int(sp_beg), to_int(sp_end))
+
+
+def fill_index(connection, mapping_path):
+    """
+    Creates the tables of the index in the SQLite connection and inserts the
+    segments of the mapping table, see generate_segments.
+    """
+    (size, mtime) = mapping_stamp(mapping_path)
+    connection.executescript('''
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        CREATE TABLE meta (size INTEGER, mtime INTEGER);
+        CREATE TABLE segments (accession TEXT, pdb TEXT, chain TEXT, res_beg INTEGER, res_end INTEGER,
+                               pdb_beg TEXT, pdb_end TEXT, sp_beg INTEGER, sp_end INTEGER);
+    ''')
+    segments = generate_segments(mapping_path)
+    while True:
+        batch = [segment for (_, segment) in zip(range(insert_batch_size), segments)]
+        if not batch:
+            break
+        connection.executemany('INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+    # Creating the index after all inserts is much faster than maintaining it
+    connection.execute('CREATE INDEX segments_accession ON segments (accession)')
+    connection.execute('INSERT INTO meta VALUES (?, ?)', (size, mtime))
+    connection.commit()
+
+
+def build_index(mapping_path, directory=None):
+    """
+    Builds the index of the mapping table, next to it or within directory,
+    into a temporary file, which is then moved into place.
+    """
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(mapping_path))
+        target = None
+    else:
+        os.makedirs(directory, exist_ok=True)
+        target = directory
+    umask = os.umask(0)
+    os.umask(umask)
+    (fd, tmp_index) = tempfile.mkstemp(prefix='.', suffix=index_suffix, dir=directory)
+    os.close(fd)
+    try:
+        connection = sqlite3.connect(tmp_index)
+        try:
+            fill_index(connection, mapping_path)
+        finally:
+            connection.close()
+
+        # mkstemp creates files which are only accessible by the owner
+        os.chmod(tmp_index, 0o666 & ~umask)
+        os.replace(tmp_index, index_path(mapping_path, target))
+    finally:
+        if os.path.exists(tmp_index):
+            os.remove(tmp_index)
+
+
+def is_current(mapping_path, directory=None):
+    """
+    Whether the index of the mapping table exists and matches its current version.
+    """
+    path = index_path(mapping_path, directory)
+    if not os.path.isfile(path):
+        return False
+    try:
+        connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+        try:
+            meta = connection.execute('SELECT size, mtime FROM meta').fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return False
+    return meta is not None and tuple(meta) == mapping_stamp(mapping_path)
+
+
+class SiftsIndex(object):
+    """
+    Read-only access to the segments of a SIFTS mapping table through its
+    index, which is (re)built first if necessary. The index is looked up and
+    built next to the mapping table first, then within cache_dir, and built
+    in memory if neither is writable.
+    """
+    def __init__(self, mapping_path, cache_dir=default_cache_dir):
+        self.mapping_path = mapping_path
+        directories = [None, cache_dir]
+        current = [directory for directory in directories if is_current(mapping_path, directory)]
+        # False stands for the index in memory
+        directory = current[0] if current else False
+        if not current:
+            for candidate in directories:
+                try:
+                    build_index(mapping_path, candidate)
+                    directory = candidate
+                    break
+                except (OSError, sqlite3.Error) as e:
+                    sys.stderr.write("WARNING: Could not write index of {} to {}: {}\n".format(
+                        mapping_path, os.path.dirname(os.path.abspath(index_path(mapping_path, candidate))), e))
+        if directory is False:
+            sys.stderr.write("WARNING: Building the index of {} in memory\n".format(mapping_path))
+            self.connection = sqlite3.connect(':memory:')
+            fill_index(self.connection, mapping_path)
+            return
+        self.connection = sqlite3.connect('file:{}?mode=ro'.format(index_path(mapping_path, directory)), uri=True)
+
+    def __contains__(self, accession):
+        return self.connection.execute('SELECT 1 FROM segments WHERE accession = ? LIMIT 1',
+                                       (accession,)).fetchone() is not None
+
+    def segments(self, accession):
+        """
+        Returns the list of Segments of the UniProt accession, ordered by PDB
+        entry, chain and position. An isoform accession (P12345-2) without
+        segments of its own falls back to the canonical sequence.
+        """
+        rows = self.connection.execute(
+            'SELECT * FROM segments WHERE accession = ? ORDER BY pdb, chain, sp_beg', (accession,)).fetchall()
+        if not rows and re_isoform.search(accession):
+            return self.segments(re_isoform.sub('', accession))
+        return [Segment(*row) for row in rows]
+
+    def close(self):
+        self.connection.close()
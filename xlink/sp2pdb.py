@@ -6,22 +6,112 @@ Created on Mon Mar 13 19:32:07 2017
 Translates swissprot (sp) identifier within a FASTA file into PDB
 accessions and also allows downloading them into a directory
 
+The translation uses a local SIFTS mapping table (pdb_chain_uniprot.tsv.gz),
+which is compiled into an index on the first use. For each accession, all
+PDB chains covering a segment of its sequence are written as tab separated
+rows:
+
+    accession  pdb  chain  sp_beg  sp_end  pdb_beg  pdb_end
+
 @author: lzimmermann
 """
 import argparse
+import os
 import sys
 
+from sifts_index import SiftsIndex
+import structure_download
+
+
+output_header = ['accession', 'pdb', 'chain', 'sp_beg', 'sp_end', 'pdb_beg', 'pdb_end']
+
+
+def fasta_accession(header):
+    """
+    Accession of a FASTA header line, which is the second field of UniProt
+    headers (>sp|P12345|NAME_HUMAN ...) and the first word otherwise.
+    """
+    fields = header[1:].split()
+    if not fields:
+        return ''
+    word = fields[0]
+    parts = word.split('|')
+    if len(parts) >= 2 and parts[0] in ('sp', 'tr'):
+        return parts[1]
+    return word
+
+
+def generate_accessions(fasta_path):
+    with open(fasta_path, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                yield fasta_accession(line)
+
+
+def format_value(value):
+    return '' if value is None else str(value)
 
 
 def main(argv):
-    
-    parser = argparse.ArgumentParser()
-    parser.add_argument("IN", type=str)
+
+    parser = argparse.ArgumentParser(description="Translates the UniProt accessions of a FASTA file into PDB chains")
+    parser.add_argument("IN", type=str, help="FASTA file with the UniProt accessions")
+    parser.add_argument('-s', metavar="SIFTS", type=str, required=True,
+                        help="SIFTS mapping table pdb_chain_uniprot.tsv(.gz)")
+    parser.add_argument('-o', metavar="OUT", type=str, help="Output file of the mapping. Defaults to stdout")
+    parser.add_argument('-d', metavar="DIR", type=str, help="Download the mapped structures into this directory")
+    parser.add_argument('-f', metavar="FORMAT", type=str, default='cif', choices=sorted(structure_download.extensions),
+                        help="Format of the downloaded structures")
+    parser.add_argument('-j', '--jobs', metavar="N", type=int, default=structure_download.default_connections,
+                        help="Maximum number of concurrent downloads")
+    parser.add_argument('--retries', metavar="N", type=int, default=structure_download.default_retries,
+                        help="Retries of a failed download")
+    parser.add_argument('--cache-dir', dest='cache_dir', metavar="DIR", type=str,
+                        default=structure_download.default_cache_dir, help="Directory of the download cache")
+    parser.add_argument('--url', metavar="TEMPLATE", type=str, default=structure_download.default_url,
+                        help="URL of the structures, with the fields {name} and {extension}")
     args = parser.parse_args(argv[1:])
-    
-    
 
+    for path in (args.IN, args.s):
+        if not os.path.isfile(path):
+            sys.stderr.write("ERROR: File: {} does not exist.\n".format(path))
+            sys.exit(1)
+
+    if args.jobs < 1:
+        sys.stderr.write("ERROR: The number of jobs has to be at least 1\n")
+        sys.exit(2)
+
+    sifts = SiftsIndex(args.s)
+    out = sys.stdout if args.o is None else open(args.o, 'w')
+    pdbs = []
+    unmapped = 0
+    try:
+        out.write('\t'.join(output_header) + '\n')
+        for accession in dict.fromkeys(generate_accessions(args.IN)):
+            segments = sifts.segments(accession)
+            if not segments:
+                unmapped += 1
+            for segment in segments:
+                out.write('\t'.join([accession, segment.pdb, segment.chain] +
+                                    [format_value(v) for v in (segment.sp_beg, segment.sp_end,
+                                                               segment.pdb_beg, segment.pdb_end)]) + '\n')
+                pdbs.append(segment.pdb)
+    finally:
+        sifts.close()
+        if out is not sys.stdout:
+            out.close()
+    if unmapped:
+        sys.stderr.write("WARNING: {} accessions have no PDB structure\n".format(unmapped))
+
+    if args.d is not None:
+        results = structure_download.download(pdbs, args.d, args.f, args.url, args.cache_dir,
+                                              args.jobs, args.retries)
+        failed = [(name, error) for (name, error) in results.items() if isinstance(error, BaseException)]
+        for (name, error) in failed:
+            sys.stderr.write("ERROR: Download of {} failed: {}\n".format(name, error))
+        if failed:
+            sys.exit(3)
 
 
 if __name__ == '__main__':
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Concurrent download of structure files into a content-addressed cache.
+
+Downloads run as asyncio tasks on a bounded pool of worker threads, so at
+most `connections` requests are open at once. Failed requests are retried
+with exponential backoff. Each file is streamed into a temporary file of the
+cache and then stored under the SHA-256 of its content, and the URL refers
+to this object, so a URL is only downloaded once and identical files are
+only stored once. Files are hard linked from the cache into the output
+directory where possible.
+"""
+import asyncio
+import concurrent.futures
+import hashlib
+import http.client
+import os
+import shutil
+import socket
+import tempfile
+import urllib.error
+import urllib.request
+
+
+default_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))),
+                                 'xlink_scripts', 'downloads')
+default_url = 'https://files.rcsb.org/download/{name}.{extension}'
+
+# File extension of each format offered by the download server
+extensions = {'cif': 'cif.gz', 'pdb': 'pdb.gz'}
+
+default_connections = 8
+default_retries = 3
+default_timeout = 60  # s
+chunk_size = 1 << 20
+backoff = 0.5  # s, doubled for each retry
+
+# HTTP status codes worth retrying
+transient_status = {408, 429, 500, 502, 503, 504}
+
+# Errors of the connection worth retrying, including truncated responses
+network_errors = (ConnectionError, TimeoutError, socket.timeout, socket.gaierror, http.client.HTTPException)
+
+
+class ContentCache(object):
+    """
+    Directory with the downloaded files in objects/, named by the SHA-256 of
+    their content, and a reference from each URL to its object in refs/.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        for sub in ('objects', 'refs', 'tmp'):
+            os.makedirs(os.path.join(cache_dir, sub), exist_ok=True)
+
+    def object_path(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest[2:])
+
+    def ref_path(self, url):
+        return os.path.join(self.cache_dir, 'refs', hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def tmp_file(self):
+        """
+        Creates a temporary file within the cache, returns its file descriptor and path.
+        """
+        return tempfile.mkstemp(dir=os.path.join(self.cache_dir, 'tmp'))
+
+    def store(self, tmp, path):
+        """
+        Moves the temporary file to path.
+        """
+        umask = os.umask(0)
+        os.umask(umask)
+        # mkstemp creates files which are only accessible by the owner
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, path)
+
+    def get(self, url):
+        """
+        Path of the cached object of the URL, None if it has not been downloaded.
+        """
+        try:
+            with open(self.ref_path(url), 'r') as f:
+                path = self.object_path(f.read().strip())
+        except OSError:
+            return None
+        return path if os.path.isfile(path) else None
+
+    def put_file(self, url, tmp, digest):
+        """
+        Stores the temporary file with the content downloaded from the URL,
+        whose SHA-256 is digest, and returns the path of its object.
+        """
+        path = self.object_path(digest)
+        if os.path.isfile(path):
+            os.remove(tmp)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.store(tmp, path)
+        (fd, tmp_ref) = self.tmp_file()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(digest)
+            self.store(tmp_ref, self.ref_path(url))
+        finally:
+            if os.path.exists(tmp_ref):
+                os.remove(tmp_ref)
+        return path
+
+
+def fetch_url(cache, url, timeout):
+    """
+    Downloads the URL into the cache, streaming the content into a temporary
+    file, and returns the path of its object.
+    """
+    (fd, tmp) = cache.tmp_file()
+    try:
+        digest = hashlib.sha256()
+        with os.fdopen(fd, 'wb') as f:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                for chunk in iter(lambda: response.read(chunk_size), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+        return cache.put_file(url, tmp, digest.hexdigest())
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def is_transient(error):
+    """
+    Whether the request may succeed when retried. Local errors, e.g. of
+    writing the cache, fail at once.
+    """
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in transient_status
+    if isinstance(error, urllib.error.URLError):
+        error = error.reason
+    return isinstance(error, network_errors)
+
+
+async def fetch(loop, pool, cache, url, retries, timeout):
+    """
+    Returns the path of the cached object of the URL, downloading it first if necessary.
+    """
+    path = cache.get(url)
+    if path is not None:
+        return path
+    for attempt in range(retries + 1):
+        try:
+            return await loop.run_in_executor(pool, fetch_url, cache, url, timeout)
+        except Exception as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            await asyncio.sleep(backoff * 2 ** attempt)
+
+
+def link(source, target):
+    """
+    Hard links the cached object to target, or copies it if linking is not possible.
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+async def download_all(names, url, output_dir, cache, connections, retries, timeout, extension):
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as pool:
+        urls = [url.format(name=name, extension=extension) for name in names]
+        paths = await asyncio.gather(*[fetch(loop, pool, cache, u, retries, timeout) for u in urls],
+                                     return_exceptions=True)
+    results = {}
+    for (name, path) in zip(names, paths):
+        if not isinstance(path, BaseException):
+            target = os.path.join(output_dir, '{}.{}'.format(name, extension))
+            try:
+                link(path, target)
+                path = target
+            except OSError as e:
+                path = e
+        results[name] = path
+    return results
+
+
+def download(names, output_dir, file_format='cif', url=default_url, cache_dir=default_cache_dir,
+             connections=default_connections, retries=default_retries, timeout=default_timeout):
+    """
+    Downloads the structures of the PDB entries in names into output_dir.
+    url is a template with the fields {name} and {extension}. Returns a
+    dictionary of each name to the path of its file, or to the exception
+    if the download failed.
+    """
+    names = list(dict.fromkeys(names))
+    os.makedirs(output_dir, exist_ok=True)
+    cache = ContentCache(cache_dir)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(download_all(names, url, output_dir, cache, connections, retries,
+                                                    timeout, extensions[file_format]))
+    finally:
+        loop.close()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming readers for the atom records of structure files.
+
+Supports the legacy fixed-column PDB format and mmCIF, both optionally
+gzip-compressed. Files are read line by line, so only the current line is
+held in memory. All readers generate the same atom records:
+
+    {'model', 'resid', 'segid', 'resname', 'atomname', 'x', 'y', 'z'}
+
+If a container of atom keys (resid, resname, atomname, segid) is given,
+records of other atoms are dropped before their coordinates are parsed.
+"""
+import gzip
+import re
+
+
+# Accepted file extensions, each also with a trailing .gz
+extensions_pdb = ('pdb', 'ent')
+extensions_cif = ('cif', 'mmcif')
+extensions = tuple(extension + suffix
+                   for extension in extensions_pdb + extensions_cif for suffix in ('', '.gz'))
+
+
+def extract(segment, t):
+    def from_line(line):
+        if isinstance(segment, tuple):
+            return t(line[segment[0]-1:segment[1]].strip())
+        else:
+            return t(line[segment-1].strip())
+    return from_line
+# Line extractors for legacy pdb format for particular fields
+record_atom_resid = extract((23, 26), str)
+record_atom_segid = extract(22, str)
+record_atom_resname = extract((18, 20), str)
+record_atom_name = extract((13, 16), str)
+record_atom_x = extract((31, 38), float)
+record_atom_y = extract((39, 46), float)
+record_atom_z = extract((47, 54), float)
+
+
+def open_structure(filename):
+    """
+    Opens the structure file for reading text, decompressing gzip files on the fly.
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt')
+    return open(filename, 'r')
+
+
+def structure_format(filename):
+    """
+    Returns 'pdb' or 'cif' depending on the extension of filename, None if unknown.
+    """
+    if filename.endswith('.gz'):
+        filename = filename[:-len('.gz')]
+    extension = filename.split('.')[-1].lower()
+    if extension in extensions_pdb:
+        return 'pdb'
+    if extension in extensions_cif:
+        return 'cif'
+    return None
+
+
+def generate_atoms_pdb(handle, atoms=None):
+    """
+    Generates the atom records of the lines of a legacy PDB file.
+    """
+    model = '1'
+    for line in handle:
+        if line.startswith("ATOM"):
+            resid = record_atom_resid(line)
+            resname = record_atom_resname(line)
+            atomname = record_atom_name(line)
+            segid = record_atom_segid(line)
+            if atoms is not None and (resid, resname, atomname, segid) not in atoms:
+                continue
+            yield {
+                'model':    model,
+                'resid':    resid,
+                'segid':    segid,
+                'resname':  resname,
+                'atomname': atomname,
+                'x': record_atom_x(line),
+                'y': record_atom_y(line),
+                'z': record_atom_z(line)
+              }
+        elif line.startswith("MODEL"):
+            model = line[10:14].strip() or model
+
+
+# Tokens of a mmCIF data line, either quoted or delimited by whitespace
+re_cif_token = re.compile(r"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)""")
+
+
+def tokenize_cif(line):
+    if "'" not in line and '"' not in line:
+        return line.split()
+    return [single or double or bare for (single, double, bare) in re_cif_token.findall(line)]
+
+
+def atom_site_columns(fields):
+    """
+    Maps the attributes of the atom records to the columns of the _atom_site loop.
+    """
+    def column(*names):
+        for name in names:
+            if name in fields:
+                return fields.index(name)
+        raise ValueError("mmCIF _atom_site loop lacks the field " + names[0])
+    return {
+        'group':    column('group_PDB'),
+        'model':    fields.index('pdbx_PDB_model_num') if 'pdbx_PDB_model_num' in fields else None,
+        'resid':    column('auth_seq_id', 'label_seq_id'),
+        'resname':  column('auth_comp_id', 'label_comp_id'),
+        'atomname': column('auth_atom_id', 'label_atom_id'),
+        'segid':    column('auth_asym_id', 'label_asym_id'),
+        'x': column('Cartn_x'),
+        'y': column('Cartn_y'),
+        'z': column('Cartn_z')
+      }
+
+
+def generate_atoms_cif(handle, atoms=None):
+    """
+    Generates the atom records of the _atom_site loop of a mmCIF file.
+
+    The author provided residue numbers, names and chain identifiers are
+    used if present, as these are the ones which also appear in PDB files.
+    """
+    state = None  # 'header' within the field names of a loop, 'data' within the _atom_site rows
+    fields = []
+    tokens = []
+    for line in handle:
+        if state == 'header':
+            if line.startswith('_atom_site.'):
+                fields.append(line.split()[0][len('_atom_site.'):])
+                continue
+            if fields and not line.startswith('_'):
+                c = atom_site_columns(fields)
+                state = 'data'
+            else:
+                state = None
+
+        if state == 'data':
+            if line.startswith(('_', 'loop_', 'data_', '#')):
+                state = None
+            else:
+                tokens.extend(tokenize_cif(line))
+                # Rows might be wrapped over multiple lines
+                if len(tokens) < len(fields):
+                    continue
+                (row, tokens) = (tokens, [])
+                if row[c['group']] != 'ATOM':
+                    continue
+                key = (row[c['resid']], row[c['resname']], row[c['atomname']], row[c['segid']])
+                if atoms is not None and key not in atoms:
+                    continue
+                yield {
+                    'model':    row[c['model']] if c['model'] is not None else '1',
+                    'resid':    key[0],
+                    'segid':    key[3],
+                    'resname':  key[1],
+                    'atomname': key[2],
+                    'x': float(row[c['x']]),
+                    'y': float(row[c['y']]),
+                    'z': float(row[c['z']])
+                  }
+                continue
+
+        if line.startswith('loop_'):
+            state = 'header'
+            fields = []
+
+
+def generate_atoms(filename, atoms=None):
+    """
+    Generates the atom records of the structure file, see the module docstring.
+    """
+    reader = generate_atoms_cif if structure_format(filename) == 'cif' else generate_atoms_pdb
+    with open_structure(filename) as handle:
+        for atom in reader(handle, atoms):
+            yield atom
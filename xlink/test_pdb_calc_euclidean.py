@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the distance modes of pdb_calc_euclidean on a small structure
+with alternate locations.
+"""
+import contextlib
+import io
+import math
+import os
+import tempfile
+import unittest
+
+import pdb_calc_euclidean
+
+
+# Residues of chain A with the coordinates of their CA, LYS 2 has two alternate locations
+residues = [('1', 'MET', ' ', (0.0, 0.0, 0.0)),
+            ('2', 'LYS', 'A', (3.8, 0.0, 0.0)),
+            ('2', 'LYS', 'B', (3.8, 2.0, 1.0)),
+            ('3', 'VAL', ' ', (7.6, 0.0, 0.0)),
+            ('4', 'LEU', ' ', (11.4, 0.0, 0.0)),
+            ('5', 'ALA', ' ', (15.2, 0.0, 0.0)),
+            ('6', 'GLY', ' ', (19.0, 0.0, 0.0))]
+
+
+class PdbCalcEuclideanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.pdb = self.write('structure.pdb', ''.join(
+            "ATOM  {:5d}  CA {}{:3s} A{:>4s}    {:8.3f}{:8.3f}{:8.3f}  1.00  0.00           C\n".format(
+                serial, altloc, resname, resid, *coords)
+            for (serial, (resid, resname, altloc, coords)) in enumerate(residues, 1)) + "END\n")
+        self.fasta = self.write('proteins.fasta', '>P1\nMKVLAG\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def run_main(self, *args):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            pdb_calc_euclidean.main(['pdb_calc_euclidean.py', self.pdb] + list(args) + ['--no-cache'])
+        return [line.split(',') for line in out.getvalue().splitlines()]
+
+    def test_altlocs_agree_in_both_modes(self):
+        pairs = self.write('pairs.csv', '2,LYS,CA,A,5,ALA,CA,A\n')
+        xlinks = self.write('xlinks.csv', 'Id,Protein1,Protein2,AbsPos1,AbsPos2\nK2-A5,P1,P1,2,5\n')
+        pair_distance = float(self.run_main(pairs)[0][-1])
+        xlink_distance = float(self.run_main(xlinks, '--fasta', self.fasta)[1][-1])
+        self.assertEqual(pair_distance, xlink_distance)
+        # The last alternate location wins
+        self.assertAlmostEqual(pair_distance, math.sqrt(11.4 ** 2 + 2.0 ** 2 + 1.0 ** 2), places=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
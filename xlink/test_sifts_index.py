@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the locations of the SIFTS index when the directory of the
+mapping table is not writable.
+"""
+import os
+import tempfile
+import unittest
+
+import sifts_index
+
+
+class SiftsIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mapping = os.path.join(self.tmp.name, 'pdb_chain_uniprot.tsv')
+        with open(self.mapping, 'w') as f:
+            f.write('# SIFTS\nPDB\tCHAIN\tSP_PRIMARY\tRES_BEG\tRES_END\tPDB_BEG\tPDB_END\tSP_BEG\tSP_END\n')
+            f.write('1ABC\tA\tP12345\t1\t3\t1\t3\t1\t3\n')
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+        # A directory in place of the index cannot be replaced, even by root
+        os.makedirs(sifts_index.index_path(self.mapping))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def segments(self):
+        index = sifts_index.SiftsIndex(self.mapping, self.cache_dir)
+        try:
+            return index.segments('P12345')
+        finally:
+            index.close()
+
+    def test_falls_back_to_cache_dir(self):
+        self.assertEqual([(s.pdb, s.chain) for s in self.segments()], [('1abc', 'A')])
+        self.assertTrue(sifts_index.is_current(self.mapping, self.cache_dir))
+        # The index within the cache is reused
+        self.assertEqual([(s.pdb, s.chain) for s in self.segments()], [('1abc', 'A')])
+
+    def test_falls_back_to_memory(self):
+        with open(self.cache_dir, 'w'):
+            pass
+        self.assertEqual([(s.pdb, s.chain) for s in self.segments()], [('1abc', 'A')])
+        self.assertFalse(sifts_index.is_current(self.mapping, self.cache_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of structure_download and the download mode of sp2pdb against a
+local HTTP server standing in for the structure server.
+"""
+import collections
+import hashlib
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+import urllib.error
+
+import sp2pdb
+import structure_download
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers each path with the scripted responses (status, body) of the
+    server in order, repeating the last one, and counts the requests.
+    """
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits[self.path] += 1
+            responses = self.server.responses.get(self.path, [(404, b'')])
+            (status, body) = responses[0] if len(responses) == 1 else responses.pop(0)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StructureDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.lock = threading.Lock()
+        self.server.hits = collections.Counter()
+        self.server.responses = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/{{name}}.{{extension}}'.format(self.server.server_address[1])
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+        self.output_dir = os.path.join(self.tmp.name, 'out')
+        self.backoff = structure_download.backoff
+        structure_download.backoff = 0
+
+    def tearDown(self):
+        structure_download.backoff = self.backoff
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def download(self, names, output_dir=None, retries=3):
+        return structure_download.download(names, output_dir or self.output_dir, 'cif', self.url, self.cache_dir,
+                                           connections=4, retries=retries, timeout=10)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_retries_on_503(self):
+        self.server.responses['/1abc.cif.gz'] = [(503, b''), (503, b''), (200, b'structure 1abc')]
+        results = self.download(['1abc'])
+        self.assertEqual(self.read(results['1abc']), b'structure 1abc')
+        self.assertEqual(self.server.hits['/1abc.cif.gz'], 3)
+
+    def test_gives_up_after_retries(self):
+        self.server.responses['/1abc.cif.gz'] = [(503, b'')]
+        results = self.download(['1abc'], retries=2)
+        self.assertIsInstance(results['1abc'], urllib.error.HTTPError)
+        self.assertEqual(results['1abc'].code, 503)
+        self.assertEqual(self.server.hits['/1abc.cif.gz'], 3)
+
+    def test_no_retry_on_404(self):
+        self.server.responses['/2abc.cif.gz'] = [(200, b'structure 2abc')]
+        results = self.download(['1abc', '2abc'])
+        self.assertIsInstance(results['1abc'], urllib.error.HTTPError)
+        self.assertEqual(results['1abc'].code, 404)
+        self.assertEqual(self.server.hits['/1abc.cif.gz'], 1)
+        self.assertEqual(self.read(results['2abc']), b'structure 2abc')
+
+    def test_reuses_cache(self):
+        self.server.responses['/1abc.cif.gz'] = [(200, b'same structure')]
+        self.server.responses['/2abc.cif.gz'] = [(200, b'same structure')]
+        first = self.download(['1abc', '2abc'])
+        second = self.download(['1abc', '2abc'], os.path.join(self.tmp.name, 'out2'))
+        self.assertEqual(self.server.hits['/1abc.cif.gz'], 1)
+        self.assertEqual(self.server.hits['/2abc.cif.gz'], 1)
+        for name in ('1abc', '2abc'):
+            self.assertNotEqual(first[name], second[name])
+            self.assertEqual(self.read(second[name]), b'same structure')
+        # Identical files are stored once
+        objects = [files for (_, _, files) in os.walk(os.path.join(self.cache_dir, 'objects')) if files]
+        self.assertEqual(sum(len(files) for files in objects), 1)
+
+    def test_streams_large_file(self):
+        content = os.urandom(3 * structure_download.chunk_size + 17)
+        self.server.responses['/1abc.cif.gz'] = [(200, content)]
+        results = self.download(['1abc'])
+        self.assertEqual(self.read(results['1abc']), content)
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir, 'tmp')), [])
+
+    def test_no_retry_on_cache_error(self):
+        content = b'structure 1abc'
+        self.server.responses['/1abc.cif.gz'] = [(200, content)]
+        # A file in place of the directory of the object cannot be written to, even by root
+        objects = os.path.join(self.cache_dir, 'objects')
+        os.makedirs(objects)
+        with open(os.path.join(objects, hashlib.sha256(content).hexdigest()[:2]), 'w'):
+            pass
+        results = self.download(['1abc'])
+        self.assertIsInstance(results['1abc'], OSError)
+        self.assertNotIsInstance(results['1abc'], urllib.error.URLError)
+        self.assertEqual(self.server.hits['/1abc.cif.gz'], 1)
+
+    def test_link_failure_is_reported(self):
+        self.server.responses['/1abc.cif.gz'] = [(200, b'structure 1abc')]
+        # A directory in place of the output file cannot be replaced
+        os.makedirs(os.path.join(self.output_dir, '1abc.cif.gz'))
+        results = self.download(['1abc'])
+        self.assertIsInstance(results['1abc'], OSError)
+
+    def run_sp2pdb(self):
+        fasta = os.path.join(self.tmp.name, 'proteins.fasta')
+        with open(fasta, 'w') as f:
+            f.write('>sp|P12345|TEST_HUMAN\nMKV\n')
+        sifts = os.path.join(self.tmp.name, 'pdb_chain_uniprot.tsv')
+        with open(sifts, 'w') as f:
+            f.write('# SIFTS\nPDB\tCHAIN\tSP_PRIMARY\tRES_BEG\tRES_END\tPDB_BEG\tPDB_END\tSP_BEG\tSP_END\n')
+            f.write('1ABC\tA\tP12345\t1\t3\t1\t3\t1\t3\n')
+        sp2pdb.main(['sp2pdb.py', fasta, '-s', sifts, '-o', os.path.join(self.tmp.name, 'mapping.tsv'),
+                     '-d', self.output_dir, '--url', self.url, '--cache-dir', self.cache_dir])
+
+    def test_sp2pdb_downloads_after_503(self):
+        self.server.responses['/1abc.cif.gz'] = [(503, b''), (200, b'structure 1abc')]
+        self.run_sp2pdb()
+        self.assertEqual(self.read(os.path.join(self.output_dir, '1abc.cif.gz')), b'structure 1abc')
+        self.assertEqual(self.server.hits['/1abc.cif.gz'], 2)
+
+    def test_sp2pdb_exits_on_404(self):
+        with self.assertRaises(SystemExit) as context:
+            self.run_sp2pdb()
+        self.assertEqual(context.exception.code, 3)
+        self.assertEqual(self.server.hits['/1abc.cif.gz'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Writes search hit records into columnar files (Parquet, Arrow IPC/Feather)
+and reads them back.
+
+Records are dictionaries of attribute names to values as parsed from the
+result file. Known attributes are converted into typed columns, all other
+attributes are kept as strings. The table is written incrementally in
+row groups of batch_size records, so memory use does not grow with the input.
+
+pyarrow is only imported once a table is written.
+"""
+import itertools
+import sys
+
+
+# Output formats and the file extensions usually used for them
+columnar_formats = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+float_columns = {'score', 'fdr', 'qvalue'}
+int_columns = {'search_hit_rank', 'xprophet_f', 'decoy', 'charge'}
+int_list_columns = {'xlinkposition', 'AbsPos1', 'AbsPos2'}
+
+# Separators of the list values in the text representation
+list_separators = {'AbsPos1': '+', 'AbsPos2': '+'}
+
+batch_size = 1 << 16
+
+
+def convert_value(column, value):
+    """
+    Converts the string value of the attribute into the type of its column.
+    Empty values become None.
+    """
+    if value is None or isinstance(value, list):
+        return value
+    value = value.strip()
+    if column in int_list_columns:
+        return [int(v) for v in value.replace('+', ',').split(',') if v.strip()]
+    if not value:
+        return None
+    if column in float_columns:
+        return float(value)
+    if column in int_columns:
+        return int(value)
+    return value
+
+
+def format_value(column, value):
+    """
+    Inverse of convert_value, converts the typed value back into a string.
+    Floats are written in their shortest representation, which may differ
+    from the text of the original result file (24.850 becomes 24.85).
+    """
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return list_separators.get(column, ',').join([str(v) for v in value])
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def column_type(pa, column):
+    if column in float_columns:
+        return pa.float64()
+    if column in int_columns:
+        return pa.int64()
+    if column in int_list_columns:
+        return pa.list_(pa.int64())
+    return pa.string()
+
+
+def schema_of(pa, records):
+    """
+    Schema with one column for each attribute occurring in records,
+    in the order of first occurrence.
+    """
+    columns = {}
+    for record in records:
+        for column in record:
+            columns.setdefault(column, None)
+    return pa.schema([pa.field(column, column_type(pa, column)) for column in columns])
+
+
+def write_table(records, path, output_format):
+    """
+    Writes the records into the columnar file at path. The schema is derived
+    from the first batch of records. Attributes first occurring later are dropped.
+    Returns the number of records written.
+    """
+    import pyarrow as pa
+
+    records = iter(records)
+    writer = None
+    dropped = set()
+    n_records = 0
+    try:
+        for batch in iter(lambda: list(itertools.islice(records, batch_size)), []):
+            if writer is None:
+                schema = schema_of(pa, batch)
+                if output_format == 'parquet':
+                    import pyarrow.parquet as pq
+                    writer = pq.ParquetWriter(path, schema)
+                else:
+                    writer = pa.ipc.new_file(path, schema)
+            for record in batch:
+                dropped.update(column for column in record if column not in schema.names)
+            table = pa.Table.from_arrays(
+                [pa.array([convert_value(field.name, record.get(field.name)) for record in batch], type=field.type)
+                 for field in schema], schema=schema)
+            writer.write_table(table)
+            n_records += len(batch)
+        if writer is None:
+            # No records at all, still produces a valid file
+            empty = pa.schema([])
+            if output_format == 'parquet':
+                import pyarrow.parquet as pq
+                pq.write_table(empty.empty_table(), path)
+            else:
+                writer = pa.ipc.new_file(path, empty)
+    finally:
+        if writer is not None:
+            writer.close()
+    if dropped:
+        sys.stderr.write("WARNING: Attributes not in the first {} search hits were dropped: {}\n".format(
+            batch_size, ', '.join(sorted(dropped))))
+    return n_records
+
+
+def read_table(path, input_format):
+    """
+    Generates the records of the columnar file at path, one row group or
+    record batch at a time. All values are converted back into strings.
+    """
+    import pyarrow as pa
+
+    if input_format == 'parquet':
+        import pyarrow.parquet as pq
+        batches = pq.ParquetFile(path).iter_batches()
+    else:
+        reader = pa.ipc.open_file(path)
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    for batch in batches:
+        for record in batch.to_pylist():
+            yield {column: format_value(column, value) for (column, value) in record.items()}
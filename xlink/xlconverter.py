@@ -11,77 +11,123 @@ Converts output files with Cross-Link information in different file formats
 import argparse
 import os
 import sys
-import re
-from Bio import SeqIO
+import io
+import itertools
+import functools
+import multiprocessing
+import sqlite3
 
+from fasta_index import FastaIndex, build_index, default_cache_dir
+from xquest_parser import detect_format, generate_spectra, split_spectra
+from xlcolumnar import columnar_formats, write_table
 
-def getAttFromLine(line):
+
+# Bytes of the input converted at once by a worker in the --jobs mode
+range_size = 1 << 26
+
+# Shared with the worker processes by the pool initializer
+_worker_state = {}
+
+
+def find_peptide(pep_seq, prot_seq):
     """
-    Returns a dictionary with key value pairs from a line with XML markup
+    Returns the start positions of the non-overlapping occurrences
+    of the peptide within the protein sequence.
     """
-    return  {q[0]: q[1][1:-1].strip() for q in  (pair.split("=") for pair in line.split()[1:])}
+    positions = []
+    step = max(len(pep_seq), 1)
+    start = prot_seq.find(pep_seq)
+    while start != -1:
+        positions.append(start)
+        start = prot_seq.find(pep_seq, start + step)
+    return positions
 
 
-max_fdr = 1
-xprop_flagged = False
+class PeptideIndex(object):
+    """
+    Memoizes the sequences of the proteins in the database index and
+    the positions of peptides within them. Both caches are LRU caches
+    holding at most cache_size entries (unbounded if None).
+    """
+    def __init__(self, database_index, cache_size=None):
+        self.database_index = database_index
+        self.sequence = functools.lru_cache(maxsize=cache_size)(self._sequence)
+        self.positions = functools.lru_cache(maxsize=cache_size)(self._positions)
 
-def xquest2xlinkanalyzer(infile, database_index, modres):
-    global xprop_flagged
-    global max_fdr
-    
-    with open(infile, 'r') as f:
-        print("Id,Protein1,Protein2,AbsPos1,AbsPos2,score")
-        for line in f:
-            line = line.strip()
-            if line.startswith('<search_hit'):
-                d = getAttFromLine(line)
-                
-                # Ignore decoy sequences
-                if 'decoy' in d['prot1'] or 'decoy' in d['prot2']:
-                    continue          
-                                
-                # get crosslink position
-                xlpos = d['xlinkposition']
-                if xlpos.endswith('"'):
-                    xlpos = xlpos[:-1]
-                xlpos = xlpos.split(',')
-                
-                # Handle first protein
-                prot1_seq = str(database_index[d['prot1']].seq)
-                pep1_seq = d['seq1'].replace('X', modres).replace('x', modres)
-                
-                # match first peptide
-                abspos1 = '+'.join([str(m.start() + int(xlpos[0])) 
-                for m in re.finditer(pep1_seq, prot1_seq)])
-                
-                prot2 = d['prot2'].strip()
-                if prot2:
-                    prot2_seq = str(database_index[prot2].seq)
-                    pep2_seq = d['seq2'].replace('X', modres).replace('x', modres)
-                    abspos2 = '+'.join([str(m.start() + int(xlpos[1])) for m in re.finditer(pep2_seq, prot2_seq)])                    
-                else:
-                    abspos2 = '-'
-                    prot2 = '-'
-                    
-                if 'fdr' in d:
-                    fdr = float(d['fdr'])
-                else:
-                    fdr = 0
+    def _sequence(self, protein):
+        return self.database_index.sequence(protein)
 
-                if  fdr > max_fdr:
-                    continue
-                
-                # XProphet flagged
-                xprophet_f = d["xprophet_f"]
-                if xprophet_f.endswith('"'):
-                    xprophet_f = xprophet_f[:-1]
+    def _positions(self, pep_seq, protein):
+        """
+        Start positions of the peptide within the protein, see find_peptide.
+        """
+        return tuple(find_peptide(pep_seq, self.sequence(protein)))
+
+
+def absolute_positions(peptide_index, pep_seq, protein, xlpos, modres):
+    """
+    Positions of the crosslinked residue within the protein, one for
+    each occurrence of the peptide.
+    """
+    pep_seq = pep_seq.replace('X', modres).replace('x', modres)
+    return [start + int(xlpos) for start in peptide_index.positions(pep_seq, protein)]
+
+
+xlinkanalyzer_header = ['Id', 'Protein1', 'Protein2', 'AbsPos1', 'AbsPos2', 'score']
+
+def xquest2xlinkanalyzer(spectra, peptide_index, modres):
+    """
+    Generates the xlinkanalyzer rows of the search hits of the spectra.
+    """
+    for (spectrum, hits) in spectra:
+        for d in hits:
                 
-                if int(xprophet_f) == 0 and xprop_flagged:
-                    continue
-        
-                print(','.join([d['id'], d['prot1'].strip(), 
-                                prot2, abspos1, abspos2, d['score']]))
+            # Ignore decoy sequences
+            if 'decoy' in d['prot1'] or 'decoy' in d['prot2']:
+                continue          
+                            
+            # get crosslink position
+            xlpos = d['xlinkposition'].split(',')
             
+            # match first peptide
+            abspos1 = '+'.join([str(pos) for pos in
+                                absolute_positions(peptide_index, d['seq1'], d['prot1'], xlpos[0], modres)])
+            
+            prot2 = d['prot2'].strip()
+            if prot2:
+                abspos2 = '+'.join([str(pos) for pos in
+                                    absolute_positions(peptide_index, d['seq2'], prot2, xlpos[1], modres)])
+            else:
+                abspos2 = '-'
+                prot2 = '-'
+    
+            yield [d['id'], d['prot1'].strip(), 
+                   prot2, abspos1, abspos2, d['score']]
+
+
+def xquest2records(spectra, peptide_index, modres):
+    """
+    Generates a record for each search hit of the spectra, holding all of
+    its attributes, the name of the spectrum and the absolute positions
+    of the crosslink within both proteins. Decoy hits are kept.
+    """
+    for (spectrum, hits) in spectra:
+        for d in hits:
+            record = {'spectrum': spectrum.get('spectrum')}
+            record.update(d)
+            xlpos = d['xlinkposition'].split(',')
+            for (i, seq, prot) in ((0, 'seq1', 'prot1'), (1, 'seq2', 'prot2')):
+                protein = d.get(prot, '').strip()
+                try:
+                    abspos = absolute_positions(peptide_index, d[seq], protein, xlpos[i], modres) \
+                        if protein and i < len(xlpos) else []
+                except KeyError:
+                    # Protein not within the database, e.g. a decoy
+                    abspos = []
+                record['AbsPos{}'.format(i + 1)] = abspos
+            yield record
+
+
 def checkfile(filepath):
     
     if not os.path.isfile(filepath):
@@ -89,49 +135,148 @@ def checkfile(filepath):
         return False
     return True
     
-def detect_format(infile):
-    with open(infile, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith("<xquest"):
-                return "xquest"
-    return None                
-    
+xinet_header = ['Score', 'Protein1', 'LinkPos1', 'Protein2', 'LinkPos2']
+
+def xquest2xinet(spectra):
+    """
+    Generates the xinet rows of the search hits of the spectra.
+    """
+    for (spectrum, hits) in spectra:
+        for d in hits:
+            link_pos = d['xlinkposition'].split(',')
+            lpos2 = link_pos[1] if len(link_pos) == 2 else ""      
+            yield [str(float(d['score'])),
+                   d['prot1'],
+                   link_pos[0],
+                   d['prot2'],
+                   lpos2]
+
+
+def write_rows(rows, out, batch_size=10000):
+    """
+    Writes the rows as lines of comma separated values, in batches
+    of batch_size rows instead of one write per row.
+    """
+    rows = iter(rows)
+    for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+        out.write(''.join([','.join(row) + '\n' for row in batch]))
+
+
+def _init_worker(infile, output_format, database, modres, cache_size, max_fdr=1, xprop_flagged=False):
+    # Each worker holds its own read-only index of the database
+    database_index = FastaIndex(database)
+    _worker_state['infile'] = infile
+    _worker_state['output_format'] = output_format
+    _worker_state['database_index'] = database_index
+    _worker_state['peptide_index'] = PeptideIndex(database_index, cache_size)
+    _worker_state['modres'] = modres
+    _worker_state['max_fdr'] = max_fdr
+    _worker_state['xprop_flagged'] = xprop_flagged
+
+
+def convert_rows(spectra):
+    """
+    Generates the rows of the spectra in the output format of the worker,
+    records for the columnar formats.
+    """
+    if _worker_state['output_format'] == "xinet":
+        return xquest2xinet(spectra)
+    if _worker_state['output_format'] in columnar_formats:
+        return xquest2records(spectra, _worker_state['peptide_index'], _worker_state['modres'])
+    return xquest2xlinkanalyzer(spectra, _worker_state['peptide_index'], _worker_state['modres'])
+
+
+def range_columns(byte_range):
+    """
+    Collects the filter columns of the hits within the byte range of the
+    input file, see xlfilter.hit_columns.
+    """
+    from xlfilter import hit_columns
+    (start, end) = byte_range
+    return hit_columns(generate_spectra(_worker_state['infile'], start=start, end=end))
+
+
+def filtered_spectra(byte_range, mask=None, qvalues=None):
+    """
+    Generates the spectra within the byte range of the input file with only
+    the hits passing the filter: the mask of the range if given, otherwise
+    the fdr and xProphet flag of the hits, which are filtered while reading.
+    """
+    from xlfilter import apply_mask, filter_spectra
+    (start, end) = byte_range
+    spectra = generate_spectra(_worker_state['infile'], start=start, end=end)
+    if mask is not None:
+        return apply_mask(spectra, mask, qvalues)
+    return filter_spectra(spectra, _worker_state['max_fdr'], _worker_state['xprop_flagged'])
+
+
+def convert_range(task):
+    """
+    Converts the spectra within the byte range of the input file, see
+    split_spectra and filtered_spectra.
+    Returns the output as text, or as list of records for the columnar formats.
+    """
+    rows = convert_rows(filtered_spectra(*task))
+    if _worker_state['output_format'] in columnar_formats:
+        return list(rows)
+    out = io.StringIO()
+    write_rows(rows, out)
+    return out.getvalue()
+
+
+allowed_fasta_endings = ['fasta', 'fa', 'fas']
+
+def main_index(argv):
+    """
+    Pre-builds the persistent index of a FASTA database, see fasta_index.
+    """
+    parser = argparse.ArgumentParser(prog='xlconverter index')
+    parser.add_argument('DB', type=str)
+    parser.add_argument('--pack', action='store_true',
+                        help="Also store the sequences packed into a memory-mappable blob")
+    args = parser.parse_args(argv)
+
+    if not checkfile(args.DB):
+        sys.stderr.write("ERROR: Cannot continue due to previous error\n")
+        sys.exit(1)
+    if sum([ args.DB.endswith(x) for x in allowed_fasta_endings]) != 1:
+        sys.stderr.write("Unknown file ending of database. Terminating\n")
+        sys.exit(3)
+    try:
+        build_index(args.DB, args.pack)
+    except (OSError, sqlite3.Error) as e:
+        sys.stderr.write("WARNING: Could not write index next to {} ({}), writing it to {}\n".format(
+            args.DB, e, default_cache_dir))
+        try:
+            build_index(args.DB, args.pack, default_cache_dir)
+        except (OSError, sqlite3.Error) as e:
+            sys.stderr.write("ERROR: Could not write index of {}: {}\n".format(args.DB, e))
+            sys.exit(1)
+
 
-def xquest2xinet(infile, database_index):
-    global xprop_flagged
-    global max_fdr
-    
-    with open(infile, 'r') as f:
-        print('Score,Protein1,LinkPos1,Protein2,LinkPos2')   
-        for line in f:
-            line = line.strip()
-            if line.startswith('<search_hit'):
-    
-                d = getAttFromLine(line)
-                link_pos = d['xlinkposition'].split(',')
-                lpos2 = link_pos[1] if len(link_pos) == 2 else ""      
-                print(','.join([str(float(d['score'])),
-                                          d['prot1'],
-                                          link_pos[0].replace('"', ''),
-                                          d['prot2'],
-                                          lpos2.replace('"','')]))
-                
 def main(argv):
-    global max_fdr
-    global xprop_flagged
     
+    if len(argv) > 1 and argv[1] == 'index':
+        main_index(argv[2:])
+        return
     
-    allowed_output_formats = ['xinet', 'xlinkanalyzer']
-    allowed_fasta_endings = ['fasta', 'fa', 'fas']
+    allowed_output_formats = ['xinet', 'xlinkanalyzer'] + list(columnar_formats)
 
     parser = argparse.ArgumentParser()
     parser.add_argument('IN', type=str)
     parser.add_argument('-f', metavar="FORMAT", type=str, required=True)
+    parser.add_argument('-o', metavar="OUT", type=str,
+                        help="Output file, required for the columnar formats. Defaults to stdout")
     parser.add_argument('-d', metavar="DB", type=str, required=True)
     parser.add_argument('-m', metavar="MOD", type=str, required=True)
     parser.add_argument('--xproph', dest='xproph', action='store_true')
-    parser.add_argument('--fdr', metavar="FDR", type=float)
+    parser.add_argument('--fdr', metavar="FDR", type=float, default=1)
+    parser.add_argument('--recompute-fdr', dest='recompute_fdr', action='store_true',
+                        help="Filter by q-values recomputed from targets and decoys instead of the fdr of the result file")
+    parser.add_argument('--cache-size', dest='cache_size', metavar="N", type=int, default=2**16,
+                        help="Number of peptide lookups to memoize, 0 for unbounded")
+    parser.add_argument('-j', '--jobs', metavar="N", type=int, default=1,
+                        help="Number of worker processes converting parts of the input in parallel")
     
     args = parser.parse_args(argv[1:])
     
@@ -139,6 +284,10 @@ def main(argv):
         sys.stderr.write('ERROR: Output file format unknown\n')
         sys.exit(2)
     
+    if args.f in columnar_formats and args.o is None:
+        sys.stderr.write('ERROR: Output format {} requires an output file (-o)\n'.format(args.f))
+        sys.exit(2)
+    
     if not checkfile(args.IN) or not checkfile(args.d):
         sys.stderr.write("ERROR: Cannot continue due to previous error\n")
         sys.exit(1)
@@ -155,24 +304,68 @@ def main(argv):
     if len(args.m) != 1:
         sys.stderr.write("ERROR: Please specify only one character for the variable modification\n")
         sys.exit(4)
+
+    if args.jobs < 1:
+        sys.stderr.write("ERROR: Number of jobs must be positive\n")
+        sys.exit(5)
         
-    if args.fdr is not None:    
-        max_fdr = args.fdr 
-    xprop_flagged = args.xproph
+    initargs = (args.IN, args.f, args.d, args.m.upper(), args.cache_size or None, args.fdr, args.xproph)
+    if args.jobs == 1:
+        ranges = [(0, None)]
+        _init_worker(*initargs)
+    else:
+        # Splits the input into more ranges than workers to balance the load
+        # and to bound the size of the converted output of each range
+        n_ranges = max(args.jobs, os.path.getsize(args.IN) // range_size + 1)
+        ranges = split_spectra(args.IN, n_ranges)
+        # Builds the database index once, before the workers open it
+        FastaIndex(args.d).close()
+        pool = multiprocessing.Pool(processes=args.jobs, initializer=_init_worker, initargs=initargs)
 
-    # Create index of database
-    database_index = SeqIO.index(args.d, "fasta")
-   
+    if args.recompute_fdr:
+        from xlfilter import concatenate_columns, filter_mask, load_columns, store_columns
 
-    if formt == "xquest" and args.f == "xinet":
-        xquest2xinet(args.IN, database_index)
-    elif formt == "xquest" and args.f == "xlinkanalyzer":
-        xquest2xlinkanalyzer(args.IN, database_index, args.m.upper())
+        # The q-values depend on all hits, so the filter is evaluated once
+        # for all hits, then split by range again. The columns of the hits
+        # are cached next to the input for further runs
+        columns = load_columns(args.IN, ranges)
+        if columns is None:
+            columns = [range_columns(ranges[0])] if args.jobs == 1 else pool.map(range_columns, ranges)
+            store_columns(args.IN, ranges, columns)
+        (mask, qvalues) = filter_mask(concatenate_columns(columns), args.fdr, args.xproph, args.recompute_fdr)
+        bounds = list(itertools.accumulate([0] + [len(c['score']) for c in columns]))
+        tasks = [(byte_range, mask[lower:upper], qvalues[lower:upper])
+                 for (byte_range, lower, upper) in zip(ranges, bounds[:-1], bounds[1:])]
+    else:
+        tasks = [(byte_range,) for byte_range in ranges]
+    if args.jobs == 1:
+        results = [convert_rows(filtered_spectra(*tasks[0]))]
+    else:
+        results = pool.imap(convert_range, tasks)
 
+    try:
+        if args.f in columnar_formats:
+            write_table(itertools.chain.from_iterable(results), args.o, args.f)
+        else:
+            out = sys.stdout if args.o is None else open(args.o, 'w')
+            header = xinet_header if args.f == "xinet" else xlinkanalyzer_header
+            out.write(','.join(header) + '\n')
+            for result in results:
+                if args.jobs == 1:
+                    write_rows(result, out)
+                else:
+                    out.write(result)
+            if out is not sys.stdout:
+                out.close()
+    finally:
+        if args.jobs == 1:
+            _worker_state['database_index'].close()
+        else:
+            pool.close()
+            pool.join()
 
     sys.stdout.close()
     sys.stderr.close()
-    database_index.close()
         
 
 if __name__ == '__main__':
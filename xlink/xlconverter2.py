@@ -5,42 +5,235 @@ Created on Sun Apr  2 09:56:24 2017
 
 Converts files with xlink information into various formats
 
+Conversions are composed of a reader and a writer plugin, which exchange
+a stream of records, one dictionary of attributes per search hit. Every
+reader can therefore be combined with every writer. Plugins import the
+modules they depend on only once they are used, so that the startup of
+simple conversions is not slowed down by unrelated heavy dependencies.
+
+New formats are added by decorating a function with @reader or @writer.
+
 
 @author: lukas
 """
 import sys
+import os
 import argparse
-import enum
+import collections
+import itertools
 
 
+Plugin = collections.namedtuple('Plugin', ['name', 'function', 'detect', 'requires'])
 
+readers = collections.OrderedDict()
+writers = collections.OrderedDict()
 
+# Records used to determine the columns of the generic CSV output
+csv_schema_records = 1000
 
 
-def detect_format(infile_path):
-    with open(infile_path, 'r') as f:
-        for line in f:
-            if line.lstrip().startswith("<xquest"):
-                return "xquest"
-    return None                
-    
-    
-    
-    
-    
+def register(registry, name, detect=None, requires=()):
+    def decorator(function):
+        registry[name] = Plugin(name, function, detect, requires)
+        return function
+    return decorator
+
+
+def reader(name, detect=None, requires=()):
+    """
+    Registers a reader. The function is called with the input path and the
+    parsed arguments and generates the records. detect is called with the
+    input path and returns whether the file is in the format of this reader.
+    """
+    return register(readers, name, detect, requires)
+
+
+def writer(name, requires=()):
+    """
+    Registers a writer. The function is called with the records, the output
+    path (None for stdout) and the parsed arguments. requires names the
+    arguments which have to be given for this writer.
+    """
+    return register(writers, name, None, requires)
+
+
+def has_magic(path, magic):
+    with open(path, 'rb') as f:
+        return f.read(len(magic)) == magic
+
 
+def open_output(path):
+    return sys.stdout if path is None else open(path, 'w', newline='')
 
 
+def close_output(out):
+    if out is not sys.stdout:
+        out.close()
+
+
+def detect_format(infile_path):
+    """
+    Returns the name of the first reader which accepts the file, None if there is none.
+    """
+    for plugin in readers.values():
+        if plugin.detect is not None and plugin.detect(infile_path):
+            return plugin.name
+    return None
+
+
+# Readers
+
+def detect_xquest(path):
+    import xquest_parser
+    return xquest_parser.detect_format(path) == "xquest"
+
+
+@reader('xquest', detect=detect_xquest)
+def read_xquest(path, args):
+    from xquest_parser import generate_spectra
+    for (spectrum, hits) in generate_spectra(path):
+        for d in hits:
+            record = {'spectrum': spectrum.get('spectrum')}
+            record.update(d)
+            yield record
+
+
+@reader('parquet', detect=lambda path: has_magic(path, b'PAR1'))
+def read_parquet(path, args):
+    from xlcolumnar import read_table
+    return read_table(path, 'parquet')
+
+
+@reader('arrow', detect=lambda path: has_magic(path, b'ARROW1'))
+def read_arrow(path, args):
+    from xlcolumnar import read_table
+    return read_table(path, 'arrow')
+
+
+@reader('csv', detect=lambda path: path.endswith('.csv'))
+def read_csv(path, args):
+    import csv
+    with open(path, 'r', newline='') as f:
+        for record in csv.DictReader(f):
+            yield record
+
+
+# Writers
+
+@writer('csv')
+def write_csv(records, path, args):
+    """
+    Writes all attributes of the records. The columns are taken from the
+    first records, attributes first occurring later are dropped.
+    """
+    import csv
+    records = iter(records)
+    head = list(itertools.islice(records, csv_schema_records))
+    columns = collections.OrderedDict()
+    for record in head:
+        for column in record:
+            columns.setdefault(column, None)
+    out = open_output(path)
+    try:
+        csv_writer = csv.DictWriter(out, fieldnames=list(columns), extrasaction='ignore', lineterminator='\n')
+        csv_writer.writeheader()
+        csv_writer.writerows(itertools.chain(head, records))
+    finally:
+        close_output(out)
+
+
+def as_spectra(records):
+    """
+    Adapts the records to the (spectrum, hits) tuples of the xlconverter row generators.
+    """
+    return ((None, [record]) for record in records)
+
+
+@writer('xinet')
+def write_xinet(records, path, args):
+    from xlconverter import xquest2xinet, xinet_header, write_rows
+    out = open_output(path)
+    try:
+        out.write(','.join(xinet_header) + '\n')
+        write_rows(xquest2xinet(as_spectra(records)), out)
+    finally:
+        close_output(out)
+
+
+@writer('xlinkanalyzer', requires=('d', 'm'))
+def write_xlinkanalyzer(records, path, args):
+    from xlconverter import xquest2xlinkanalyzer, xlinkanalyzer_header, write_rows, PeptideIndex
+    from fasta_index import FastaIndex
+    database_index = FastaIndex(args.d)
+    out = open_output(path)
+    try:
+        out.write(','.join(xlinkanalyzer_header) + '\n')
+        write_rows(xquest2xlinkanalyzer(as_spectra(records), PeptideIndex(database_index, args.cache_size or None),
+                                        args.m.upper()), out)
+    finally:
+        close_output(out)
+        database_index.close()
+
+
+@writer('parquet', requires=('o',))
+def write_parquet(records, path, args):
+    from xlcolumnar import write_table
+    write_table(records, path, 'parquet')
+
+
+@writer('arrow', requires=('o',))
+def write_arrow(records, path, args):
+    from xlcolumnar import write_table
+    write_table(records, path, 'arrow')
 
 
 def main(argv):
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description="Converts files with xlink information into various formats")
     parser.add_argument("IN",  type=str, help="Infile to convert")
+    parser.add_argument('-f', metavar="FORMAT", type=str, required=True,
+                        help="Output format, one of: " + ', '.join(writers))
+    parser.add_argument('-i', metavar="FORMAT", type=str,
+                        help="Input format, one of: {}. Detected if omitted".format(', '.join(readers)))
+    parser.add_argument('-o', metavar="OUT", type=str, help="Output file. Defaults to stdout")
+    parser.add_argument('-d', metavar="DB", type=str, help="FASTA database of the proteins")
+    parser.add_argument('-m', metavar="MOD", type=str, help="Residue of the variable modification")
+    parser.add_argument('--cache-size', dest='cache_size', metavar="N", type=int, default=2**16,
+                        help="Number of peptide lookups to memoize, 0 for unbounded")
     args = parser.parse_args(argv[1:])
-    
-    
 
+    if not os.path.isfile(args.IN):
+        sys.stderr.write("ERROR: File: {} does not exist.\n".format(args.IN))
+        sys.exit(1)
+
+    if args.f not in writers:
+        sys.stderr.write('ERROR: Output file format unknown\n')
+        sys.exit(2)
+
+    informat = args.i if args.i is not None else detect_format(args.IN)
+    if informat is None:
+        sys.stderr.write("ERROR: Input format of xl file could not be determined\n")
+        sys.exit(2)
+    if informat not in readers:
+        sys.stderr.write('ERROR: Input file format unknown\n')
+        sys.exit(2)
+
+    for plugin in (readers[informat], writers[args.f]):
+        missing = [option for option in plugin.requires if getattr(args, option) is None]
+        if missing:
+            sys.stderr.write("ERROR: Format {} requires the options: {}\n".format(
+                plugin.name, ', '.join('-' + option for option in missing)))
+            sys.exit(3)
+
+    if args.d is not None and not os.path.isfile(args.d):
+        sys.stderr.write("ERROR: File: {} does not exist.\n".format(args.d))
+        sys.exit(1)
+
+    if args.m is not None and len(args.m) != 1:
+        sys.stderr.write("ERROR: Please specify only one character for the variable modification\n")
+        sys.exit(4)
+
+    writers[args.f].function(readers[informat].function(args.IN, args), args.o, args)
 
 
 if __name__ == '__main__':
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
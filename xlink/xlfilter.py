@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filtering of search hits by FDR and xProphet flag, shared by all output
+formats of xlconverter.
+
+Filtering by the fdr of the result file only depends on each hit, so the
+hits are filtered while the spectra are converted. The recomputed q-values
+depend on all hits: the attributes relevant for filtering are collected
+into NumPy columns in a first pass over the spectra, and the filter is
+evaluated once on these columns as a boolean mask, which is then applied to
+the hits in order while the spectra are converted in a second pass. The
+columns are kept next to the result file, so further runs with other
+cutoffs skip the first pass. NumPy is only imported once columns are used.
+"""
+import os
+import sys
+import tempfile
+
+
+# Suffix of the file with the cached columns of a result file
+columns_suffix = '.xlcols.npz'
+
+
+def is_decoy(d):
+    """
+    Whether the search hit is a decoy, by its decoy flag or by its proteins.
+    """
+    return d.get('decoy', '0').strip() not in ('', '0') or \
+        'decoy' in d.get('prot1', '') or 'decoy' in d.get('prot2', '')
+
+
+def hit_columns(spectra):
+    """
+    Collects score, fdr, xprophet_f and decoy of all search hits of the
+    spectra into arrays, in the order of the hits. Hits without fdr get an
+    FDR of 0, hits without xprophet_f are considered as not flagged.
+    """
+    import numpy as np
+    score = []
+    fdr = []
+    xprophet_f = []
+    decoy = []
+    for (spectrum, hits) in spectra:
+        for d in hits:
+            score.append(float(d.get('score') or 'nan'))
+            fdr.append(float(d.get('fdr') or 0))
+            xprophet_f.append(int(d.get('xprophet_f') or 0))
+            decoy.append(is_decoy(d))
+    return {
+        'score': np.array(score, dtype=np.float64),
+        'fdr': np.array(fdr, dtype=np.float64),
+        'xprophet_f': np.array(xprophet_f, dtype=np.int64),
+        'decoy': np.array(decoy, dtype=bool)
+    }
+
+
+def concatenate_columns(columns):
+    """
+    Concatenates the columns of consecutive parts of the spectra.
+    """
+    import numpy as np
+    return {name: np.concatenate([c[name] for c in columns]) for name in columns[0]}
+
+
+def target_decoy_qvalues(scores, decoy):
+    """
+    Computes the q-value of each hit from the target-decoy approach: the FDR
+    at a score threshold is the number of decoys divided by the number of
+    targets scoring at least as high, the q-value is the minimal FDR of all
+    thresholds which still accept the hit. Hits with equal score share their q-value.
+    """
+    import numpy as np
+    n = len(scores)
+    if n == 0:
+        return np.empty(0)
+    # Missing scores are ranked last
+    order = np.argsort(-np.nan_to_num(scores, nan=-np.inf), kind='stable')
+    ranked_scores = np.nan_to_num(scores[order], nan=-np.inf)
+    n_decoys = np.cumsum(decoy[order])
+    n_targets = np.arange(1, n + 1) - n_decoys
+
+    # Each hit counts all hits tied with it
+    last_tied = np.searchsorted(-ranked_scores, -ranked_scores, side='right') - 1
+    fdr = n_decoys[last_tied] / np.maximum(n_targets[last_tied], 1)
+    qvalues = np.minimum.accumulate(fdr[::-1])[::-1]
+
+    result = np.empty(n)
+    result[order] = qvalues
+    return result
+
+
+def filter_mask(columns, max_fdr=1, xprop_flagged=False, recompute_fdr=False):
+    """
+    Returns the boolean mask of the hits passing the filter and their
+    q-values if recompute_fdr is set, None otherwise. The FDR of the hits
+    is either taken from the result file or recomputed by target_decoy_qvalues.
+    """
+    qvalues = None
+    fdr = columns['fdr']
+    if recompute_fdr:
+        qvalues = target_decoy_qvalues(columns['score'], columns['decoy'])
+        fdr = qvalues
+    mask = fdr <= max_fdr
+    if xprop_flagged:
+        mask &= columns['xprophet_f'] != 0
+    return (mask, qvalues)
+
+
+def passes_filter(d, max_fdr=1, xprop_flagged=False):
+    """
+    Whether the search hit passes the filter by the fdr of the result file
+    and the xProphet flag, the rule of filter_mask for a single hit.
+    """
+    if not float(d.get('fdr') or 0) <= max_fdr:
+        return False
+    return not xprop_flagged or int(d.get('xprophet_f') or 0) != 0
+
+
+def filter_spectra(spectra, max_fdr=1, xprop_flagged=False):
+    """
+    Generates the spectra with only the hits passing the filter by the fdr
+    of the result file and the xProphet flag, see passes_filter.
+    """
+    for (spectrum, hits) in spectra:
+        yield (spectrum, [d for d in hits if passes_filter(d, max_fdr, xprop_flagged)])
+
+
+def columns_path(infile_path):
+    return infile_path + columns_suffix
+
+
+def file_stamp(infile_path):
+    """
+    Size and modification time of the result file, which identify its version.
+    """
+    import numpy as np
+    stat = os.stat(infile_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def encode_ranges(ranges):
+    import numpy as np
+    # The open end of the last range is stored as -1
+    return np.array([(start, -1 if end is None else end) for (start, end) in ranges], dtype=np.int64).reshape(-1, 2)
+
+
+def load_columns(infile_path, ranges):
+    """
+    Returns the list of the cached columns of the byte ranges of the result
+    file, see store_columns, None if there are none for the current version
+    of the file and these ranges.
+    """
+    import numpy as np
+    path = columns_path(infile_path)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path) as cached:
+            if not np.array_equal(cached['stamp'], file_stamp(infile_path)) or \
+                    not np.array_equal(cached['ranges'], encode_ranges(ranges)):
+                return None
+            bounds = cached['bounds']
+            columns = {name: cached[name] for name in ('score', 'fdr', 'xprophet_f', 'decoy')}
+    except (OSError, ValueError, KeyError) as e:
+        sys.stderr.write("WARNING: Ignoring cached columns {}: {}\n".format(path, e))
+        return None
+    return [{name: column[lower:upper] for (name, column) in columns.items()}
+            for (lower, upper) in zip(bounds[:-1], bounds[1:])]
+
+
+def store_columns(infile_path, ranges, columns):
+    """
+    Writes the columns of the byte ranges of the result file next to it,
+    together with the ranges and the version of the file. The columns are
+    only a cache, so failing to write them is not an error.
+    """
+    import numpy as np
+    directory = os.path.dirname(os.path.abspath(infile_path))
+    bounds = np.cumsum([0] + [len(c['score']) for c in columns])
+    tmp = None
+    try:
+        umask = os.umask(0)
+        os.umask(umask)
+        (fd, tmp) = tempfile.mkstemp(prefix='.', suffix=columns_suffix, dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, stamp=file_stamp(infile_path), ranges=encode_ranges(ranges), bounds=bounds,
+                     **concatenate_columns(columns))
+        # mkstemp creates files which are only accessible by the owner
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, columns_path(infile_path))
+        tmp = None
+    except OSError as e:
+        sys.stderr.write("WARNING: Could not write cached columns next to {}: {}\n".format(infile_path, e))
+    finally:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def apply_mask(spectra, mask, qvalues=None):
+    """
+    Generates the spectra with only the hits passing the mask, which holds
+    one entry for each hit in the order of the spectra. If qvalues are given,
+    each passing hit gets its q-value as attribute qvalue.
+    """
+    i = 0
+    for (spectrum, hits) in spectra:
+        kept = []
+        for d in hits:
+            if mask[i]:
+                if qvalues is not None:
+                    d = dict(d, qvalue=repr(float(qvalues[i])))
+                kept.append(d)
+            i += 1
+        yield (spectrum, kept)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming parser for xQuest result files, shared by the xlink tools.
+
+The file is fed in large chunks into an expat pull parser, so neither
+the layout of the XML (tags spanning several lines, attribute values
+containing whitespace) nor the size of the file matter.
+"""
+import os
+import re
+import xml.parsers.expat
+
+
+# Bytes read at once from the result file
+chunk_size = 1 << 20
+
+# Bytes inspected by detect_format
+detect_size = 1 << 13
+
+re_xquest = re.compile(rb'^\s*<xquest', re.MULTILINE)
+
+spectrum_end_tag = b'</spectrum_search'
+
+# Tags located by generate_tags
+tag_names = {
+    'spectrum': b'<spectrum_search',
+    'hit': b'<search_hit',
+    'end': spectrum_end_tag
+}
+
+# Bytes which may follow the name of a tag
+tag_name_ends = b' \t\r\n/>'
+
+# Start tag from its '<', attribute values may contain '>'
+re_start_tag = re.compile(rb'<[^\s/>]+(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+
+# The digits of the rank are group 2
+re_rank = re.compile(rb'\ssearch_hit_rank\s*=\s*(["\'])([0-9]*)\1')
+
+
+def detect_format(infile_path):
+    """
+    Returns "xquest" if the head of the file contains the root element
+    of an xQuest result file, None otherwise.
+    """
+    with open(infile_path, 'rb') as f:
+        head = f.read(detect_size)
+    if re_xquest.search(head):
+        return "xquest"
+    return None
+
+
+def generate_events(infile_path, chunk_size=chunk_size, start=0, end=None):
+    """
+    Generates tuples (event, attributes, offset), where event is one of
+
+        'spectrum'  start of a spectrum_search element
+        'hit'       start of a search_hit element
+        'end'       end of a spectrum_search element
+
+    attributes is the dictionary of the attributes of the element (None for
+    'end') and offset is the byte offset of the tag within the file.
+
+    Only the bytes from start to end are parsed if given, which have to be
+    a range as returned by split_spectra.
+    """
+    events = []
+    parser = xml.parsers.expat.ParserCreate()
+
+    # Ranges after the first lack the root element, which is replaced by a dummy
+    prefix = b'<xquest_range>' if start > 0 else b''
+    shift = start - len(prefix)
+
+    def start_element(name, attributes):
+        if name == 'search_hit':
+            events.append(('hit', attributes, parser.CurrentByteIndex + shift))
+        elif name == 'spectrum_search':
+            events.append(('spectrum', attributes, parser.CurrentByteIndex + shift))
+
+    def end_element(name):
+        if name == 'spectrum_search':
+            events.append(('end', None, parser.CurrentByteIndex + shift))
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+
+    with open(infile_path, 'rb') as f:
+        f.seek(start)
+        parser.Parse(prefix, False)
+        remaining = -1 if end is None else end - start
+        while True:
+            chunk = f.read(chunk_size if remaining < 0 else min(chunk_size, remaining))
+            if remaining >= 0:
+                remaining -= len(chunk)
+            # Ranges are cut within the root element, so they cannot be completed
+            parser.Parse(chunk, not chunk and end is None)
+            for event in events:
+                yield event
+            del events[:]
+            if not chunk:
+                break
+
+
+def generate_tags(buffer, start=0, end=None):
+    """
+    Fast path of generate_events for a result file held in a buffer (bytes
+    or mmap). The tags are located with find instead of parsing the XML,
+    which assumes that they do not occur within comments or CDATA sections.
+
+    Generates tuples (event, tag_start, tag_end) with the events of
+    generate_events, where tag_start and tag_end are the offsets of the
+    tag within the buffer.
+    """
+    if end is None:
+        end = len(buffer)
+    found = [[buffer.find(name, start, end), event, name] for (event, name) in tag_names.items()]
+    while True:
+        candidates = [f for f in found if f[0] != -1]
+        if not candidates:
+            return
+        nearest = min(candidates)
+        (position, event, name) = nearest
+        following = position + len(name)
+        nearest[0] = buffer.find(name, following, end)
+        if following >= end or buffer[following] not in tag_name_ends:
+            # Only a tag with a longer name
+            continue
+        tag_end = buffer.find(b'>', following, end) + 1
+        if tag_end > 0 and event != 'end':
+            tag = buffer[following:tag_end]
+            if tag.count(b'"') % 2 or tag.count(b"'") % 2:
+                # A quoted attribute value contains '>' or a quote of the other kind
+                m = re_start_tag.match(buffer, position, end)
+                tag_end = 0 if m is None else m.end()
+        if tag_end <= 0:
+            # Truncated tag at the end of the buffer
+            return
+        yield (event, position, tag_end)
+
+
+def find_spectrum_end(f, position, chunk_size=chunk_size):
+    """
+    Returns the offset directly after the first closing spectrum_search tag
+    at or after position in the binary file f, None if there is none.
+    """
+    f.seek(position)
+    data = b''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return None
+        data += chunk
+        found = data.find(spectrum_end_tag)
+        if found != -1:
+            close = data.find(b'>', found)
+            if close != -1:
+                return position + close + 1
+        else:
+            # Keeps the tail in case the tag is split between chunks
+            keep = len(spectrum_end_tag) - 1
+            position += len(data) - keep
+            data = data[len(data) - keep:]
+
+
+def find_last_spectrum_end(f, size, chunk_size=chunk_size):
+    """
+    Returns the offset directly after the last closing spectrum_search tag
+    in the binary file f of the given size, None if there is none.
+    """
+    position = size
+    while position > 0:
+        position = max(0, position - chunk_size)
+        f.seek(position)
+        data = f.read(size - position)
+        found = data.rfind(spectrum_end_tag)
+        if found != -1:
+            close = data.find(b'>', found)
+            if close != -1:
+                return position + close + 1
+    return None
+
+
+def split_spectra(infile_path, n):
+    """
+    Splits the result file into at most n byte ranges (start, end) of about
+    equal size, each ending directly after a closing spectrum_search tag.
+    The ranges can be parsed independently with generate_events. Returns the
+    single range (0, None) of the whole file if the file cannot be split.
+    """
+    if n <= 1:
+        return [(0, None)]
+    size = os.path.getsize(infile_path)
+    with open(infile_path, 'rb') as f:
+        last = find_last_spectrum_end(f, size)
+        if last is None:
+            return [(0, None)]
+        bounds = []
+        for k in range(1, n):
+            target = size * k // n
+            if bounds and target <= bounds[-1]:
+                continue
+            bound = find_spectrum_end(f, target)
+            if bound is None or bound >= last:
+                break
+            bounds.append(bound)
+        bounds.append(last)
+    return list(zip([0] + bounds[:-1], bounds))
+
+
+def generate_spectra(infile_path, chunk_size=chunk_size, start=0, end=None):
+    """
+    Generates a tuple (spectrum, hits) for each spectrum_search element,
+    where spectrum is the dictionary of its attributes and hits the list
+    of the attribute dictionaries of its search_hit elements.
+    """
+    spectrum = None
+    hits = []
+    for (event, attributes, _) in generate_events(infile_path, chunk_size, start, end):
+        if event == 'hit':
+            hits.append(attributes)
+        elif event == 'spectrum':
+            spectrum = attributes
+            hits = []
+        else:
+            yield (spectrum, hits)
+            spectrum = None
+            hits = []